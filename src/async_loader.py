@@ -0,0 +1,192 @@
+"""Asyncio access to the database that does not block the event loop.
+
+sqlite3 calls block, so the async methods of Lab and Patient and
+CohortQuery.apatient_ids run their queries on a bounded pool of
+worker threads. The workers borrow their connections from the
+database's pool in connection_pool, like the blocking properties do,
+so close_pool and read mode apply to them as well. A database's
+default pool has connection_pool.DEFAULT_POOL_SIZE connections,
+which the workers share with the rest of the process; after
+connection_pool.configure_read_only(db_name) every worker has a
+read-only connection of its own instead and never waits for another.
+
+Lookups of the same kind that are awaited in the same iteration of
+the event loop are coalesced by a BatchLoader: when a hundred
+requests each await patient.aload(), the database sees one
+``WHERE ID IN (...)`` query instead of a hundred single-row ones.
+"""
+import asyncio
+import atexit
+import functools
+import json
+import sqlite3
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+import instrumentation
+from connection_pool import get_pool
+
+T = TypeVar("T")
+
+# number of worker threads running the queries
+DEFAULT_WORKERS = 4
+
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def _run(db_name: str, function: Callable[[sqlite3.Connection], T]) -> T:
+    """Call function with a connection to db_name, in a worker thread.
+
+    The connection is borrowed from the database's pool, see
+    connection_pool.get_pool, like the connections of the blocking
+    properties.
+    """
+    with get_pool(db_name).connection() as connection:
+        return function(connection)
+
+
+def executor() -> ThreadPoolExecutor:
+    """Return the worker pool, creating it on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                DEFAULT_WORKERS, thread_name_prefix="ehr-async"
+            )
+        return _executor
+
+
+def configure_executor(workers: int = DEFAULT_WORKERS) -> None:
+    """Replace the worker pool with one of the given size."""
+    global _executor
+    if workers < 1:
+        raise ValueError("The number of workers must be at least 1")
+    shutdown()
+    with _executor_lock:
+        _executor = ThreadPoolExecutor(workers, thread_name_prefix="ehr-async")
+
+
+def shutdown() -> None:
+    """Stop the workers, closing the connections they held of their own.
+
+    Those are the per-thread connections of databases in read mode,
+    which a ReadOnlyPool closes once their thread has exited.
+    Connections borrowed from a ConnectionPool went back to it after
+    every query. Called automatically at interpreter exit; the next
+    async call starts a new pool.
+    """
+    global _executor
+    with _executor_lock:
+        pool, _executor = _executor, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+async def run_query(
+    db_name: str, function: Callable[[sqlite3.Connection], T]
+) -> T:
+    """Run function(connection) in a worker thread and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor(), _run, db_name, function)
+
+
+class BatchLoader:
+    """Coalesce the lookups of one event loop iteration into one query.
+
+    load(key) returns every row of table whose key_column equals key,
+    as (key, *columns) tuples in order_by order. The first load of an
+    iteration schedules a flush with loop.call_soon; every load made
+    before the flush runs joins the same query.
+    """
+
+    def __init__(
+        self,
+        db_name: str,
+        table: str,
+        key_column: str,
+        columns: str,
+        order_by: str,
+    ) -> None:
+        """Initialize a loader; use loader() to share one per loop."""
+        self.db_name = db_name
+        self.query = f"""
+            SELECT {key_column}, {columns} FROM {table}
+            WHERE {key_column} IN (SELECT value FROM json_each(?))
+            ORDER BY {order_by}
+            """
+        self._pending: dict[Any, list[asyncio.Future[list[Any]]]] = dict()
+
+    async def load(self, key: Any) -> list[tuple[Any, ...]]:
+        """Return the rows for key, batched with concurrent loads."""
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[list[Any]] = loop.create_future()
+        if not self._pending:
+            loop.call_soon(self._flush, loop)
+        self._pending.setdefault(key, []).append(future)
+        return await future
+
+    def _fetch(
+        self, keys: list[Any], connection: sqlite3.Connection
+    ) -> dict[Any, list[tuple[Any, ...]]]:
+        """Select the rows of all keys at once, in a worker thread."""
+        rows: dict[Any, list[tuple[Any, ...]]] = dict()
+        cursor = connection.execute(self.query, (json.dumps(keys),))
+        for row in cursor:
+            rows.setdefault(row[0], []).append(row)
+        cursor.close()
+        return rows
+
+    def _flush(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Send the pending keys to a worker as one query."""
+        pending, self._pending = self._pending, dict()
+        stats = instrumentation.current()
+        if stats is not None:
+            stats.count("async_batches")
+            stats.count("async_lookups", sum(map(len, pending.values())))
+
+        done = loop.run_in_executor(
+            executor(),
+            _run,
+            self.db_name,
+            functools.partial(self._fetch, list(pending)),
+        )
+
+        def deliver(done: asyncio.Future[dict[Any, Any]]) -> None:
+            """Hand every waiting load its rows, or the query's error."""
+            error = None if done.cancelled() else done.exception()
+            for key, futures in pending.items():
+                for future in futures:
+                    if future.done():
+                        continue
+                    if done.cancelled():
+                        future.cancel()
+                    elif error is not None:
+                        future.set_exception(error)
+                    else:
+                        future.set_result(done.result().get(key, []))
+
+        done.add_done_callback(deliver)
+
+
+_loaders: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, dict[tuple[str, ...], BatchLoader]
+] = weakref.WeakKeyDictionary()
+
+
+def loader(
+    db_name: str, table: str, key_column: str, columns: str, order_by: str
+) -> BatchLoader:
+    """Return the running loop's BatchLoader for a kind of lookup."""
+    loop = asyncio.get_running_loop()
+    loaders = _loaders.setdefault(loop, dict())
+    key = (db_name, table, key_column, columns, order_by)
+    batch_loader = loaders.get(key)
+    if batch_loader is None:
+        batch_loader = loaders[key] = BatchLoader(*key)
+    return batch_loader
+
+
+atexit.register(shutdown)
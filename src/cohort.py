@@ -0,0 +1,424 @@
+"""Cohort-level queries over the PATIENTS and LABS tables.
+
+The Patient methods answer questions about one patient by walking
+its Lab objects in Python. The functions here answer the same
+questions for a whole cohort with a single SQL statement, and keep
+the per-patient semantics so both give the same answers.
+"""
+import datetime as dt
+import json
+import sqlite3
+from typing import Any, AsyncIterator, Iterable, Iterator, NamedTuple
+
+from async_loader import run_query
+from connection_pool import connection_for
+from patient_parser_v4 import date_sql, stored_date, to_epoch
+
+# operators accepted by Patient.is_sick
+SICK_OPERATORS = (">", "<")
+
+
+def _cohort_filter(
+    patient_ids: Iterable[str] | None, parameters: dict[str, Any]
+) -> str:
+    """Return the SQL selecting the cohort's patient IDs.
+
+    Without patient_ids the cohort is every patient in PATIENTS.
+    Otherwise the IDs are passed as one JSON array parameter, which
+    avoids SQLite's limit on the number of bound parameters.
+    """
+    if patient_ids is None:
+        return "SELECT ID FROM PATIENTS"
+    parameters["patient_ids"] = json.dumps(list(patient_ids))
+    return "SELECT DISTINCT value FROM json_each(:patient_ids)"
+
+
+def check_operator(operator: str) -> None:
+    """Raise ValueError for operators that is_sick does not support."""
+    if operator not in SICK_OPERATORS:
+        raise ValueError(
+            f"Unsupported operator {operator!r}, expected one of "
+            f"{', '.join(SICK_OPERATORS)}"
+        )
+
+
+def cohort_is_sick(
+    db: sqlite3.Connection | str,
+    lab_name: str,
+    operator: str,
+    value: float,
+    patient_ids: Iterable[str] | None = None,
+) -> dict[str, bool | None]:
+    """Evaluate Patient.is_sick for every patient in a cohort.
+
+    db is an open connection or the path of the database. The cohort
+    is every patient in PATIENTS, or the given patient_ids.
+
+    The latest lab named lab_name is selected for every patient with
+    one windowed query (ROW_NUMBER over PatientID, newest Date first),
+    and its value is compared against value using operator. When a
+    patient has several labs sharing the latest date, the one that
+    was ingested first wins, exactly as in Patient.is_sick.
+
+    Patients without that lab, for which Patient.is_sick raises
+    ValueError, are mapped to None.
+
+    The query makes a single pass over the LABS rows with that name,
+    so the cost is O(K) for the whole cohort instead of O(K) per
+    patient.
+    """
+    check_operator(operator)
+
+    parameters: dict[str, Any] = {
+        "lab_name": lab_name,
+        "value": value,
+    }
+    cohort_sql = _cohort_filter(patient_ids, parameters)
+
+    query = f"""
+        WITH latest AS (
+            SELECT
+                PatientID,
+                Value,
+                ROW_NUMBER() OVER (
+                    PARTITION BY PatientID
+                    ORDER BY Date DESC, Autogen_id ASC
+                ) AS recency
+            FROM LABS
+            WHERE Name = :lab_name
+        ),
+        cohort(ID) AS ({cohort_sql})
+        SELECT cohort.ID, latest.Value {operator} :value
+        FROM cohort
+        LEFT JOIN latest
+            ON latest.PatientID = cohort.ID AND latest.recency = 1
+        """
+
+    output_dict: dict[str, bool | None] = dict()
+    with connection_for(db) as connection:
+        cursor = connection.execute(query, parameters)
+        for patient_id, sick in cursor:
+            output_dict[str(patient_id)] = None if sick is None else bool(sick)
+        cursor.close()
+    return output_dict
+
+
+class PatientAges(NamedTuple):
+    """Dates and ages of one patient, as computed by cohort_ages."""
+
+    patient_id: str
+    dob: dt.datetime
+    first_admission: dt.datetime | None
+    age_at_first_admission: int
+    age: int
+
+
+def cohort_ages(
+    db: sqlite3.Connection | str,
+    patient_ids: Iterable[str] | None = None,
+    now: dt.datetime | None = None,
+) -> Iterator[PatientAges]:
+    """Stream the first admission date and ages of a cohort's patients.
+
+    The earliest lab date of every patient is found with a single
+    MIN(Date) ... GROUP BY PatientID, joined against PATIENTS for the
+    date of birth, and the rows are yielded as the query produces
+    them. The query is O(K) for the whole cohort, where calling
+    Patient.age_at_first_admission for every patient costs a
+    database round trip per lab.
+
+    Ages follow Patient.age and Patient.age_at_first_admission:
+    differences of calendar years, measured from now (the current
+    time by default). A patient without labs has no first admission
+    and, as in Patient.age_at_first_admission, is counted at its
+    current age.
+
+    Patients that are in patient_ids but not in PATIENTS are skipped.
+    """
+    if now is None:
+        now = dt.datetime.now()
+    parameters: dict[str, Any] = dict()
+    cohort_sql = _cohort_filter(patient_ids, parameters)
+
+    query = f"""
+        WITH first AS (
+            SELECT PatientID, MIN(Date) AS FirstDate
+            FROM LABS
+            GROUP BY PatientID
+        ),
+        cohort(ID) AS ({cohort_sql})
+        SELECT PATIENTS.ID, PATIENTS.DateOfBirth, first.FirstDate
+        FROM cohort
+        JOIN PATIENTS ON PATIENTS.ID = cohort.ID
+        LEFT JOIN first ON first.PatientID = PATIENTS.ID
+        """
+    with connection_for(db) as connection:
+        cursor = connection.execute(query, parameters)
+        for patient_id, raw_dob, raw_first in cursor:
+            dob = stored_date(raw_dob)
+            first = None if raw_first is None else stored_date(raw_first)
+            earliest = now if first is None else min(first, now)
+            yield PatientAges(
+                str(patient_id),
+                dob,
+                first,
+                earliest.year - dob.year,
+                now.year - dob.year,
+            )
+        cursor.close()
+
+
+def cohort_age_at_first_admission(
+    db: sqlite3.Connection | str,
+    patient_ids: Iterable[str] | None = None,
+) -> dict[str, int]:
+    """Return Patient.age_at_first_admission for a cohort, by patient ID."""
+    return {
+        ages.patient_id: ages.age_at_first_admission
+        for ages in cohort_ages(db, patient_ids)
+    }
+
+
+# comparison operators accepted by CohortQuery.lab
+LAB_OPERATORS = ("<", "<=", "=", "!=", ">=", ">")
+# which of a patient's labs must satisfy a CohortQuery.lab predicate
+LAB_MODES = ("latest", "any", "all")
+
+
+class CohortQuery:
+    """Builder of a cohort selection, compiled to one SQL statement.
+
+    Every filter method adds a condition on PATIENTS, or on the
+    patient's LABS rows, and returns the query itself so that calls
+    can be chained:
+
+        query = (
+            CohortQuery()
+            .demographics(gender="Female", race=["White", "Black"])
+            .age_between(40, 65)
+            .lab("METABOLIC: ALBUMIN", "<", 3.5)
+        )
+        for patient_id in query.patient_ids("EHR.db"):
+            ...
+
+    All conditions must hold. Values are always bound as parameters,
+    never pasted into the SQL. The lab predicates are correlated
+    subqueries on (PatientID, Name), which idx_labs_patient_name_date
+    answers in O(log K) per patient, so the whole selection costs
+    O(N log K) in SQLite instead of a query per property per patient.
+    """
+
+    def __init__(self, now: dt.datetime | None = None) -> None:
+        """Start a query selecting every patient.
+
+        Ages are measured at now, the current time by default.
+        """
+        self.now = dt.datetime.now() if now is None else now
+        self._conditions: list[str] = []
+        self._parameters: dict[str, Any] = dict()
+
+    def _bind(self, value: Any) -> str:
+        """Add a parameter and return its placeholder."""
+        name = f"p{len(self._parameters)}"
+        self._parameters[name] = value
+        return f":{name}"
+
+    def _bind_date(self, date: dt.datetime) -> str:
+        """Bind a birth date as text and epoch, return SQL picking one."""
+        return date_sql(
+            "PATIENTS",
+            "DateOfBirth",
+            self._bind(str(date)),
+            self._bind(to_epoch(date)),
+        )
+
+    def _match(self, column: str, values: str | Iterable[str]) -> None:
+        """Require column to equal values, or to be one of them."""
+        if isinstance(values, str):
+            self._conditions.append(f"{column} = {self._bind(values)}")
+        else:
+            placeholder = self._bind(json.dumps(list(values)))
+            self._conditions.append(
+                f"{column} IN (SELECT value FROM json_each({placeholder}))"
+            )
+
+    def demographics(
+        self,
+        gender: str | Iterable[str] | None = None,
+        race: str | Iterable[str] | None = None,
+        marital_status: str | Iterable[str] | None = None,
+        language: str | Iterable[str] | None = None,
+    ) -> "CohortQuery":
+        """Keep patients whose columns match a value or one of several."""
+        for column, values in [
+            ("Gender", gender),
+            ("Race", race),
+            ("MaritalStatus", marital_status),
+            ("Language", language),
+        ]:
+            if values is not None:
+                self._match(column, values)
+        return self
+
+    def age_between(
+        self, min_age: int | None = None, max_age: int | None = None
+    ) -> "CohortQuery":
+        """Keep patients whose Patient.age lies in [min_age, max_age].
+
+        Patient.age is a difference of calendar years, so the bounds
+        translate to a range of birth dates, compared in the format
+        SQLite stores them in, see patient_parser_v4.date_sql.
+        """
+        if min_age is not None:
+            # born in now.year - min_age or earlier
+            limit = dt.datetime(self.now.year - min_age + 1, 1, 1)
+            self._conditions.append(f"DateOfBirth < {self._bind_date(limit)}")
+        if max_age is not None:
+            # born in now.year - max_age or later
+            limit = dt.datetime(self.now.year - max_age, 1, 1)
+            self._conditions.append(f"DateOfBirth >= {self._bind_date(limit)}")
+        return self
+
+    def poverty_between(
+        self, minimum: float | None = None, maximum: float | None = None
+    ) -> "CohortQuery":
+        """Keep patients whose poverty level lies in [minimum, maximum]."""
+        if minimum is not None:
+            self._conditions.append(f"PovertyLevel >= {self._bind(minimum)}")
+        if maximum is not None:
+            self._conditions.append(f"PovertyLevel <= {self._bind(maximum)}")
+        return self
+
+    def lab(
+        self,
+        lab_name: str,
+        operator: str,
+        value: float,
+        mode: str = "latest",
+    ) -> "CohortQuery":
+        """Keep patients whose lab_name results satisfy operator value.
+
+        With mode="latest" the latest result is compared, picked as in
+        Patient.is_sick. With mode="any" one result must satisfy the
+        comparison, and with mode="all" every result must. In every
+        mode, patients without a lab_name result are left out.
+        """
+        if operator not in LAB_OPERATORS:
+            raise ValueError(
+                f"Unsupported operator {operator!r}, expected one of "
+                f"{', '.join(LAB_OPERATORS)}"
+            )
+        if mode not in LAB_MODES:
+            raise ValueError(
+                f"Unsupported mode {mode!r}, expected one of "
+                f"{', '.join(LAB_MODES)}"
+            )
+        name = self._bind(lab_name)
+        bound = self._bind(value)
+        labs = f"FROM LABS WHERE PatientID = PATIENTS.ID AND Name = {name}"
+
+        if mode == "latest":
+            condition = f"""(
+                SELECT Value {labs}
+                ORDER BY Date DESC, Autogen_id ASC
+                LIMIT 1
+            ) {operator} {bound}"""
+        elif mode == "any":
+            condition = (
+                f"EXISTS (SELECT 1 {labs} AND Value {operator} {bound})"
+            )
+        else:
+            condition = f"""EXISTS (SELECT 1 {labs})
+            AND NOT EXISTS (
+                SELECT 1 {labs} AND NOT (Value {operator} {bound})
+            )"""
+        self._conditions.append(condition)
+        return self
+
+    def _where(self) -> str:
+        """Return the conjunction of all conditions."""
+        return "\n            AND ".join(self._conditions) or "1"
+
+    def compile(self) -> tuple[str, dict[str, Any]]:
+        """Return the SQL statement and its named parameters."""
+        where = self._where()
+        query = f"""
+            SELECT ID FROM PATIENTS
+            WHERE {where}
+            ORDER BY rowid
+            """
+        return query, dict(self._parameters)
+
+    def patient_ids(self, db: sqlite3.Connection | str) -> Iterator[str]:
+        """Stream the IDs of the matching patients, in ingest order.
+
+        The connection is held until the iteration ends.
+        """
+        query, parameters = self.compile()
+        with connection_for(db) as connection:
+            cursor = connection.execute(query, parameters)
+            for (patient_id,) in cursor:
+                yield str(patient_id)
+            cursor.close()
+
+    async def apatient_ids(
+        self, db_name: str, page_size: int = 1000
+    ) -> AsyncIterator[str]:
+        """Stream the matching patient IDs without blocking the event loop.
+
+        The patients are selected page_size at a time, each page by a
+        separate query in an async_loader worker thread, continuing
+        after the last rowid of the previous page. No connection is
+        held between pages. db_name is a database name as in
+        Patient.db_name.
+        """
+        if page_size < 1:
+            raise ValueError("The page size must be at least 1")
+        query = f"""
+            SELECT rowid, ID FROM PATIENTS
+            WHERE ({self._where()}) AND rowid > :after_rowid
+            ORDER BY rowid
+            LIMIT :page_size
+            """
+        parameters = dict(self._parameters, page_size=page_size)
+        after_rowid = 0
+        while True:
+            page = await run_query(
+                db_name,
+                lambda connection: connection.execute(
+                    query, dict(parameters, after_rowid=after_rowid)
+                ).fetchall(),
+            )
+            for _, patient_id in page:
+                yield str(patient_id)
+            if len(page) < page_size:
+                return
+            after_rowid = page[-1][0]
+
+    def count(self, db: sqlite3.Connection | str) -> int:
+        """Return the number of matching patients."""
+        query, parameters = self.compile()
+        with connection_for(db) as connection:
+            (count,) = connection.execute(
+                f"SELECT COUNT(*) FROM ({query})", parameters
+            ).fetchone()
+        return int(count)
+
+    def explain(self, db: sqlite3.Connection | str) -> str:
+        """Return the SQL, its parameters and SQLite's query plan.
+
+        The plan is what EXPLAIN QUERY PLAN reports against db, so it
+        shows which indexes the statement would use there.
+        """
+        query, parameters = self.compile()
+        with connection_for(db) as connection:
+            plan = connection.execute(
+                f"EXPLAIN QUERY PLAN {query}", parameters
+            ).fetchall()
+
+        lines = [query.strip(), "", f"parameters: {parameters}", "", "plan:"]
+        depths: dict[int, int] = dict()
+        for node, parent, _, detail in plan:
+            depths[node] = depths.get(parent, -1) + 1
+            lines.append(f"{'  ' * depths[node]}{detail}")
+        return "\n".join(lines)
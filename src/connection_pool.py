@@ -0,0 +1,520 @@
+"""Connection manager shared by the Lab and Patient model objects.
+
+Opening an SQLite connection costs far more than the single-row
+lookups that the model properties perform, so connections are kept
+in a pool per database path and handed out again on every access.
+Each pooled connection keeps its own prepared-statement cache
+(the ``cached_statements`` argument of ``sqlite3.connect``), which
+means that repeated property reads also skip the SQL compilation.
+
+Thread safety: a pooled connection is only ever used by the thread
+that checked it out, so Lab and Patient objects may be read from many
+threads at once. With a ConnectionPool, at most its size of them
+query at the same time. For read-heavy fan-out, switch a database
+file to read mode with configure_read_only: every thread then gets
+its own read-only connection (an SQLite URI with mode=ro), opened on
+its first query and kept until the thread exits or the pool is
+closed, and no thread waits for another. Writes through those
+connections fail, so ingest into the database before switching, or
+after configure_pool has switched it back.
+
+A pooled connection keeps the file it opened, even after that file
+is deleted or replaced. refresh_pool swaps such a pool for a fresh
+one, which parse_data does before every ingest.
+"""
+import atexit
+import os
+import sqlite3
+import threading
+import urllib.parse
+import weakref
+from contextlib import contextmanager
+from typing import Iterator
+
+import instrumentation
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CACHED_STATEMENTS = 128
+
+
+class ConnectionPool:
+    """Pool of reusable connections to a single SQLite database.
+
+    At most ``size`` connections are open at any time. Callers that
+    ask for a connection while all of them are checked out wait until
+    one is released.
+
+    db_name may also be an SQLite URI starting with ``file:``, such
+    as the shared-cache in-memory databases of shared_memory_uri.
+    Such a database lives as long as one of its connections is open,
+    which the idle connections of the pool take care of.
+    """
+
+    def __init__(
+        self,
+        db_name: str,
+        size: int = DEFAULT_POOL_SIZE,
+        cached_statements: int = DEFAULT_CACHED_STATEMENTS,
+    ) -> None:
+        """Initialize an empty pool; connections are opened on demand."""
+        if size < 1:
+            raise ValueError("The pool size must be at least 1")
+        self.db_name = db_name
+        self.size = size
+        self.cached_statements = cached_statements
+        self._idle: list[sqlite3.Connection] = []
+        self._open = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        # (device, inode) of the database file the connections opened
+        self._file_id: tuple[int, int] | None = None
+        # the connection handed over with adopt, if any
+        self.adopted: sqlite3.Connection | None = None
+
+    @property
+    def closed(self) -> bool:
+        """Return whether the pool has been closed."""
+        return self._closed
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a new connection for the pool."""
+        stats = instrumentation.current()
+        if stats is not None:
+            stats.count("connections_opened")
+        connection = sqlite3.connect(
+            self.db_name,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+            uri=self.db_name.startswith("file:"),
+        )
+        self._remember_file()
+        return connection
+
+    def _remember_file(self) -> None:
+        """Record which file the pool's connections opened, O(1)."""
+        if self._file_id is None:
+            self._file_id = _file_id(self.db_name)
+
+    def replaced(self) -> bool:
+        """Return whether the database file was deleted or replaced.
+
+        That is, whether the file at db_name is no longer the one the
+        pool's connections opened. Always False for in-memory
+        databases and URIs, and for a pool that opened nothing yet.
+        """
+        return (
+            self._file_id is not None
+            and _file_id(self.db_name) != self._file_id
+        )
+
+    def acquire(self) -> sqlite3.Connection:
+        """Check a connection out of the pool.
+
+        An idle connection is reused when there is one. Otherwise a
+        new connection is opened, unless the pool is already at its
+        size limit, in which case the call blocks until another
+        caller releases a connection.
+        """
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise sqlite3.ProgrammingError(
+                        "Cannot acquire a connection from a closed pool"
+                    )
+                if self._idle:
+                    connection = self._idle.pop()
+                    instrumentation.trace(connection)
+                    return connection
+                if self._open < self.size:
+                    self._open += 1
+                    break
+                self._condition.wait()
+
+        try:
+            connection = self._connect()
+        except BaseException:
+            with self._condition:
+                self._open -= 1
+                self._condition.notify()
+            raise
+        instrumentation.trace(connection)
+        return connection
+
+    def adopt(self, connection: sqlite3.Connection) -> None:
+        """Hand an already open connection over to the pool."""
+        with self._condition:
+            if self._open >= self.size:
+                raise ValueError("The pool has no room for another connection")
+            self._open += 1
+            self._idle.append(connection)
+            self.adopted = connection
+            self._condition.notify()
+
+    def abandoned(self) -> bool:
+        """Return whether the adopted connection was closed by its owner.
+
+        Only an idle connection counts, so that a checkout in
+        progress is never pulled from under its user.
+        """
+        with self._condition:
+            adopted = self.adopted
+            if adopted is None or adopted not in self._idle:
+                return False
+        return _is_closed(adopted)
+
+    def release(self, connection: sqlite3.Connection) -> None:
+        """Return a connection to the pool."""
+        instrumentation.untrace(connection)
+        with self._condition:
+            if self._closed:
+                self._open -= 1
+                connection.close()
+            else:
+                self._idle.append(connection)
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Borrow a connection for the duration of a with block."""
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self) -> None:
+        """Close the idle connections and refuse further checkouts.
+
+        Connections that are checked out when the pool is closed are
+        closed as soon as they are released.
+        """
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._condition.notify_all()
+        for connection in idle:
+            connection.close()
+
+
+def read_only_uri(db_name: str) -> str:
+    """Return the URI that opens a database file read-only."""
+    if db_name.startswith((":memory:", "file:")):
+        raise ValueError(f"{db_name} is not the path of a database file")
+    path = urllib.parse.quote(os.path.abspath(db_name))
+    return f"file:{path}?mode=ro"
+
+
+class _ThreadToken:
+    """Kept in a thread's locals, so that it is freed when the thread ends."""
+
+    __slots__ = ("__weakref__",)
+
+
+class ReadOnlyPool(ConnectionPool):
+    """Pool that gives every thread its own read-only connection.
+
+    A thread reuses its connection for every checkout, nested ones
+    included, so unlike a ConnectionPool it never waits for another
+    thread. SQLite lets any number of connections read at once. A
+    thread's connection is closed once the thread has exited, so
+    short-lived worker threads do not leave connections behind.
+    """
+
+    def __init__(
+        self,
+        db_name: str,
+        cached_statements: int = DEFAULT_CACHED_STATEMENTS,
+    ) -> None:
+        """Initialize an empty pool over the database file db_name."""
+        super().__init__(db_name, 1, cached_statements)
+        self.uri = read_only_uri(db_name)
+        self._local = threading.local()
+        # checkouts in progress per connection, keyed by id()
+        self._checkouts: dict[int, int] = {}
+        self._connections: list[sqlite3.Connection] = []
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a new read-only connection."""
+        stats = instrumentation.current()
+        if stats is not None:
+            stats.count("connections_opened")
+        connection = sqlite3.connect(
+            self.uri,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+            uri=True,
+        )
+        self._remember_file()
+        return connection
+
+    def acquire(self) -> sqlite3.Connection:
+        """Return the calling thread's connection, opening it if needed."""
+        connection: sqlite3.Connection | None = getattr(
+            self._local, "connection", None
+        )
+        with self._condition:
+            if self._closed:
+                raise sqlite3.ProgrammingError(
+                    "Cannot acquire a connection from a closed pool"
+                )
+        if connection is None:
+            connection = self._connect()
+            token = _ThreadToken()
+            self._local.connection = connection
+            self._local.token = token
+            with self._condition:
+                self._connections.append(connection)
+                self._open += 1
+            weakref.finalize(token, self._discard, connection)
+        with self._condition:
+            depth = self._checkouts.get(id(connection), 0)
+            self._checkouts[id(connection)] = depth + 1
+        if depth == 0:
+            instrumentation.trace(connection)
+        return connection
+
+    def _discard(self, connection: sqlite3.Connection) -> None:
+        """Close the connection of a thread that has exited."""
+        with self._condition:
+            if connection not in self._connections:
+                return  # closed with the pool already
+            self._connections.remove(connection)
+            self._open -= 1
+        connection.close()
+
+    def adopt(self, connection: sqlite3.Connection) -> None:
+        """Refuse: a read-only pool opens its own connections."""
+        raise ValueError("A read-only pool opens its own connections")
+
+    def release(self, connection: sqlite3.Connection) -> None:
+        """End a checkout; the connection stays with its thread."""
+        with self._condition:
+            depth = self._checkouts.pop(id(connection)) - 1
+            if depth:
+                self._checkouts[id(connection)] = depth
+            close = self._closed and not depth
+        if not depth:
+            instrumentation.untrace(connection)
+        if close:
+            connection.close()
+
+    def close(self) -> None:
+        """Close the connections of every thread.
+
+        A connection in the middle of a checkout is closed when the
+        checkout ends.
+        """
+        with self._condition:
+            self._closed = True
+            connections, self._connections = self._connections, []
+            self._open = 0
+            idle = [
+                connection
+                for connection in connections
+                if id(connection) not in self._checkouts
+            ]
+        for connection in idle:
+            connection.close()
+
+
+_pools: dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def _file_id(db_name: str) -> tuple[int, int] | None:
+    """Return the (device, inode) of a database file, None if missing.
+
+    In-memory databases and URIs have none.
+    """
+    if db_name.startswith((":memory:", "file:")):
+        return None
+    try:
+        stat = os.stat(db_name)
+    except FileNotFoundError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+def _pool_key(db_name: str) -> str:
+    """Normalize a database path so that aliases share a pool."""
+    if db_name.startswith((":memory:", "file:")):
+        return db_name
+    return os.path.abspath(db_name)
+
+
+def get_pool(db_name: str) -> ConnectionPool:
+    """Return the pool for a database, creating it on first use."""
+    key = _pool_key(db_name)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool.closed:
+            if key.startswith(":memory:") and key != ":memory:":
+                # see database_name; reopening would create a file
+                raise sqlite3.ProgrammingError(
+                    f"The in-memory database {key} has been closed"
+                )
+            pool = ConnectionPool(db_name)
+            _pools[key] = pool
+        return pool
+
+
+def configure_pool(
+    db_name: str,
+    size: int = DEFAULT_POOL_SIZE,
+    cached_statements: int = DEFAULT_CACHED_STATEMENTS,
+) -> ConnectionPool:
+    """Replace the pool for a database with one of the given size."""
+    key = _pool_key(db_name)
+    new_pool = ConnectionPool(db_name, size, cached_statements)
+    with _pools_lock:
+        old_pool = _pools.get(key)
+        _pools[key] = new_pool
+    if old_pool is not None:
+        old_pool.close()
+    return new_pool
+
+
+def configure_read_only(
+    db_name: str, cached_statements: int = DEFAULT_CACHED_STATEMENTS
+) -> ReadOnlyPool:
+    """Switch a database file to read mode, see ReadOnlyPool.
+
+    configure_pool switches it back to a read-write pool.
+    """
+    key = _pool_key(db_name)
+    new_pool = ReadOnlyPool(db_name, cached_statements)
+    with _pools_lock:
+        old_pool = _pools.get(key)
+        _pools[key] = new_pool
+    if old_pool is not None:
+        old_pool.close()
+    return new_pool
+
+
+def refresh_pool(db_name: str) -> None:
+    """Replace the pool for a database whose file was replaced.
+
+    Connections opened before the file was deleted or swapped for
+    another still see the old file, which is read-only once
+    unlinked. The new pool has the same kind and size as the old
+    one and opens connections to the current file. O(1).
+    """
+    key = _pool_key(db_name)
+    with _pools_lock:
+        old_pool = _pools.get(key)
+        if old_pool is None or not old_pool.replaced():
+            return
+        new_pool: ConnectionPool
+        if isinstance(old_pool, ReadOnlyPool):
+            new_pool = ReadOnlyPool(db_name, old_pool.cached_statements)
+        else:
+            new_pool = ConnectionPool(
+                db_name, old_pool.size, old_pool.cached_statements
+            )
+        _pools[key] = new_pool
+    old_pool.close()
+
+
+def close_pool(db_name: str) -> None:
+    """Close and forget the pool for a database, if there is one."""
+    with _pools_lock:
+        pool = _pools.pop(_pool_key(db_name), None)
+    if pool is not None:
+        pool.close()
+
+
+def shutdown() -> None:
+    """Close every pool; called automatically at interpreter exit."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def shared_memory_uri(name: str) -> str:
+    """Return the URI of a named, shared-cache in-memory database.
+
+    Every connection opened with the URI (and uri=True) sees the same
+    database, so model objects can query what parse_data loaded.
+    """
+    return f"file:{name}?mode=memory&cache=shared"
+
+
+def _is_closed(connection: sqlite3.Connection) -> bool:
+    """Return whether a connection has been closed."""
+    try:
+        connection.in_transaction
+    except sqlite3.ProgrammingError:
+        return True
+    return False
+
+
+def _adopted_pool(connection: sqlite3.Connection) -> ConnectionPool | None:
+    """Return the pool that adopted connection, see database_name."""
+    with _pools_lock:
+        pool = _pools.get(f":memory:{id(connection):x}")
+    if pool is None or pool.adopted is not connection:
+        return None
+    return pool
+
+
+def database_name(connection: sqlite3.Connection) -> str:
+    """Return a name under which get_pool reaches connection's database.
+
+    For a database file that is its path. A private in-memory
+    database cannot be opened a second time, so the connection itself
+    is adopted as the only connection of a new pool, registered under
+    a name unique to it. From then on connection_for lends the
+    connection through that pool as well, so it has one user at a
+    time. close_pool(name) closes the connection and forgets the
+    pool. Pools whose connection was closed by its owner are
+    forgotten the next time a connection is adopted.
+    """
+    path = connection.execute("PRAGMA database_list").fetchone()[2]
+    if path:
+        return str(path)
+
+    name = f":memory:{id(connection):x}"
+    with _pools_lock:
+        for key, other in list(_pools.items()):
+            if other.adopted is not connection and other.abandoned():
+                del _pools[key]
+                other.close()
+        pool = _pools.get(name)
+        if pool is None or pool.closed or pool.adopted is not connection:
+            pool = ConnectionPool(name, size=1)
+            pool.adopt(connection)
+            _pools[name] = pool
+    return name
+
+
+@contextmanager
+def connection_for(
+    db: sqlite3.Connection | str,
+) -> Iterator[sqlite3.Connection]:
+    """Yield a connection to db.
+
+    db may be an open connection, which is used as is, or a database
+    path, in which case a connection is borrowed from its pool. A
+    connection that a pool adopted, see database_name, is borrowed
+    from that pool, so that it is never used by two callers at once.
+    """
+    pool = _adopted_pool(db) if isinstance(db, sqlite3.Connection) else None
+    if pool is not None:
+        with pool.connection() as connection:
+            yield connection
+    elif isinstance(db, sqlite3.Connection):
+        traced = instrumentation.trace(db)
+        try:
+            yield db
+        finally:
+            if traced:
+                instrumentation.untrace(db)
+    else:
+        with get_pool(db).connection() as connection:
+            yield connection
+
+
+atexit.register(shutdown)
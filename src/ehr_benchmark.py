@@ -0,0 +1,346 @@
+"""Benchmarks for the ehr_utils parser.
+
+Run ``python src/ehr_benchmark.py --help`` for the options. The suite
+generates synthetic exports at each requested scale, times the
+parser and the model objects on them and writes the results as JSON.
+"""
+import argparse
+import datetime as dt
+import json
+import pathlib
+import platform
+import random
+import tempfile
+import time
+import timeit
+import tracemalloc
+from typing import Any, Callable
+
+from cohort import cohort_ages
+from connection_pool import close_pool, configure_read_only
+from lab_aggregates import aggregate_labs
+from patient_parser_v4 import (
+    cached_date_parser,
+    date_parser,
+    Lab,
+    map_patients,
+    parse_data,
+    Patient,
+    strptime_date_parser,
+)
+from synthetic_ehr import LAB_TESTS, write_synthetic_ehr
+
+# default scales, in lab rows, of the benchmark suite
+DEFAULT_SCALES = [1_000, 10_000, 100_000]
+# number of patients and labs whose properties are read per phase
+DEFAULT_SAMPLE_SIZE = 1_000
+# numbers of threads that benchmark_threads compares
+DEFAULT_THREAD_COUNTS = [1, 2, 4, 8]
+
+
+def synthetic_timestamps(
+    count: int, distinct: int, seed: int = 0
+) -> list[str]:
+    """Return count timestamps drawn from distinct values.
+
+    The strings follow the YYYY-MM-DD hh:mm:ss.mmm layout of the lab
+    exports. Drawing from a limited pool mimics the repeated panel
+    timestamps that make the date cache worthwhile.
+    """
+    rng = random.Random(seed)
+    start = dt.datetime(1990, 1, 1)
+    pool = [
+        (start + dt.timedelta(seconds=rng.uniform(0, 1e9))).strftime(
+            "%Y-%m-%d %H:%M:%S.%f"
+        )[:-3]
+        for _ in range(distinct)
+    ]
+    return [rng.choice(pool) for _ in range(count)]
+
+
+def benchmark_date_parser(
+    count: int = 100_000, distinct: int = 5_000, repeat: int = 3
+) -> dict[str, float]:
+    """Time the date parsers over the same synthetic timestamps.
+
+    Returns the best of repeat runs, in seconds per parsed timestamp,
+    for strptime_date_parser (the previous implementation),
+    date_parser and a fresh cached_date_parser per run.
+    """
+    timestamps = synthetic_timestamps(count, distinct)
+
+    def run(parser: Callable[[str], dt.datetime]) -> None:
+        for timestamp in timestamps:
+            parser(timestamp)
+
+    results = {
+        "strptime_date_parser": min(
+            timeit.repeat(
+                lambda: run(strptime_date_parser), number=1, repeat=repeat
+            )
+        ),
+        "date_parser": min(
+            timeit.repeat(lambda: run(date_parser), number=1, repeat=repeat)
+        ),
+        "cached_date_parser": min(
+            timeit.repeat(
+                lambda: run(cached_date_parser()), number=1, repeat=repeat
+            )
+        ),
+    }
+    return {name: seconds / count for name, seconds in results.items()}
+
+
+def measure(
+    phase: Callable[[], Any], items: int, memory: bool = True
+) -> dict[str, float]:
+    """Time one phase and, optionally, its peak Python memory.
+
+    The phase is run once for its wall time. With memory=True it is
+    run a second time under tracemalloc, whose bookkeeping would
+    otherwise distort the timing. items is the number of rows or
+    objects the phase handles, used for the throughput.
+    """
+    start = time.perf_counter()
+    phase()
+    seconds = time.perf_counter() - start
+    result = {
+        "seconds": seconds,
+        "items": items,
+        "items_per_second": items / seconds if seconds else 0.0,
+    }
+    if memory:
+        tracemalloc.start()
+        phase()
+        result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def _read_lab_properties(labs: list[Lab]) -> None:
+    """Read every property of every lab."""
+    for lab in labs:
+        (lab.patient_id, lab.admission_id, lab.name)
+        (lab.value, lab.unit, lab.date)
+
+
+def _read_patient_properties(patients: list[Patient]) -> None:
+    """Read every demographic property of every patient."""
+    for patient in patients:
+        (patient.gender, patient.dob, patient.race)
+        (patient.marital_status, patient.language, patient.poverty_level)
+        patient.age
+
+
+def _screen(patients: list[Patient], lab_name: str, value: float) -> None:
+    """Run is_sick for every patient, skipping those without the lab."""
+    for patient in patients:
+        try:
+            patient.is_sick(lab_name, ">", value)
+        except ValueError:
+            pass
+
+
+def _first_admissions(patients: list[Patient]) -> None:
+    """Compute age_at_first_admission for every patient."""
+    for patient in patients:
+        patient.age_at_first_admission
+
+
+def benchmark_scale(
+    n_labs: int,
+    seed: int = 0,
+    sample_size: int = DEFAULT_SAMPLE_SIZE,
+    memory: bool = True,
+) -> dict[str, Any]:
+    """Benchmark parse_data and the model objects on n_labs lab rows.
+
+    The property, is_sick and age_at_first_admission phases run on
+    a deterministic sample of sample_size patients (and of as many
+    labs), so that the largest scales finish in reasonable time;
+    their throughput is what matters.
+    """
+    with tempfile.TemporaryDirectory() as dirname:
+        db_name = str(pathlib.Path(dirname) / "EHR.db")
+        start = time.perf_counter()
+        patient_file, lab_file = write_synthetic_ehr(dirname, n_labs, seed)
+        generate_seconds = time.perf_counter() - start
+
+        patient_dict, lab_dict = parse_data(patient_file, lab_file, db=db_name)
+        n_patients = len(patient_dict)
+        phases = {
+            "parse_data": measure(
+                lambda: parse_data(patient_file, lab_file, db=db_name),
+                n_labs + n_patients,
+                memory,
+            ),
+            "parse_data_bulk": measure(
+                lambda: parse_data(
+                    patient_file, lab_file, db=db_name, bulk_load=True
+                ),
+                n_labs + n_patients,
+                memory,
+            ),
+        }
+        patient_dict, lab_dict = parse_data(patient_file, lab_file, db=db_name)
+
+        rng = random.Random(seed)
+        patients = rng.sample(
+            list(patient_dict.values()), min(sample_size, n_patients)
+        )
+        labs = [lab for labs in lab_dict.values() for lab in labs]
+        labs = rng.sample(labs, min(sample_size, len(labs)))
+        lab_name, _, mean, _ = LAB_TESTS[0]
+
+        phases["lab_properties"] = measure(
+            lambda: _read_lab_properties(labs), len(labs), memory
+        )
+        phases["patient_properties"] = measure(
+            lambda: _read_patient_properties(patients),
+            len(patients),
+            memory,
+        )
+        phases["is_sick"] = measure(
+            lambda: _screen(patients, lab_name, mean),
+            len(patients),
+            memory,
+        )
+        phases["age_at_first_admission"] = measure(
+            lambda: _first_admissions(patients), len(patients), memory
+        )
+        phases["cohort_ages"] = measure(
+            lambda: sum(1 for _ in cohort_ages(db_name)), n_patients, memory
+        )
+        phases["aggregate_labs"] = measure(
+            lambda: aggregate_labs(db_name, "Gender").summaries(),
+            n_labs,
+            memory,
+        )
+        # release the pooled connections before the files go away
+        close_pool(db_name)
+
+    return {
+        "n_labs": n_labs,
+        "n_patients": n_patients,
+        "seed": seed,
+        "generate_seconds": generate_seconds,
+        "phases": phases,
+    }
+
+
+def benchmark_threads(
+    n_labs: int,
+    thread_counts: list[int] = DEFAULT_THREAD_COUNTS,
+    seed: int = 0,
+    sample_size: int = DEFAULT_SAMPLE_SIZE,
+) -> list[dict[str, Any]]:
+    """Measure how is_sick throughput scales with the number of threads.
+
+    The sampled patients are screened with map_patients, once per
+    thread count, in read mode (connection_pool.configure_read_only).
+    The speedup is relative to the first thread count. Threads only
+    help as far as SQLite runs without the GIL and there are cores
+    to run it on, so the numbers depend on the machine.
+    """
+    results: list[dict[str, Any]] = []
+    with tempfile.TemporaryDirectory() as dirname:
+        db_name = str(pathlib.Path(dirname) / "EHR.db")
+        patient_file, lab_file = write_synthetic_ehr(dirname, n_labs, seed)
+        patient_dict, _ = parse_data(patient_file, lab_file, db=db_name)
+        patients = random.Random(seed).sample(
+            list(patient_dict.values()), min(sample_size, len(patient_dict))
+        )
+        lab_name, _, mean, _ = LAB_TESTS[0]
+        configure_read_only(db_name)
+
+        def screen(patient: Patient) -> None:
+            _screen([patient], lab_name, mean)
+
+        for workers in thread_counts:
+            start = time.perf_counter()
+            map_patients(screen, patients, workers)
+            seconds = time.perf_counter() - start
+            baseline = results[0]["seconds"] if results else seconds
+            results.append(
+                {
+                    "workers": workers,
+                    "seconds": seconds,
+                    "patients_per_second": len(patients) / seconds,
+                    "speedup": baseline / seconds,
+                }
+            )
+        close_pool(db_name)
+    return results
+
+
+def run_suite(
+    scales: list[int] = DEFAULT_SCALES,
+    seed: int = 0,
+    sample_size: int = DEFAULT_SAMPLE_SIZE,
+    memory: bool = True,
+    thread_counts: list[int] = DEFAULT_THREAD_COUNTS,
+) -> dict[str, Any]:
+    """Run benchmark_scale for every scale and collect the results.
+
+    benchmark_threads runs on the smallest scale.
+    """
+    return {
+        "created": dt.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date_parser": benchmark_date_parser(),
+        "scales": [
+            benchmark_scale(n_labs, seed, sample_size, memory)
+            for n_labs in scales
+        ],
+        "threads": benchmark_threads(
+            min(scales), thread_counts, seed, sample_size
+        ),
+    }
+
+
+def main() -> None:
+    """Run the benchmark suite and write or print the results."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--scales",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SCALES,
+        help="numbers of lab rows to benchmark",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sample-size", type=int, default=DEFAULT_SAMPLE_SIZE)
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="skip the tracemalloc run of every phase",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        default=DEFAULT_THREAD_COUNTS,
+        help="numbers of threads to screen patients with",
+    )
+    parser.add_argument(
+        "--output", help="JSON file for the results, printed if omitted"
+    )
+    args = parser.parse_args()
+
+    results = run_suite(
+        args.scales,
+        args.seed,
+        args.sample_size,
+        not args.no_memory,
+        args.threads,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
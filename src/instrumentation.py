@@ -0,0 +1,269 @@
+"""Opt-in counters and timings for the parser and the model objects.
+
+Nothing is measured until enable() is called, or inside a with
+instrumented() block:
+
+    with instrumented() as stats:
+        patient_dict, lab_dict = parse_data("patients.txt", "labs.txt")
+        patient_dict["1"].age
+    stats.dump("stats.json")
+
+While enabled, the following are recorded in a Stats object:
+
+- counters: SQL statements executed per kind (SELECT, INSERT, ...),
+  connections opened and rows inserted;
+- phases: seconds spent parsing, converting dates, inserting and
+  committing in lab_file_to_dict and patient_file_to_dict;
+- histograms: the latency of every Lab and Patient property read.
+
+When disabled, the only costs left are a None check per ingest call
+and per pooled connection checkout. The property wrappers are
+installed on the classes by enable() and removed again by disable(),
+so property reads run the original code.
+"""
+import collections
+import functools
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+C = TypeVar("C", bound=type)
+
+
+class Histogram:
+    """Latency histogram with power-of-two microsecond buckets.
+
+    A sample of s seconds is counted in the first bucket whose upper
+    bound, 2**i microseconds, is at least s.
+    """
+
+    def __init__(self) -> None:
+        """Initialize an empty histogram."""
+        self.count = 0
+        self.total = 0.0
+        self.minimum = float("inf")
+        self.maximum = 0.0
+        self.buckets: collections.Counter[int] = collections.Counter()
+
+    def record(self, seconds: float) -> None:
+        """Add one sample, O(1)."""
+        self.count += 1
+        self.total += seconds
+        self.minimum = min(self.minimum, seconds)
+        self.maximum = max(self.maximum, seconds)
+        microseconds = max(1, int(seconds * 1e6))
+        self.buckets[1 << (microseconds - 1).bit_length()] += 1
+
+    def as_dict(self) -> dict[str, Any]:
+        """Return the summary and the buckets, keyed by upper bound."""
+        return {
+            "count": self.count,
+            "total_seconds": self.total,
+            "mean_seconds": self.total / self.count if self.count else 0.0,
+            "min_seconds": self.minimum if self.count else 0.0,
+            "max_seconds": self.maximum,
+            "buckets_us": {
+                str(bound): self.buckets[bound]
+                for bound in sorted(self.buckets)
+            },
+        }
+
+
+class Stats:
+    """Counters, phase timings and latency histograms of one session."""
+
+    def __init__(self) -> None:
+        """Initialize empty statistics."""
+        self.counters: collections.Counter[str] = collections.Counter()
+        self.phases: dict[str, float] = collections.defaultdict(float)
+        self.histograms: dict[str, Histogram] = collections.defaultdict(
+            Histogram
+        )
+        self._lock = threading.Lock()
+
+    def count(self, name: str, amount: int = 1) -> None:
+        """Add amount to a counter."""
+        with self._lock:
+            self.counters[name] += amount
+
+    def count_statement(self, sql: str) -> None:
+        """Count one executed SQL statement, by its first keyword."""
+        kind = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ""
+        with self._lock:
+            self.counters["sql_statements"] += 1
+            self.counters[f"sql_statements.{kind}"] += 1
+
+    def add_time(self, phase: str, seconds: float) -> None:
+        """Add seconds to a phase."""
+        with self._lock:
+            self.phases[phase] += seconds
+
+    def record(self, name: str, seconds: float) -> None:
+        """Add one latency sample to a histogram."""
+        with self._lock:
+            self.histograms[name].record(seconds)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time the body of a with block as the phase name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def timed(
+        self, phase: str, function: Callable[..., T]
+    ) -> Callable[..., T]:
+        """Wrap function so that the time spent in it goes to phase."""
+
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> T:
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add_time(phase, time.perf_counter() - start)
+
+        return wrapper
+
+    def timed_iter(self, phase: str, items: Iterable[T]) -> Iterator[T]:
+        """Yield from items, adding the time spent producing them to phase.
+
+        The consumer's own time between items is not counted.
+        """
+        iterator = iter(items)
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield item
+        finally:
+            self.add_time(phase, elapsed)
+
+    def as_dict(self) -> dict[str, Any]:
+        """Return all statistics as JSON-serializable data."""
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "phases_seconds": dict(self.phases),
+                "histograms": {
+                    name: histogram.as_dict()
+                    for name, histogram in self.histograms.items()
+                },
+            }
+
+    def dump(self, path: str) -> None:
+        """Write as_dict() to a JSON file."""
+        with open(path, "w") as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+
+_stats: Stats | None = None
+# ids of the connections whose trace callback counts statements
+_traced: set[int] = set()
+# classes whose properties are timed while enabled
+_instrumented_classes: list[type] = []
+_originals: dict[tuple[type, str], property] = dict()
+
+
+def current() -> Stats | None:
+    """Return the statistics being recorded, or None when disabled."""
+    return _stats
+
+
+def instrument_properties(cls: C) -> C:
+    """Register a class whose property reads enable() should time.
+
+    Meant as a class decorator; the class itself is not changed.
+    """
+    _instrumented_classes.append(cls)
+    return cls
+
+
+def _timed_property(stats: Stats, name: str, prop: property) -> property:
+    """Return a property timing every read of prop into stats."""
+    getter = prop.fget
+    assert getter is not None
+
+    def timed_getter(self: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            return getter(self)
+        finally:
+            stats.record(name, time.perf_counter() - start)
+
+    return property(timed_getter, doc=prop.__doc__)
+
+
+def enable() -> Stats:
+    """Start recording into a new Stats object and return it.
+
+    Enabling again while enabled starts over with fresh statistics.
+    """
+    global _stats
+    disable()
+    _stats = Stats()
+    for cls in _instrumented_classes:
+        for attribute, value in list(vars(cls).items()):
+            if isinstance(value, property):
+                _originals[cls, attribute] = value
+                setattr(
+                    cls,
+                    attribute,
+                    _timed_property(
+                        _stats, f"{cls.__name__}.{attribute}", value
+                    ),
+                )
+    return _stats
+
+
+def disable() -> Stats | None:
+    """Stop recording and return the statistics that were recorded."""
+    global _stats
+    stats, _stats = _stats, None
+    for (cls, attribute), value in _originals.items():
+        setattr(cls, attribute, value)
+    _originals.clear()
+    return stats
+
+
+@contextmanager
+def instrumented() -> Iterator[Stats]:
+    """Record statistics for the duration of a with block."""
+    stats = enable()
+    try:
+        yield stats
+    finally:
+        if _stats is stats:
+            disable()
+
+
+def trace(connection: sqlite3.Connection) -> bool:
+    """Count the statements run on connection, when enabled.
+
+    Called whenever a connection is checked out; untrace undoes it.
+    Returns whether this call started the tracing.
+    """
+    if _stats is None or id(connection) in _traced:
+        return False
+    connection.set_trace_callback(_stats.count_statement)
+    _traced.add(id(connection))
+    return True
+
+
+def untrace(connection: sqlite3.Connection) -> None:
+    """Stop counting the statements run on connection."""
+    if _traced and id(connection) in _traced:
+        _traced.discard(id(connection))
+        connection.set_trace_callback(None)
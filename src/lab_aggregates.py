@@ -0,0 +1,411 @@
+"""Per-lab statistics computed in one streaming pass over LABS.
+
+aggregate_labs reads (lab name, stratum, value) rows from SQLite in
+chunks and folds them into one LabAggregate per lab name, or per lab
+name and Gender or Race. Nothing but the aggregates is kept, so the
+memory used does not grow with the number of labs.
+
+- RunningStats keeps the count, mean, sum of squared deviations
+  (Welford's online algorithm), minimum and maximum. Exact, O(1)
+  memory.
+- QuantileSketch keeps approximate percentiles with a relative-error
+  guarantee (the DDSketch layout): values are counted in buckets
+  whose bounds grow geometrically, so every percentile is returned
+  within relative_accuracy of a value at that rank. The number of
+  buckets grows with the logarithm of the range of the values, not
+  with their number.
+
+Both merge exactly: merging the aggregates of two disjoint sets of
+rows gives the aggregates of their union. A large database can be
+split into patient shards (aggregate_labs(..., patient_ids=shard)),
+aggregated in parallel or on different machines, and combined with
+LabAggregates.merge.
+"""
+import collections
+import json
+import math
+import sqlite3
+from typing import Any, Iterable, NamedTuple, Sequence
+
+import numpy as np
+
+from connection_pool import connection_for
+
+# PATIENTS columns that aggregate_labs can stratify by
+STRATA = ("Gender", "Race")
+# relative error of the percentiles of a QuantileSketch by default
+DEFAULT_RELATIVE_ACCURACY = 0.01
+# percentiles reported by LabAggregates.summaries by default
+DEFAULT_PERCENTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+# rows fetched from SQLite at a time by aggregate_labs
+DEFAULT_CHUNK_ROWS = 10_000
+
+
+class RunningStats:
+    """Count, mean, variance, minimum and maximum of a stream of values.
+
+    add folds in one value with Welford's update, add_many a whole
+    batch, and merge another RunningStats with the pairwise update
+    of Chan et al., all in O(1) memory. NaN values are skipped, as
+    SQL aggregates skip NULL.
+    """
+
+    __slots__ = ("count", "mean", "m2", "minimum", "maximum")
+
+    def __init__(self) -> None:
+        """Start with no values."""
+        self.count = 0
+        self.mean = 0.0
+        # sum of squared deviations from the mean
+        self.m2 = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+
+    def add(self, value: float) -> None:
+        """Fold in one value, O(1)."""
+        if math.isnan(value):
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+    def add_many(self, values: Sequence[float]) -> None:
+        """Fold in a batch of values, O(len(values)) in NumPy."""
+        array = np.asarray(values, dtype=np.float64)
+        array = array[~np.isnan(array)]
+        if not len(array):
+            return
+        batch = RunningStats()
+        batch.count = len(array)
+        batch.mean = float(array.mean())
+        batch.m2 = float(np.square(array - batch.mean).sum())
+        batch.minimum = float(array.min())
+        batch.maximum = float(array.max())
+        self.merge(batch)
+
+    def merge(self, other: "RunningStats") -> None:
+        """Fold in the values summarized by other, O(1)."""
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    @property
+    def variance(self) -> float | None:
+        """Return the sample variance, None for fewer than two values."""
+        if self.count < 2:
+            return None
+        return self.m2 / (self.count - 1)
+
+    @property
+    def std(self) -> float | None:
+        """Return the sample standard deviation, see variance."""
+        variance = self.variance
+        return None if variance is None else math.sqrt(variance)
+
+
+class QuantileSketch:
+    """Mergeable percentile sketch with relative error guarantees.
+
+    A positive value x is counted in bucket ceil(log(x) / log(gamma)),
+    where gamma = (1 + a) / (1 - a) for the relative accuracy a, and
+    a negative value in the bucket of -x on the negative side. Zeros
+    are counted apart. A bucket is reported as the point within a of
+    both of its bounds, so quantile(q) is within a relative error a
+    of the value of rank q. NaN values are skipped, as in
+    RunningStats.
+    """
+
+    def __init__(
+        self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY
+    ) -> None:
+        """Start an empty sketch."""
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("The relative accuracy must be in (0, 1)")
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive: collections.Counter[int] = collections.Counter()
+        self.negative: collections.Counter[int] = collections.Counter()
+        self.zeros = 0
+        self.count = 0
+
+    def _bucket(self, magnitude: float) -> int:
+        """Return the bucket of a positive magnitude, O(1)."""
+        return math.ceil(math.log(magnitude) / self._log_gamma)
+
+    def _value(self, bucket: int) -> float:
+        """Return the magnitude that represents a bucket, O(1)."""
+        return 2 * self.gamma**bucket / (self.gamma + 1)
+
+    def add(self, value: float) -> None:
+        """Count one value, O(1)."""
+        if math.isnan(value):
+            return
+        if value > 0:
+            self.positive[self._bucket(value)] += 1
+        elif value < 0:
+            self.negative[self._bucket(-value)] += 1
+        else:
+            self.zeros += 1
+        self.count += 1
+
+    def add_many(self, values: Sequence[float]) -> None:
+        """Count a batch of values, O(len(values)) in NumPy."""
+        array = np.asarray(values, dtype=np.float64)
+        array = array[~np.isnan(array)]
+        for counter, magnitudes in (
+            (self.positive, array[array > 0]),
+            (self.negative, -array[array < 0]),
+        ):
+            buckets, counts = np.unique(
+                np.ceil(np.log(magnitudes) / self._log_gamma),
+                return_counts=True,
+            )
+            counter.update(
+                dict(zip(buckets.astype(np.int64).tolist(), counts.tolist()))
+            )
+        self.zeros += int(np.count_nonzero(array == 0))
+        self.count += len(array)
+
+    def merge(self, other: "QuantileSketch") -> None:
+        """Count the values counted by other, O(buckets).
+
+        Raises ValueError when the sketches have different accuracies,
+        since their buckets do not line up.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches of different accuracy")
+        self.positive.update(other.positive)
+        self.negative.update(other.negative)
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def quantile(self, q: float) -> float | None:
+        """Return the approximate value of rank q, None when empty.
+
+        q is a fraction in [0, 1]; 0.5 is the median. The buckets are
+        walked from the most negative value up, O(buckets).
+        """
+        if not 0 <= q <= 1:
+            raise ValueError("The quantile must be in [0, 1]")
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for bucket in sorted(self.negative, reverse=True):
+            seen += self.negative[bucket]
+            if seen > rank:
+                return -self._value(bucket)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for bucket in sorted(self.positive):
+            seen += self.positive[bucket]
+            if seen > rank:
+                return self._value(bucket)
+        return None  # not reached: seen ends at count > rank
+
+
+class LabSummary(NamedTuple):
+    """Statistics of one lab, or of one lab in one stratum."""
+
+    lab_name: str
+    stratum: str | None
+    n_values: int
+    mean: float
+    std: float | None
+    minimum: float
+    maximum: float
+    percentiles: dict[float, float]
+
+
+class LabAggregate:
+    """RunningStats and QuantileSketch of the values of one group."""
+
+    def __init__(
+        self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY
+    ) -> None:
+        """Start an empty aggregate."""
+        self.stats = RunningStats()
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def add(self, value: float) -> None:
+        """Fold in one value, O(1)."""
+        self.stats.add(value)
+        self.sketch.add(value)
+
+    def add_many(self, values: Sequence[float]) -> None:
+        """Fold in a batch of values, O(len(values))."""
+        self.stats.add_many(values)
+        self.sketch.add_many(values)
+
+    def merge(self, other: "LabAggregate") -> None:
+        """Fold in the values aggregated by other."""
+        self.stats.merge(other.stats)
+        self.sketch.merge(other.sketch)
+
+    def summary(
+        self,
+        lab_name: str,
+        stratum: str | None = None,
+        percentiles: Iterable[float] = DEFAULT_PERCENTILES,
+    ) -> LabSummary:
+        """Return the statistics, with percentiles clamped to min/max."""
+        stats = self.stats
+        estimates = dict()
+        for q in percentiles:
+            estimate = self.sketch.quantile(q)
+            if estimate is not None:
+                estimates[q] = min(max(estimate, stats.minimum), stats.maximum)
+        return LabSummary(
+            lab_name,
+            stratum,
+            stats.count,
+            stats.mean,
+            stats.std,
+            stats.minimum,
+            stats.maximum,
+            estimates,
+        )
+
+
+class LabAggregates:
+    """LabAggregate per (lab name, stratum), mergeable as a whole.
+
+    The stratum is None when the labs are not stratified, or when a
+    lab's patient is missing from PATIENTS.
+    """
+
+    def __init__(
+        self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY
+    ) -> None:
+        """Start with no groups."""
+        self.relative_accuracy = relative_accuracy
+        self.groups: dict[tuple[str, str | None], LabAggregate] = dict()
+
+    def group(self, lab_name: str, stratum: str | None = None) -> LabAggregate:
+        """Return the aggregate of a group, creating it if needed."""
+        key = (lab_name, stratum)
+        aggregate = self.groups.get(key)
+        if aggregate is None:
+            aggregate = LabAggregate(self.relative_accuracy)
+            self.groups[key] = aggregate
+        return aggregate
+
+    def merge(self, other: "LabAggregates") -> "LabAggregates":
+        """Fold in every group of other and return self.
+
+        Merging the aggregates of disjoint shards gives the aggregates
+        of their union, O(groups x buckets).
+        """
+        for (lab_name, stratum), aggregate in other.groups.items():
+            self.group(lab_name, stratum).merge(aggregate)
+        return self
+
+    def summaries(
+        self, percentiles: Iterable[float] = DEFAULT_PERCENTILES
+    ) -> list[LabSummary]:
+        """Return the summary of every group, by lab name and stratum."""
+        percentiles = list(percentiles)
+        return [
+            self.groups[key].summary(*key, percentiles)
+            for key in sorted(
+                self.groups, key=lambda key: (key[0], key[1] or "")
+            )
+        ]
+
+
+def _labs_query(
+    stratify_by: str | None,
+    latest_only: bool,
+    patient_ids: Iterable[str] | None,
+    parameters: dict[str, Any],
+) -> str:
+    """Return the SQL selecting (NameID, stratum, Value) rows."""
+    where = "WHERE Value IS NOT NULL"
+    if patient_ids is not None:
+        parameters["patient_ids"] = json.dumps(list(patient_ids))
+        where += """
+            AND PatientID IN (SELECT value FROM json_each(:patient_ids))"""
+    if latest_only:
+        # the latest result per patient and lab, picked as in is_sick
+        source = f"""(
+            SELECT
+                PatientID,
+                NameID,
+                Value,
+                ROW_NUMBER() OVER (
+                    PARTITION BY PatientID, NameID
+                    ORDER BY Date DESC, Autogen_id ASC
+                ) AS recency
+            FROM LAB_RESULTS
+            {where}
+        ) AS labs"""
+        where = "WHERE labs.recency = 1"
+    else:
+        source = "LAB_RESULTS AS labs"
+    if stratify_by is None:
+        return f"SELECT labs.NameID, NULL, labs.Value FROM {source} {where}"
+    return f"""
+        SELECT labs.NameID, PATIENTS.{stratify_by}, labs.Value
+        FROM {source}
+        LEFT JOIN PATIENTS ON PATIENTS.ID = labs.PatientID
+        {where}
+        """
+
+
+def aggregate_labs(
+    db: sqlite3.Connection | str,
+    stratify_by: str | None = None,
+    latest_only: bool = False,
+    patient_ids: Iterable[str] | None = None,
+    relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+) -> LabAggregates:
+    """Aggregate the lab values per lab name in one pass over LABS.
+
+    stratify_by is None or one of STRATA, the PATIENTS column whose
+    value splits every lab into strata. With latest_only=True only
+    the latest result of every patient and lab counts, picked as in
+    Patient.is_sick (a tie goes to the result ingested first). With
+    patient_ids only the labs of those patients count, which is how
+    a database is split into shards whose aggregates are merged.
+
+    The rows are fetched chunk_rows at a time, grouped in Python and
+    folded into the aggregates batch by batch, O(K) time in all, and
+    memory bounded by the chunk and the aggregates.
+    """
+    if stratify_by is not None and stratify_by not in STRATA:
+        raise ValueError(
+            f"Unsupported stratum {stratify_by!r}, expected one of "
+            f"{', '.join(STRATA)}"
+        )
+    parameters: dict[str, Any] = dict()
+    query = _labs_query(stratify_by, latest_only, patient_ids, parameters)
+
+    aggregates = LabAggregates(relative_accuracy)
+    with connection_for(db) as connection:
+        names = dict(connection.execute("SELECT ID, Name FROM LAB_NAMES"))
+        cursor = connection.execute(query, parameters)
+        while rows := cursor.fetchmany(chunk_rows):  # O(K) over all chunks
+            batches: dict[tuple[int, str | None], list[float]] = dict()
+            for name_id, stratum, value in rows:
+                key = (name_id, None if stratum is None else str(stratum))
+                batch = batches.get(key)
+                if batch is None:
+                    batches[key] = [value]
+                else:
+                    batch.append(value)
+            for (name_id, stratum), values in batches.items():
+                aggregates.group(names[name_id], stratum).add_many(values)
+        cursor.close()
+    return aggregates
@@ -0,0 +1,258 @@
+"""Columnar, NumPy-backed, in-memory copy of the lab results.
+
+A LabTable keeps one array per column instead of one Lab object per
+row. Patient IDs, lab names and units are dictionary-encoded as
+integer codes, and the rows are sorted by patient, so the labs of a
+patient are one contiguous slice. Analytics such as "latest value
+per patient" then run as a handful of vectorized NumPy operations
+and never touch the database.
+"""
+import datetime as dt
+import sqlite3
+from typing import Any, Iterable
+
+import numpy as np
+import numpy.typing as npt
+
+from cohort import check_operator
+from connection_pool import connection_for
+from patient_parser_v4 import (
+    LAB_FIELDS,
+    lab_fields_row,
+    Patient,
+    stored_date,
+)
+from tsv_reader import iter_rows
+
+
+def _encode(value: str, codes: dict[str, int]) -> int:
+    """Return the code of value, assigning the next free one if new."""
+    code = codes.get(value)
+    if code is None:
+        code = codes[value] = len(codes)
+    return code
+
+
+class LabTable:
+    """Lab results stored as NumPy columns, grouped by patient.
+
+    Row i of the table is described by the i-th entry of every column
+    array. The rows of the patient with code p are
+    offsets[p]:offsets[p + 1], in Autogen_id order.
+    """
+
+    def __init__(self, rows: Iterable[tuple[Any, ...]]) -> None:
+        """Build the table from LABS rows.
+
+        Every row is (PatientID, AdmissionID, Name, Value, Unit, Date,
+        Autogen_id), the column order of the LABS table. Date may be a
+        datetime, a string accepted by date_parser or integer
+        microseconds since the epoch, which are taken as they are.
+
+        Encoding the rows is O(K); sorting them by patient is
+        O(K log K).
+        """
+        self.patient_codes: dict[str, int] = dict()
+        self.name_codes: dict[str, int] = dict()
+        self.unit_codes: dict[str, int] = dict()
+
+        patients, admissions, names, values = [], [], [], []
+        units, dates, autogen_ids = [], [], []
+        for row in rows:  # O(K)
+            patients.append(_encode(str(row[0]), self.patient_codes))
+            admissions.append(int(row[1]))
+            names.append(_encode(str(row[2]), self.name_codes))
+            values.append(float(row[3]))
+            units.append(_encode(str(row[4]), self.unit_codes))
+            date = row[5]
+            dates.append(date if isinstance(date, int) else stored_date(date))
+            autogen_ids.append(int(row[6]))
+
+        patient_column = np.array(patients, dtype=np.int32)
+        autogen_column = np.array(autogen_ids, dtype=np.int64)
+        order = np.lexsort((autogen_column, patient_column))  # O(K log K)
+
+        self.patient: npt.NDArray[np.int32] = patient_column[order]
+        self.autogen_id: npt.NDArray[np.int64] = autogen_column[order]
+        self.admission_id: npt.NDArray[np.int64] = np.array(
+            admissions, dtype=np.int64
+        )[order]
+        self.name: npt.NDArray[np.int32] = np.array(names, dtype=np.int32)[
+            order
+        ]
+        self.value: npt.NDArray[np.float64] = np.array(
+            values, dtype=np.float64
+        )[order]
+        self.unit: npt.NDArray[np.int32] = np.array(units, dtype=np.int32)[
+            order
+        ]
+        self.date: npt.NDArray[np.datetime64] = np.array(
+            dates, dtype="datetime64[us]"
+        )[order]
+        self.offsets: npt.NDArray[np.int64] = np.searchsorted(
+            self.patient, np.arange(len(self.patient_codes) + 1)
+        ).astype(np.int64)
+
+        # decoding tables, indexed by code
+        self.patient_ids = list(self.patient_codes)
+        self.names = list(self.name_codes)
+        self.units = list(self.unit_codes)
+
+    @classmethod
+    def from_file(cls, txt_file: str) -> "LabTable":
+        """Parse a lab file straight into a table, O(K x L)."""
+        return cls(
+            (*lab_fields_row(fields), generative_id)
+            for generative_id, fields in enumerate(
+                iter_rows(txt_file, LAB_FIELDS), start=1
+            )
+        )
+
+    @classmethod
+    def from_db(cls, db: sqlite3.Connection | str) -> "LabTable":
+        """Load the LABS table of a database, O(K log K)."""
+        with connection_for(db) as connection:
+            cursor = connection.execute(
+                """
+                SELECT PatientID, AdmissionID, Name, Value, Unit, Date,
+                    Autogen_id
+                FROM LABS
+                """
+            )
+            table = cls(cursor)
+            cursor.close()
+        return table
+
+    def __len__(self) -> int:
+        """Return the number of lab rows."""
+        return len(self.patient)
+
+    def rows_for(self, patient_id: str) -> slice:
+        """Return the slice of rows belonging to a patient, O(1).
+
+        A patient without labs gets an empty slice.
+        """
+        code = self.patient_codes.get(patient_id)
+        if code is None:
+            return slice(0, 0)
+        return slice(int(self.offsets[code]), int(self.offsets[code + 1]))
+
+    def mask(
+        self,
+        lab_name: str | None = None,
+        min_value: float | None = None,
+        max_value: float | None = None,
+        start: dt.datetime | None = None,
+        end: dt.datetime | None = None,
+    ) -> npt.NDArray[np.bool_]:
+        """Return a boolean row mask combining the given filters.
+
+        Values are compared inclusively against min_value and
+        max_value, and dates against the half-open window
+        [start, end). Each filter is one vectorized pass, O(K).
+        """
+        selected = np.ones(len(self), dtype=np.bool_)
+        if lab_name is not None:
+            code = self.name_codes.get(lab_name, -1)
+            selected &= self.name == code
+        if min_value is not None:
+            selected &= self.value >= min_value
+        if max_value is not None:
+            selected &= self.value <= max_value
+        if start is not None:
+            selected &= self.date >= np.datetime64(start, "us")
+        if end is not None:
+            selected &= self.date < np.datetime64(end, "us")
+        return selected
+
+    def latest(self, lab_name: str) -> npt.NDArray[np.int64]:
+        """Return the row of each patient's latest lab_name result.
+
+        There is one row per patient that has the lab, in patient
+        code order. As in Patient.is_sick, a tie on the latest date
+        goes to the lab that was ingested first.
+
+        Sorting the matching rows is O(K log K).
+        """
+        rows = np.flatnonzero(self.mask(lab_name))
+        order = np.lexsort(
+            (
+                self.autogen_id[rows],
+                -self.date[rows].astype(np.int64),
+                self.patient[rows],
+            )
+        )
+        rows = rows[order]
+        _, first = np.unique(self.patient[rows], return_index=True)
+        return rows[first].astype(np.int64)
+
+    def latest_values(self, lab_name: str) -> dict[str, float]:
+        """Return each patient's latest lab_name value by patient ID."""
+        rows = self.latest(lab_name)
+        return {
+            self.patient_ids[patient]: float(value)
+            for patient, value in zip(self.patient[rows], self.value[rows])
+        }
+
+    def cohort_is_sick(
+        self,
+        lab_name: str,
+        operator: str,
+        value: float,
+        patient_ids: Iterable[str] | None = None,
+    ) -> dict[str, bool | None]:
+        """Evaluate is_sick for many patients, like cohort.cohort_is_sick.
+
+        Patients without the lab are mapped to None. Without
+        patient_ids, the cohort is every patient that has any lab.
+        """
+        check_operator(operator)
+        rows = self.latest(lab_name)
+        latest = self.value[rows]
+        sick = latest > value if operator == ">" else latest < value
+        found = {
+            self.patient_ids[patient]: bool(result)
+            for patient, result in zip(self.patient[rows], sick)
+        }
+        if patient_ids is None:
+            patient_ids = self.patient_ids
+        return {
+            patient_id: found.get(patient_id) for patient_id in patient_ids
+        }
+
+    def is_sick(
+        self, patient_id: str, lab_name: str, operator: str, value: float
+    ) -> bool:
+        """Return Patient.is_sick for one patient, O(labs of patient).
+
+        Raises ValueError when the patient has no lab named lab_name.
+        """
+        check_operator(operator)
+        rows = self.rows_for(patient_id)
+        code = self.name_codes.get(lab_name, -1)
+        matches = np.flatnonzero(self.name[rows] == code) + rows.start
+        if len(matches) == 0:
+            raise ValueError(
+                "Lab not found. It may not exist, or you may have mistyped it"
+            )
+        # argmax returns the first, i.e. earliest ingested, latest date
+        latest = matches[np.argmax(self.date[matches])]
+        if operator == ">":
+            return bool(self.value[latest] > value)
+        return bool(self.value[latest] < value)
+
+    def first_admission(self, patient_id: str) -> dt.datetime:
+        """Return the date of a patient's earliest lab.
+
+        Raises ValueError when the patient has no labs.
+        """
+        rows = self.rows_for(patient_id)
+        if rows.start == rows.stop:
+            raise ValueError(f"Patient {patient_id!r} has no labs")
+        earliest: dt.datetime = self.date[rows].min().astype(dt.datetime)
+        return earliest
+
+    def attach(self, patients: Iterable[Patient]) -> None:
+        """Make Patient.is_sick and age_at_first_admission use this table."""
+        for patient in patients:
+            patient.lab_table = self
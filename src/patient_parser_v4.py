@@ -1,6 +1,41 @@
 """Python file to parse patient's data and lab results."""
+import collections
 import datetime as dt
+import functools
+import hashlib
+import itertools
+import os
 import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from typing import (
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    Mapping,
+    NamedTuple,
+    TYPE_CHECKING,
+    TypeVar,
+)
+
+import async_loader
+import instrumentation
+from connection_pool import (
+    connection_for,
+    database_name,
+    get_pool,
+    refresh_pool,
+)
+from tsv_reader import iter_rows
+
+if TYPE_CHECKING:
+    from lab_series import LabSeries
+    from lab_table import LabTable
+
+T = TypeVar("T")
 
 """
 The objective of the functions here is to parse patient's data and lab results.
@@ -23,10 +58,11 @@ These details will be considered in the time complexity analysis.
 """
 
 
-def date_parser(date: str) -> dt.datetime:
-    """Convert string to datetime object.
+def strptime_date_parser(date: str) -> dt.datetime:
+    """Convert string to datetime object with datetime.strptime().
 
-    Assumes it always has the format: YYYY-MM-DD hh:mm:ss.[mmm]
+    This is the general parser that date_parser falls back to for
+    strings that do not follow the fixed-width layout.
 
     The function takes a string and executes a strip() method on it.
     This method has a time complexity of O(1), because the length
@@ -47,187 +83,548 @@ def date_parser(date: str) -> dt.datetime:
     return dt.datetime.strptime(date, "%Y-%m-%d %H:%M:%S.%f")  # O(1)
 
 
+def date_parser(date: str) -> dt.datetime:
+    """Convert string to datetime object.
+
+    Assumes it always has the format: YYYY-MM-DD hh:mm:ss.[mmm]
+
+    Because the layout is fixed, the separators sit at known offsets
+    and are checked by indexing the string. A string that passes the
+    check is handed to datetime.fromisoformat(), which is implemented
+    in C and many times faster than datetime.strptime(). The fraction
+    may be missing altogether, which is how SQLite stores datetimes
+    whose microseconds are zero.
+
+    Strings that do not match the layout exactly, or that
+    fromisoformat() rejects, are handed to strptime_date_parser, so
+    irregular input is still parsed (or rejected) the same way as
+    before.
+
+    Checking a fixed number of offsets and parsing a string of
+    bounded length are both O(1).
+    """
+    date = date.strip()  # O(1)
+    length = len(date)  # O(1)
+
+    if (
+        (length == 19 or 21 <= length <= 26)
+        and date[4] == "-"
+        and date[7] == "-"
+        and date[10] == " "
+        and date[13] == ":"
+        and date[16] == ":"
+        and (length == 19 or (date[19] == "." and date[20:].isdigit()))
+    ):  # O(1)
+        try:
+            return dt.datetime.fromisoformat(date)  # O(1)
+        except ValueError:
+            # e.g. fractions other than 3 or 6 digits before Python 3.11
+            pass
+
+    return strptime_date_parser(date)  # O(1)
+
+
+# default number of distinct timestamps kept by cached_date_parser
+DATE_CACHE_SIZE = 4096
+
+
+# Dates are stored as the text of str(datetime) by default, or, with
+# parse_data(..., epoch_timestamps=True), as integer microseconds
+# since EPOCH, which SQLite compares, sorts and aggregates as plain
+# integers. Datetimes are naive, so EPOCH is too.
+EPOCH = dt.datetime(1970, 1, 1)
+MICROSECOND = dt.timedelta(microseconds=1)
+
+
+def to_epoch(date: dt.datetime) -> int:
+    """Return a datetime as integer microseconds since EPOCH, O(1)."""
+    return (date - EPOCH) // MICROSECOND
+
+
+def from_epoch(micros: int) -> dt.datetime:
+    """Return the datetime of integer microseconds since EPOCH, O(1)."""
+    return EPOCH + dt.timedelta(microseconds=micros)
+
+
+def epoch_date_parser(date: str) -> int:
+    """Convert a string accepted by date_parser to epoch microseconds."""
+    return to_epoch(date_parser(date))  # O(1)
+
+
+def stored_date(value: dt.datetime | str | int) -> dt.datetime:
+    """Convert a date read from the database to a datetime, O(1).
+
+    Integers are epoch microseconds and text is parsed by
+    date_parser. A datetime, as in a row that was not written yet,
+    is returned as it is.
+    """
+    if isinstance(value, dt.datetime):
+        return value
+    if isinstance(value, int):
+        return from_epoch(value)
+    return date_parser(value)
+
+
+def stored_epoch(value: dt.datetime | str | int) -> int:
+    """Convert a date read from the database to epoch microseconds, O(1).
+
+    Integers are returned as they are, so nothing is parsed when the
+    database stores epoch timestamps.
+    """
+    if isinstance(value, int):
+        return value
+    return to_epoch(stored_date(value))
+
+
+def cached_date_parser(
+    maxsize: int = DATE_CACHE_SIZE, epoch_timestamps: bool = False
+) -> Callable[[str], Any]:
+    """Return date_parser memoized with an LRU cache of maxsize entries.
+
+    Lab exports repeat the same timestamp for every test drawn in one
+    panel, so a small cache answers many lookups without parsing.
+    datetime objects are immutable, which makes sharing them safe.
+
+    With epoch_timestamps=True epoch_date_parser is memoized instead.
+    """
+    parser = epoch_date_parser if epoch_timestamps else date_parser
+    return functools.lru_cache(maxsize=maxsize)(parser)
+
+
+def _date_parser(
+    date_cache_size: int, epoch_timestamps: bool
+) -> Callable[[str], Any]:
+    """Return the date parser of an ingest, cached unless the size is 0."""
+    if date_cache_size:
+        return cached_date_parser(date_cache_size, epoch_timestamps)
+    return epoch_date_parser if epoch_timestamps else date_parser
+
+
+class LabRecord:
+    """In-memory copy of one row of the LABS table.
+
+    Used by hydrated Lab objects. The class uses __slots__ so that
+    millions of cached rows stay compact.
+
+    The date is kept as stored, text or epoch microseconds, and only
+    converted when the date or timestamp property asks for it.
+    """
+
+    __slots__ = (
+        "patient_id",
+        "admission_id",
+        "name",
+        "value",
+        "unit",
+        "stored_date",
+        "_date",
+        "_timestamp",
+    )
+
+    def __init__(
+        self,
+        patient_id: str,
+        admission_id: int,
+        name: str,
+        value: float,
+        unit: str,
+        date: dt.datetime | str | int,
+    ) -> None:
+        """Initialize lab record."""
+        self.patient_id = patient_id
+        self.admission_id = admission_id
+        self.name = name
+        self.value = value
+        self.unit = unit
+        self.stored_date = date
+        self._date: dt.datetime | None = None
+        self._timestamp: int | None = None
+
+    @property
+    def date(self) -> dt.datetime:
+        """Return the lab date, converting it on first access."""
+        if self._date is None:
+            self._date = stored_date(self.stored_date)
+        return self._date
+
+    @property
+    def timestamp(self) -> int:
+        """Return the lab date as epoch microseconds.
+
+        No conversion is needed when the date is stored as one;
+        otherwise it is converted on first access.
+        """
+        if isinstance(self.stored_date, int):
+            return self.stored_date
+        if self._timestamp is None:
+            self._timestamp = to_epoch(self.date)
+        return self._timestamp
+
+    @classmethod
+    def from_row(cls, row: tuple[Any, ...]) -> "LabRecord":
+        """Build a record from a row selected with LAB_COLUMNS."""
+        return cls(
+            str(row[0]),
+            int(row[1]),
+            str(row[2]),
+            float(row[3]),
+            str(row[4]),
+            row[5],
+        )
+
+
+class PatientRecord:
+    """In-memory copy of one row of the PATIENTS table.
+
+    Used by hydrated Patient objects, see LabRecord.
+    """
+
+    __slots__ = (
+        "gender",
+        "dob",
+        "race",
+        "marital_status",
+        "language",
+        "poverty_level",
+    )
+
+    def __init__(
+        self,
+        gender: str,
+        dob: dt.datetime,
+        race: str,
+        marital_status: str,
+        language: str,
+        poverty_level: str,
+    ) -> None:
+        """Initialize patient record."""
+        self.gender = gender
+        self.dob = dob
+        self.race = race
+        self.marital_status = marital_status
+        self.language = language
+        self.poverty_level = poverty_level
+
+    @classmethod
+    def from_row(cls, row: tuple[Any, ...]) -> "PatientRecord":
+        """Build a record from a row selected with PATIENT_COLUMNS."""
+        return cls(
+            str(row[0]),
+            stored_date(row[1]),
+            str(row[2]),
+            str(row[3]),
+            str(row[4]),
+            str(row[5]),
+        )
+
+
+# column lists matching the field order of LabRecord and PatientRecord
+LAB_COLUMNS = "PatientID, AdmissionID, Name, Value, Unit, Date"
+PATIENT_COLUMNS = (
+    "Gender, DateOfBirth, Race, MaritalStatus, Language, PovertyLevel"
+)
+
+
+@instrumentation.instrument_properties
 class Lab:
-    """Class to represent lab results."""
+    """Class to represent lab results.
+
+    By default every property queries the database. A hydrated lab
+    instead loads its whole row with one query on first access and
+    answers later reads from memory until refresh() is called.
+    """
 
     def __init__(
         self,
         Autogen_id: int = 0,
         db_name: str = "",
+        hydrated: bool = False,
     ) -> None:
         """Initialize lab object."""
         self.Autogen_id: int = Autogen_id
         self.db_name: str = db_name
+        self.hydrated: bool = hydrated
+        self._record: LabRecord | None = None
+
+    def _fetch(self, columns: str) -> tuple[Any, ...]:
+        """Return the given columns of this lab's row in the LABS table.
+
+        The query runs on a pooled connection, so no connection is
+        opened or closed per property access.
+        """
+        with get_pool(self.db_name).connection() as connection:
+            cursor = connection.execute(
+                f"SELECT {columns} FROM LABS WHERE Autogen_id = ?",
+                (self.Autogen_id,),
+            )
+            data: tuple[Any, ...] = cursor.fetchone()
+            cursor.close()
+        return data
+
+    def _select(self, column: str) -> Any:
+        """Return a single column of this lab's row."""
+        return self._fetch(column)[0]
+
+    def refresh(self) -> LabRecord:
+        """Re-read this lab's whole row and cache it."""
+        self._record = LabRecord.from_row(self._fetch(LAB_COLUMNS))
+        return self._record
+
+    def _load(self) -> LabRecord:
+        """Return the cached row, loading it on first use."""
+        if self._record is None:
+            return self.refresh()
+        return self._record
+
+    async def aload(self) -> LabRecord:
+        """Load this lab's row without blocking the event loop.
+
+        The query runs in an async_loader worker thread, batched with
+        the other labs loaded in the same event loop iteration. The
+        lab is switched to hydrated mode, so its properties answer
+        from the loaded row afterwards.
+
+        Raises KeyError when the row does not exist.
+        """
+        rows = await async_loader.loader(
+            self.db_name, "LABS", "Autogen_id", LAB_COLUMNS, "Autogen_id"
+        ).load(self.Autogen_id)
+        if not rows:
+            raise KeyError(self.Autogen_id)
+        self._record = LabRecord.from_row(rows[0][1:])
+        self.hydrated = True
+        return self._record
 
     @property
     def patient_id(self) -> str:
         """Return patient ID."""
-        connection = sqlite3.connect(self.db_name)
-        cursor = connection.cursor()
-        cursor.execute(
-            "SELECT PatientID FROM LABS WHERE Autogen_id = ?",
-            (self.Autogen_id,),
-        )
-        data = cursor.fetchone()
-        connection.close()
-        return str(data[0])
+        if self.hydrated:
+            return self._load().patient_id
+        return str(self._select("PatientID"))
 
     @property
     def admission_id(self) -> int:
         """Return admission ID."""
-        connection = sqlite3.connect(self.db_name)
-        cursor = connection.cursor()
-        cursor.execute(
-            "SELECT AdmissionID FROM LABS WHERE Autogen_id = ?",
-            (self.Autogen_id,),
-        )
-        data = cursor.fetchone()
-        connection.close()
-        return int(data[0])
+        if self.hydrated:
+            return self._load().admission_id
+        return int(self._select("AdmissionID"))
 
     @property
     def name(self) -> str:
         """Return lab name."""
-        connection = sqlite3.connect(self.db_name)
-        cursor = connection.cursor()
-        cursor.execute(
-            """
-        SELECT Name FROM LABS WHERE Autogen_id = ?""",
-            (self.Autogen_id,),
-        )
-        data = cursor.fetchone()
-        connection.close()
-        return str(data[0])
+        if self.hydrated:
+            return self._load().name
+        return str(self._select("Name"))
 
     @property
     def value(self) -> float:
         """Return lab value."""
-        connection = sqlite3.connect(self.db_name)
-        cursor = connection.cursor()
-        cursor.execute(
-            "SELECT Value FROM LABS WHERE Autogen_id = ?", (self.Autogen_id,)
-        )
-        data = cursor.fetchone()
-        connection.close()
-        return float(data[0])
+        if self.hydrated:
+            return self._load().value
+        return float(self._select("Value"))
 
     @property
     def unit(self) -> str:
         """Return lab unit."""
-        connection = sqlite3.connect(self.db_name)
-        cursor = connection.cursor()
-        cursor.execute(
-            """
-        SELECT Unit FROM LABS WHERE Autogen_id = ?""",
-            (self.Autogen_id,),
-        )
-        data = cursor.fetchone()
-        connection.close()
-        return str(data[0])
+        if self.hydrated:
+            return self._load().unit
+        return str(self._select("Unit"))
 
     @property
     def date(self) -> dt.datetime:
         """Return lab date."""
-        connection = sqlite3.connect(self.db_name)
-        cursor = connection.cursor()
-        cursor.execute(
-            """SELECT Date FROM LABS WHERE Autogen_id = ?""",
-            (self.Autogen_id,),
-        )
-        data = cursor.fetchone()
-        connection.close()
-        return date_parser(data[0])
+        if self.hydrated:
+            return self._load().date
+        return stored_date(self._select("Date"))
+
+    @property
+    def timestamp(self) -> int:
+        """Return lab date as integer microseconds since EPOCH.
+
+        Comparing timestamps needs no datetime objects, and with
+        epoch_timestamps storage no conversion at all.
+        """
+        if self.hydrated:
+            return self._load().timestamp
+        return stored_epoch(self._select("Date"))
 
 
+@instrumentation.instrument_properties
 class Patient:
-    """Patient class to store patient information."""
+    """Patient class to store patient information.
+
+    Like Lab, a hydrated patient loads its whole row on first access
+    and keeps it in memory until refresh() is called.
+
+    Patients can be read from several threads, see map_patients. No
+    two Patient objects share mutable state; a patient built without
+    lab_results gets a list of its own.
+
+    When a LabTable is attached, is_sick and age_at_first_admission
+    read the labs from the table instead of the database. Likewise,
+    lab_value_at and lab_values_between use an attached LabSeries.
+    """
 
     def __init__(
         self,
         patient_id: str = "",
         db_name: str = "",
-        lab_results: list[Lab] = [],
+        lab_results: list[Lab] | None = None,
+        hydrated: bool = False,
     ) -> None:
         """Initialize patient object."""
         self.id = patient_id
         self.db_name = db_name
-        self.labs = lab_results
+        self.labs = [] if lab_results is None else lab_results
+        self.hydrated = hydrated
+        self._record: PatientRecord | None = None
+        # set by LabTable.attach to answer lab questions from memory
+        self.lab_table: LabTable | None = None
+        # set by LabSeries.attach to answer point-in-time lookups
+        self.lab_series: LabSeries | None = None
+
+    def _fetch(self, columns: str) -> tuple[Any, ...]:
+        """Return the given columns of this patient's PATIENTS row.
+
+        The query runs on a pooled connection, so no connection is
+        opened or closed per property access.
+        """
+        with get_pool(self.db_name).connection() as connection:
+            cursor = connection.execute(
+                f"SELECT {columns} FROM PATIENTS WHERE ID = ?", (self.id,)
+            )
+            data: tuple[Any, ...] = cursor.fetchone()
+            cursor.close()
+        return data
+
+    def _select(self, column: str) -> Any:
+        """Return a single column of this patient's row."""
+        return self._fetch(column)[0]
+
+    def refresh(self) -> PatientRecord:
+        """Re-read this patient's whole row and cache it."""
+        self._record = PatientRecord.from_row(self._fetch(PATIENT_COLUMNS))
+        return self._record
+
+    def _load(self) -> PatientRecord:
+        """Return the cached row, loading it on first use."""
+        if self._record is None:
+            return self.refresh()
+        return self._record
+
+    async def aload(self) -> PatientRecord:
+        """Load this patient's row without blocking the event loop.
+
+        As Lab.aload, batched with the concurrent loads of other
+        patients, and switching the patient to hydrated mode.
+        """
+        rows = await async_loader.loader(
+            self.db_name, "PATIENTS", "ID", PATIENT_COLUMNS, "rowid"
+        ).load(self.id)
+        if not rows:
+            raise KeyError(self.id)
+        self._record = PatientRecord.from_row(rows[0][1:])
+        self.hydrated = True
+        return self._record
+
+    async def ahydrate_labs(self) -> None:
+        """Do what hydrate_labs does, without blocking the event loop.
+
+        The labs of all patients hydrated in the same event loop
+        iteration are selected with one query.
+        """
+        rows = await async_loader.loader(
+            self.db_name,
+            "LABS",
+            "PatientID",
+            f"Autogen_id, {LAB_COLUMNS}",
+            "Autogen_id",
+        ).load(self.id)
+        records = {row[1]: LabRecord.from_row(row[2:]) for row in rows}
+        for lab in self.labs:
+            lab.hydrated = True
+            lab._record = records.get(lab.Autogen_id)
+
+    async def ais_sick(
+        self, lab_name: str, operator: str, value: float
+    ) -> bool:
+        """Return is_sick without blocking the event loop.
+
+        The labs are hydrated with ahydrate_labs, after which is_sick
+        runs from memory, so the answer is the same as is_sick's.
+        With an attached LabTable no query is needed at all.
+        """
+        if self.lab_table is None:
+            await self.ahydrate_labs()
+        return self.is_sick(lab_name, operator, value)
+
+    def hydrate_labs(self) -> None:
+        """Load the rows of every lab in self.labs with a single query.
+
+        All of the patient's rows are selected at once by PatientID
+        and matched to the Lab objects by Autogen_id. Every lab is
+        switched to hydrated mode, so its properties no longer query
+        the database.
+        """
+        with get_pool(self.db_name).connection() as connection:
+            cursor = connection.execute(
+                f"""
+                SELECT Autogen_id, {LAB_COLUMNS} FROM LABS
+                WHERE PatientID = ?
+                """,
+                (self.id,),
+            )
+            records = {
+                row[0]: LabRecord.from_row(row[1:])
+                for row in cursor.fetchall()
+            }
+            cursor.close()
+
+        for lab in self.labs:
+            lab.hydrated = True
+            lab._record = records.get(lab.Autogen_id)
 
     @property
     def gender(self) -> str:
         """Return the gender of the patient."""
-        connection = sqlite3.connect(self.db_name)
-        cursor = connection.cursor()
-        cursor.execute("SELECT Gender FROM PATIENTS WHERE ID = ?", (self.id,))
-        data = cursor.fetchone()
-        connection.close()
-        return str(data[0])
+        if self.hydrated:
+            return self._load().gender
+        return str(self._select("Gender"))
 
     @property
     def dob(self) -> dt.datetime:
         """Return the date of birth of the patient."""
-        connection = sqlite3.connect(self.db_name)
-        cursor = connection.cursor()
-        cursor.execute(
-            """
-        SELECT DateOfBirth FROM PATIENTS WHERE ID = ?""",
-            (self.id,),
-        )
-        data = cursor.fetchone()
-        connection.close()
-        return date_parser(data[0])
+        if self.hydrated:
+            return self._load().dob
+        return stored_date(self._select("DateOfBirth"))
 
     @property
     def race(self) -> str:
         """Return the race of the patient."""
-        connection = sqlite3.connect(self.db_name)
-        cursor = connection.cursor()
-        cursor.execute("SELECT Race FROM PATIENTS WHERE ID = ?", (self.id,))
-        data = cursor.fetchone()
-        connection.close()
-        return str(data[0])
+        if self.hydrated:
+            return self._load().race
+        return str(self._select("Race"))
 
     @property
     def marital_status(self) -> str:
         """Return the marital status of the patient."""
-        connection = sqlite3.connect(self.db_name)
-        cursor = connection.cursor()
-        cursor.execute(
-            """
-        SELECT MaritalStatus FROM PATIENTS WHERE ID = ?""",
-            (self.id,),
-        )
-        data = cursor.fetchone()
-        connection.close()
-        return str(data[0])
+        if self.hydrated:
+            return self._load().marital_status
+        return str(self._select("MaritalStatus"))
 
     @property
     def language(self) -> str:
         """Return the language of the patient."""
-        connection = sqlite3.connect(self.db_name)
-        cursor = connection.cursor()
-        cursor.execute(
-            """
-        SELECT Language FROM PATIENTS WHERE ID = ?""",
-            (self.id,),
-        )
-        data = cursor.fetchone()
-        connection.close()
-        return str(data[0])
+        if self.hydrated:
+            return self._load().language
+        return str(self._select("Language"))
 
     @property
     def poverty_level(self) -> str:
         """Return the poverty level of the patient."""
-        connection = sqlite3.connect(self.db_name)
-        cursor = connection.cursor()
-        cursor.execute(
-            """
-        SELECT PovertyLevel FROM PATIENTS WHERE ID = ?""",
-            (self.id,),
-        )
-        data = cursor.fetchone()
-        connection.close()
-        return str(data[0])
+        if self.hydrated:
+            return self._load().poverty_level
+        return str(self._select("PovertyLevel"))
 
     @property
     def age(self) -> int:
@@ -310,7 +707,18 @@ class Patient:
         return statements are 2 * O(1) = O(1).
 
         This simplifies to an overall time complexity of O(K).
+
+        With an attached LabTable the same answer is computed from the
+        patient's slice of the table, without any database queries.
+
+        The dates are compared as Lab.timestamp integers, which the
+        database stores directly with epoch_timestamps=True.
         """
+        if self.lab_table is not None:  # O(1)
+            return self.lab_table.is_sick(
+                self.id, lab_name, operator, value
+            )  # O(K)
+
         lab_records = self.labs  # O(1)
 
         is_lab_found = False  # O(1)
@@ -318,19 +726,19 @@ class Patient:
 
         lab_value = 0.0  # O(1)
         # arbitrary date to please mypy
-        lab_date = dt.datetime(1, 1, 1)  # O(1)
+        lab_date = 0  # O(1)
 
         for lab in lab_records:  # O(K)
             if (lab.name == lab_name) and (is_lab_found is False):  # O(1)
                 is_lab_found = True  # O(1)
                 lab_value = lab.value  # O(1)
-                lab_date = lab.date  # O(1)
+                lab_date = lab.timestamp  # O(1)
 
             elif (lab.name == lab_name) and (is_lab_found is True):  # O(1)
-                new_lab_date = lab.date  # O(1)
+                new_lab_date = lab.timestamp  # O(1)
                 if new_lab_date > lab_date:  # O(1)
                     lab_value = lab.value  # O(1)
-                    lab_date = lab.date  # O(1)
+                    lab_date = new_lab_date  # O(1)
 
         if not is_lab_found:  # O(1)
             raise ValueError(
@@ -372,20 +780,273 @@ class Patient:
         We have a total time complexity of
         O(2) + O(1) + O(1) + O(K x 5) = O(K x 5) + O(4).
         This simplifies to O(K), as expected.
+
+        With an attached LabTable the earliest date is the minimum of
+        the patient's slice of the table, so only the date of birth
+        is read from the patient record. Otherwise the labs are
+        compared as Lab.timestamp integers and only the earliest one
+        is turned back into a datetime.
         """
         # today or now is initialized as
         # the earliest possible admission date
         earliest_admission = dt.datetime.now()  # O(1)
 
-        for lab in self.labs:  # O(K)
-            admission_date = lab.date  # O(2)
-            if admission_date < earliest_admission:  # O(1)
-                earliest_admission = admission_date  # O(1)
+        if self.lab_table is not None:  # O(1)
+            rows = self.lab_table.rows_for(self.id)  # O(1)
+            if rows.start < rows.stop:  # O(1)
+                earliest_admission = min(
+                    earliest_admission, self.lab_table.first_admission(self.id)
+                )  # O(K)
+        else:
+            earliest = to_epoch(earliest_admission)  # O(1)
+            for lab in self.labs:  # O(K)
+                admission_date = lab.timestamp  # O(2)
+                if admission_date < earliest:  # O(1)
+                    earliest = admission_date  # O(1)
+            earliest_admission = from_epoch(earliest)  # O(1)
 
         first_admission_age = earliest_admission.year - self.dob.year  # O(1)
 
         return first_admission_age  # O(1)
 
+    def lab_value_at(self, lab_name: str, when: dt.datetime) -> float | None:
+        """Return the value of lab_name as of when.
+
+        That is the value of the latest lab_name result dated at or
+        before when, or None if there was none yet. Binary search in
+        an attached LabSeries, otherwise an index search in SQLite;
+        both are O(log K).
+        """
+        if self.lab_series is not None:  # O(1)
+            return self.lab_series.value_at(
+                self.id, lab_name, when
+            )  # O(log K)
+        return lab_value_at(self.db_name, self.id, lab_name, when)  # O(log K)
+
+    def lab_values_between(
+        self, lab_name: str, start: dt.datetime, end: dt.datetime
+    ) -> list[tuple[dt.datetime, float]]:
+        """Return the (date, value) lab_name results dated in [start, end].
+
+        Both ends are included and the results come in date order.
+        O(log K) plus the results returned, as lab_value_at.
+        """
+        if self.lab_series is not None:  # O(1)
+            return self.lab_series.values_between(
+                self.id, lab_name, start, end
+            )  # O(log K)
+        return lab_values_between(
+            self.db_name, self.id, lab_name, start, end
+        )  # O(log K)
+
+
+class LabMapping(Mapping[str, list[Lab]]):
+    """Read-only mapping of patient IDs to Lab lists, read from LABS.
+
+    Nothing is kept in memory: every lookup selects the patient's
+    Autogen_ids, O(log K + labs of the patient) with the default
+    indexes, and returns fresh Lab objects in ingest order. Patients
+    without labs are missing, as in the dictionary built by
+    lab_file_to_dict.
+    """
+
+    def __init__(self, db_name: str, hydrated: bool = False) -> None:
+        """Initialize the mapping over the database db_name."""
+        self.db_name = db_name
+        self.hydrated = hydrated
+
+    def _lab_ids(self, patient_id: str) -> list[int]:
+        """Return the Autogen_ids of a patient's labs in ingest order."""
+        with get_pool(self.db_name).connection() as connection:
+            cursor = connection.execute(
+                """
+                SELECT Autogen_id FROM LABS
+                WHERE PatientID = ?
+                ORDER BY Autogen_id
+                """,
+                (patient_id,),
+            )
+            lab_ids = [row[0] for row in cursor]
+            cursor.close()
+        return lab_ids
+
+    def get_labs(self, patient_id: str) -> list[Lab]:
+        """Return a patient's labs, an empty list if there are none."""
+        return [
+            Lab(lab_id, self.db_name, self.hydrated)
+            for lab_id in self._lab_ids(patient_id)
+        ]
+
+    def __getitem__(self, patient_id: str) -> list[Lab]:
+        """Return a patient's labs, raising KeyError if there are none."""
+        labs = self.get_labs(patient_id)
+        if not labs:
+            raise KeyError(patient_id)
+        return labs
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate over the patient IDs in order of their first lab.
+
+        The IDs are read up front, O(K log K), so that no connection
+        is held while the caller looks them up.
+        """
+        with get_pool(self.db_name).connection() as connection:
+            cursor = connection.execute(
+                """
+                SELECT PatientID FROM LABS
+                GROUP BY PatientID
+                ORDER BY MIN(Autogen_id)
+                """
+            )
+            patient_ids = [row[0] for row in cursor]
+            cursor.close()
+        return iter(patient_ids)
+
+    def __len__(self) -> int:
+        """Return the number of patients with labs."""
+        with get_pool(self.db_name).connection() as connection:
+            count: int = connection.execute(
+                "SELECT COUNT(DISTINCT PatientID) FROM LABS"
+            ).fetchone()[0]
+        return count
+
+    def __contains__(self, patient_id: object) -> bool:
+        """Return whether the patient has labs, without building them."""
+        with get_pool(self.db_name).connection() as connection:
+            row = connection.execute(
+                "SELECT 1 FROM LABS WHERE PatientID = ? LIMIT 1",
+                (patient_id,),
+            ).fetchone()
+        return row is not None
+
+
+# number of Patient objects kept by a PatientMapping
+DEFAULT_PATIENT_CACHE_SIZE = 1024
+
+
+class PatientMapping(Mapping[str, Patient]):
+    """Read-only mapping of patient IDs to Patient objects, read from PATIENTS.
+
+    It answers the lookups of the dictionary built by
+    patient_file_to_dict without holding a Patient (and its Lab list)
+    for every row. A Patient is built on first lookup, with its labs
+    from a LabMapping, and kept in an LRU cache of cache_size
+    objects, so repeated lookups of a patient return the same object
+    and memory stays O(cache_size) instead of O(N + K). The cache is
+    guarded by a lock, so the mapping can be shared between threads.
+    """
+
+    def __init__(
+        self,
+        db_name: str,
+        hydrated: bool = False,
+        cache_size: int = DEFAULT_PATIENT_CACHE_SIZE,
+    ) -> None:
+        """Initialize the mapping over the database db_name."""
+        if cache_size < 0:
+            raise ValueError("The cache size cannot be negative")
+        self.db_name = db_name
+        self.hydrated = hydrated
+        self.cache_size = cache_size
+        self.labs = LabMapping(db_name, hydrated)
+        self._cache: collections.OrderedDict[
+            str, Patient
+        ] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, patient_id: str) -> Patient:
+        """Return a patient, raising KeyError for unknown IDs."""
+        with self._lock:
+            patient = self._cache.get(patient_id)
+            if patient is not None:
+                self._cache.move_to_end(patient_id)
+                return patient
+
+        if patient_id not in self:
+            raise KeyError(patient_id)
+        patient = Patient(
+            patient_id,
+            self.db_name,
+            self.labs.get_labs(patient_id),
+            self.hydrated,
+        )
+        if self.cache_size:
+            with self._lock:
+                # another thread may have built the patient meanwhile
+                patient = self._cache.setdefault(patient_id, patient)
+                self._cache.move_to_end(patient_id)
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return patient
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate over the patient IDs in ingest order.
+
+        The IDs are read up front, O(N), so that no connection is held
+        while the caller looks them up.
+        """
+        with get_pool(self.db_name).connection() as connection:
+            cursor = connection.execute(
+                "SELECT ID FROM PATIENTS ORDER BY rowid"
+            )
+            patient_ids = [row[0] for row in cursor]
+            cursor.close()
+        return iter(patient_ids)
+
+    def __len__(self) -> int:
+        """Return the number of patients."""
+        with get_pool(self.db_name).connection() as connection:
+            count: int = connection.execute(
+                "SELECT COUNT(*) FROM PATIENTS"
+            ).fetchone()[0]
+        return count
+
+    def __contains__(self, patient_id: object) -> bool:
+        """Return whether the patient exists, without building it."""
+        with self._lock:
+            if patient_id in self._cache:
+                return True
+        with get_pool(self.db_name).connection() as connection:
+            row = connection.execute(
+                "SELECT 1 FROM PATIENTS WHERE ID = ?", (patient_id,)
+            ).fetchone()
+        return row is not None
+
+    def clear_cache(self) -> None:
+        """Forget the cached Patient objects."""
+        with self._lock:
+            self._cache.clear()
+
+
+# number of threads map_patients runs the function on by default
+DEFAULT_MAP_WORKERS = 4
+
+
+def map_patients(
+    function: Callable[[Patient], T],
+    patients: Iterable[Patient],
+    workers: int = DEFAULT_MAP_WORKERS,
+) -> list[T]:
+    """Return [function(patient) for patient in patients], using threads.
+
+    function runs on up to workers threads at once. The results keep
+    the order of patients, and the first exception raised by function
+    is raised again here.
+
+    Reading Patient and Lab objects from several threads is safe:
+    every query borrows a pooled connection of its own. A database's
+    default pool has DEFAULT_POOL_SIZE connections, though, so with
+    more workers than that the threads queue for connections. Call
+    connection_pool.configure_read_only(db_name) first to give every
+    thread its own read-only connection instead.
+    """
+    if workers < 1:
+        raise ValueError("The number of workers must be at least 1")
+    if workers == 1:
+        return [function(patient) for patient in patients]
+    with ThreadPoolExecutor(workers, thread_name_prefix="ehr-map") as pool:
+        return list(pool.map(function, patients))
+
 
 def fix_header(header: str) -> list[str]:
     """Split header into list of strings.
@@ -416,11 +1077,392 @@ def fix_header(header: str) -> list[str]:
     return header.split("\t")  # O(M) or O(L)
 
 
+LAB_INSERT_SQL = """
+    INSERT INTO LAB_RESULTS
+    VALUES(?, ?, ?, ?, ?, ?, ?)
+    """
+PATIENT_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS PATIENTS (
+        ID VARCHAR(255) PRIMARY KEY,
+        Gender VARCHAR(255),
+        DateOfBirth DATETIME,
+        Race VARCHAR(255),
+        MaritalStatus VARCHAR(255),
+        Language VARCHAR(255),
+        PovertyLevel FLOAT
+    )
+    """
+PATIENT_INSERT_SQL = """
+    INSERT INTO PATIENTS
+    VALUES(?, ?, ?, ?, ?, ?, ?)
+    """
+PATIENT_UPSERT_SQL = """
+    INSERT INTO PATIENTS
+    VALUES(?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(ID) DO UPDATE SET
+        Gender = excluded.Gender,
+        DateOfBirth = excluded.DateOfBirth,
+        Race = excluded.Race,
+        MaritalStatus = excluded.MaritalStatus,
+        Language = excluded.Language,
+        PovertyLevel = excluded.PovertyLevel
+    """
+
+# Number of bytes hashed at each end of a file's processed prefix.
+# Hashing samples rather than the whole prefix keeps the check cheap
+# on multi-GB exports while still catching files that were rewritten.
+FINGERPRINT_BLOCK_SIZE = 1 << 20
+
+
+class FileFingerprint(NamedTuple):
+    """Size, modification time and sampled digest of an ingested file."""
+
+    size: int
+    mtime: float
+    digest: str
+
+
+class IngestState(NamedTuple):
+    """Fingerprint and row count recorded after ingesting a file."""
+
+    fingerprint: FileFingerprint
+    row_count: int
+
+
+def file_fingerprint(
+    txt_file: str, size: int | None = None
+) -> FileFingerprint:
+    """Fingerprint the first size bytes of a file, or all of it.
+
+    The digest covers the prefix length and the first and last
+    FINGERPRINT_BLOCK_SIZE bytes of the prefix, so it is O(1) in the
+    size of the file.
+    """
+    stat = os.stat(txt_file)
+    if size is None:
+        size = stat.st_size
+    digest = hashlib.sha256(str(size).encode())
+    with open(txt_file, "rb") as f:
+        digest.update(f.read(min(size, FINGERPRINT_BLOCK_SIZE)))
+        if size > FINGERPRINT_BLOCK_SIZE:
+            f.seek(max(FINGERPRINT_BLOCK_SIZE, size - FINGERPRINT_BLOCK_SIZE))
+            digest.update(f.read(size - f.tell()))
+    return FileFingerprint(size, stat.st_mtime, digest.hexdigest())
+
+
+def _is_appended(txt_file: str, state: IngestState) -> bool:
+    """Return whether a file only grew since its state was recorded."""
+    previous = state.fingerprint
+    if os.path.getsize(txt_file) < previous.size:
+        return False
+    return file_fingerprint(txt_file, previous.size).digest == previous.digest
+
+
+def load_ingest_state(
+    db: sqlite3.Connection, table: str
+) -> IngestState | None:
+    """Return the state recorded when table was last ingested, if any."""
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS INGEST_STATE (
+            TableName VARCHAR(255) PRIMARY KEY,
+            FileSize INT,
+            FileMTime FLOAT,
+            Digest VARCHAR(64),
+            RowCount INT
+        )
+        """
+    )
+    row = db.execute(
+        """
+        SELECT FileSize, FileMTime, Digest, RowCount FROM INGEST_STATE
+        WHERE TableName = ?
+        """,
+        (table,),
+    ).fetchone()
+    if row is None:
+        return None
+    return IngestState(FileFingerprint(row[0], row[1], row[2]), row[3])
+
+
+def save_ingest_state(
+    db: sqlite3.Connection,
+    table: str,
+    fingerprint: FileFingerprint,
+    row_count: int,
+) -> None:
+    """Record the fingerprint of the file just ingested into table.
+
+    The caller commits, so the state lands in the same transaction
+    as the rows it describes.
+    """
+    load_ingest_state(db, table)  # creates INGEST_STATE if needed
+    db.execute(
+        "INSERT OR REPLACE INTO INGEST_STATE VALUES(?, ?, ?, ?, ?)",
+        (table, *fingerprint, row_count),
+    )
+
+
+# number of parsed rows handed to executemany at a time during ingest
+DEFAULT_BATCH_SIZE = 10_000
+
+
+# Pragmas applied by bulk_loading: the rollback journal is kept in
+# memory and nothing is synced to disk, so a crash during the load
+# can corrupt the database, but a failed load still rolls back. The
+# page cache grows to 256 MiB and temporary indexes stay in memory.
+# page_size only takes effect on a database that is still empty.
+BULK_LOAD_PRAGMAS: dict[str, str | int] = {
+    "page_size": 16384,
+    "journal_mode": "MEMORY",
+    "synchronous": "OFF",
+    "cache_size": -262144,
+    "temp_store": "MEMORY",
+}
+
+# the connections inside a bulk_loading block; they are held, not
+# just their ids, so that no other connection can be mistaken for one
+_bulk_loading: set[sqlite3.Connection] = set()
+_bulk_loading_lock = threading.Lock()
+
+
+def commit(db: sqlite3.Connection) -> None:
+    """Commit, unless db is bulk loading and commits once at the end."""
+    with _bulk_loading_lock:
+        deferred = db in _bulk_loading
+    if not deferred:
+        db.commit()
+
+
+class BulkLoad:
+    """Settings and duration of one bulk_loading block."""
+
+    def __init__(
+        self, previous: dict[str, Any], applied: dict[str, Any]
+    ) -> None:
+        """Initialize the report; seconds is set when the block ends."""
+        self.previous = previous
+        self.applied = applied
+        self.seconds = 0.0
+
+
+@contextmanager
+def bulk_loading(
+    db: sqlite3.Connection,
+    pragmas: dict[str, str | int] = BULK_LOAD_PRAGMAS,
+) -> Iterator[BulkLoad]:
+    """Run the body of a with block as one fast, non-durable load.
+
+    The pragmas are applied and a transaction is opened. Every commit
+    that the ingest functions make inside the block is deferred, so
+    all tables are written in that one transaction, which is
+    committed when the block ends, or rolled back if it raises.
+    Afterwards the pragmas are set back to their previous values,
+    except page_size, which is a property of the database file.
+
+    The pragma names and values are pasted into the SQL, so they
+    must not come from untrusted input.
+    """
+    if db.in_transaction:
+        raise sqlite3.ProgrammingError(
+            "Cannot start a bulk load inside an open transaction"
+        )
+
+    def read(name: str) -> Any:
+        return db.execute(f"PRAGMA {name}").fetchone()[0]
+
+    previous = {name: read(name) for name in pragmas if name != "page_size"}
+    for name, value in pragmas.items():
+        db.execute(f"PRAGMA {name} = {value}")
+    report = BulkLoad(previous, {name: read(name) for name in pragmas})
+
+    start = time.perf_counter()
+    db.execute("BEGIN")
+    with _bulk_loading_lock:
+        _bulk_loading.add(db)
+    try:
+        yield report
+    except BaseException:
+        db.rollback()
+        raise
+    else:
+        db.commit()
+    finally:
+        with _bulk_loading_lock:
+            _bulk_loading.discard(db)
+        report.seconds = time.perf_counter() - start
+        for name, value in previous.items():
+            db.execute(f"PRAGMA {name} = {value}")
+
+
+def insert_batches(
+    cursor: sqlite3.Cursor,
+    sql: str,
+    rows: Iterable[tuple[Any, ...]],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> int:
+    """Insert rows from an iterable, batch_size rows at a time.
+
+    Only one batch is held in memory at any point, so the memory use
+    is O(batch_size) however long rows is. The caller commits, which
+    keeps every batch inside the same transaction. Returns the number
+    of rows inserted.
+    """
+    if batch_size < 1:
+        raise ValueError("The batch size must be at least 1")
+    iterator = iter(rows)
+    inserted = 0
+    while batch := list(itertools.islice(iterator, batch_size)):
+        cursor.executemany(sql, batch)  # O(batch_size)
+        inserted += len(batch)
+    stats = instrumentation.current()
+    if stats is not None:
+        stats.count("rows_inserted", inserted)
+    return inserted
+
+
+def _timed_insert(
+    function_name: str,
+    cursor: sqlite3.Cursor,
+    sql: str,
+    rows: Iterable[tuple[Any, ...]],
+    batch_size: int,
+) -> int:
+    """Run insert_batches, timing its phases when instrumentation is on.
+
+    The rows are produced while they are inserted, so the time spent
+    producing them is recorded as function_name.parse and the rest as
+    function_name.insert.
+    """
+    stats = instrumentation.current()
+    if stats is None:
+        return insert_batches(cursor, sql, rows, batch_size)
+
+    parse_phase = f"{function_name}.parse"
+    parsed_before = stats.phases[parse_phase]
+    start = time.perf_counter()
+    inserted = insert_batches(
+        cursor, sql, stats.timed_iter(parse_phase, rows), batch_size
+    )
+    elapsed = time.perf_counter() - start
+    parsing = stats.phases[parse_phase] - parsed_before
+    stats.add_time(f"{function_name}.insert", elapsed - parsing)
+    return inserted
+
+
+def _timed_commit(function_name: str, db: sqlite3.Connection) -> None:
+    """Commit, timing it as function_name.commit when instrumented."""
+    stats = instrumentation.current()
+    if stats is None:
+        commit(db)
+    else:
+        with stats.phase(f"{function_name}.commit"):
+            commit(db)
+
+
+# file columns read into PATIENTS and LABS, in the order of their rows
+PATIENT_FIELDS = (
+    "PatientID",
+    "PatientGender",
+    "PatientDateOfBirth",
+    "PatientRace",
+    "PatientMaritalStatus",
+    "PatientLanguage",
+    "PatientPopulationPercentageBelowPoverty",
+)
+LAB_FIELDS = (
+    "PatientID",
+    "AdmissionID",
+    "LabName",
+    "LabValue",
+    "LabUnits",
+    "LabDateTime",
+)
+
+
+def patient_fields_row(
+    fields: tuple[str, ...],
+    parse_date: Callable[[str], dt.datetime | int] = date_parser,
+) -> tuple[Any, ...]:
+    """Convert the PATIENT_FIELDS of one line into a PATIENTS row, O(1)."""
+    patient_id, gender, dob, race, marital_status, language, poverty = fields
+    return (
+        patient_id,
+        gender,
+        parse_date(dob),
+        race,
+        marital_status,
+        language,
+        float(poverty),
+    )  # O(1)
+
+
+def lab_fields_row(
+    fields: tuple[str, ...],
+    parse_date: Callable[[str], dt.datetime | int] = date_parser,
+) -> tuple[Any, ...]:
+    """Convert the LAB_FIELDS of one line into a LABS row, O(1).
+
+    The row lacks the Autogen_id, which depends on the line's position
+    in the file.
+    """
+    patient_id, admission_id, name, value, unit, date = fields
+    return (
+        patient_id,
+        int(admission_id),
+        name,
+        float(value),
+        unit,
+        parse_date(date),
+    )  # O(1)
+
+
+def patient_row(fixed_header: list[str], line: str) -> tuple[Any, ...]:
+    """Parse one line of the patient file into a PATIENTS row.
+
+    The records are split by tab, O(M), and paired with the header's
+    contents in a dictionary, O(M), so that the columns can be picked
+    by name whatever their order in the file. The ingest functions
+    read whole files with tsv_reader.iter_rows instead.
+    """
+    records = line.strip().split("\t")  # O(M)
+
+    mapping = dict(zip(fixed_header, records))  # O(M)
+
+    return patient_fields_row(
+        tuple(mapping[name] for name in PATIENT_FIELDS)
+    )  # O(1)
+
+
+def lab_row(
+    fixed_header: list[str],
+    line: str,
+    parse_date: Callable[[str], dt.datetime | int] = date_parser,
+) -> tuple[Any, ...]:
+    """Parse one line of the lab file into a LABS row, minus Autogen_id.
+
+    As in patient_row, the line is split, O(L), and paired with the
+    header, O(L).
+    """
+    labs = line.strip().split("\t")  # O(L)
+
+    new_labs = dict(zip(fixed_header, labs))  # O(L)
+
+    return lab_fields_row(
+        tuple(new_labs[name] for name in LAB_FIELDS), parse_date
+    )  # O(1)
+
+
 def patient_file_to_dict(
     txt_file: str,
     lab_dict: dict[str, list[Lab]],
     db: sqlite3.Connection,
     name_db: str,
+    hydrated: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    upsert: bool = False,
+    collect: bool = True,
+    epoch_timestamps: bool = False,
 ) -> dict[str, Patient]:
     """Open patient txt files to convert them to dictionaries.
 
@@ -474,76 +1516,419 @@ def patient_file_to_dict(
     The total time complexity is 2 * O(M) + O(1) + O(N)[2*O(M) + O(1)].
     This simplifies to O(N x M), where N is the number of rows and M
     is the number of columns of the patient file.
+
+    The rows are parsed lazily and inserted batch_size rows at a time
+    within a single transaction, see insert_batches, so the rows
+    waiting to be written take O(batch_size) memory instead of O(N).
+
+    The file is read through the memory-mapped tsv_reader.iter_rows,
+    which picks the PATIENT_FIELDS by position, so no dictionary is
+    built per row. The whole read remains O(N x M).
+
+    By default PATIENTS is dropped and rebuilt. With upsert=True the
+    table is kept, and every row replaces the stored row with the same
+    ID or is added when the ID is new. Either way the file's
+    fingerprint is recorded for patient_file_upsert.
+
+    With collect=False no Patient objects are built and the returned
+    dictionary is empty; the rows can be read back on demand through
+    a PatientMapping instead.
+
+    With epoch_timestamps=True DateOfBirth is stored as integer
+    microseconds since EPOCH instead of text. An upsert into a table
+    that already holds dates keeps their format.
     """
     cursor = db.cursor()  # O(1)
-    cursor.execute("DROP TABLE IF EXISTS PATIENTS")  # O(1)
+    if not upsert:
+        cursor.execute("DROP TABLE IF EXISTS PATIENTS")  # O(1)
 
     # create table
-    cursor.execute(
-        """
-        CREATE TABLE PATIENTS (
-            ID VARCHAR(255) PRIMARY KEY,
-            Gender VARCHAR(255),
-            DateOfBirth DATETIME,
-            Race VARCHAR(255),
-            MaritalStatus VARCHAR(255),
-            Language VARCHAR(255),
-            PovertyLevel FLOAT
-        )
-        """
-    )  # O(1)
+    cursor.execute(PATIENT_SCHEMA)  # O(1)
 
-    db.commit()  # O(1)
+    commit(db)  # O(1)
+    stored = stores_epoch_timestamps(db, "PATIENTS", "DateOfBirth")  # O(1)
+    if stored is not None:
+        epoch_timestamps = stored  # O(1)
     output_dict = dict()  # O(1)
+    parse_date: Callable[[str], dt.datetime | int] = (
+        epoch_date_parser if epoch_timestamps else date_parser
+    )  # O(1)
+    stats = instrumentation.current()  # O(1)
+    if stats is not None:
+        parse_date = stats.timed(
+            "patient_file_to_dict.date_conversion", parse_date
+        )
 
-    with open(txt_file, encoding="UTF-8-SIG") as f:  # O(1)
+    def patient_rows() -> Iterator[tuple[Any, ...]]:
+        """Parse the file lazily, yielding one PATIENTS row per line."""
         # Core assumption: first line is header
-        # skip and save header
-        header = next(f)  # O(1)
-        fixed_header = fix_header(header)  # O(M)
-        patient_id_index = header.index("PatientID")  # O(M)
-
-        # prepare queue
-        sql_queue = []  # O(1)
         # This whole loop has a time complexity of O(NxM)
-        for line in f:  # O(N x M)
-            records = line.strip().split("\t")  # O(M)
-
-            mapping = dict(zip(fixed_header, records))  # O(M)
-
-            sql_queue.append(
-                (
-                    mapping["PatientID"],
-                    mapping["PatientGender"],
-                    date_parser(mapping["PatientDateOfBirth"]),
-                    mapping["PatientRace"],
-                    mapping["PatientMaritalStatus"],
-                    mapping["PatientLanguage"],
-                    float(mapping["PatientPopulationPercentageBelowPoverty"]),
-                )
+        for fields in iter_rows(txt_file, PATIENT_FIELDS):  # O(N x M)
+            row = patient_fields_row(fields, parse_date)  # O(1)
+            yield row  # O(1)
+            if not collect:  # O(1)
+                continue
+
+            patient_id = row[0]  # O(1)
+            patient = Patient(
+                patient_id, name_db, lab_dict[patient_id], hydrated
             )  # O(1)
-            patient_id = mapping["PatientID"]  # O(1)
-            patient = Patient(patient_id, name_db, lab_dict[patient_id])  # O(1
 
-            output_dict[records[patient_id_index]] = patient  # O(1)
+            output_dict[patient_id] = patient  # O(1)
 
-        cursor.executemany(
-            """
-            INSERT INTO PATIENTS
-            VALUES(?, ?, ?, ?, ?, ?, ?)
-            """,
-            sql_queue,
-        )
+    row_count = _timed_insert(
+        "patient_file_to_dict",
+        cursor,
+        PATIENT_UPSERT_SQL if upsert else PATIENT_INSERT_SQL,
+        patient_rows(),
+        batch_size,
+    )  # O(N)
 
-        db.commit()  # O(1)
+    save_ingest_state(
+        db, "PATIENTS", file_fingerprint(txt_file), row_count
+    )  # O(1)
+    _timed_commit("patient_file_to_dict", db)  # O(1)
 
     return output_dict  # O(1)
 
 
+# LABS is a view over the dictionary-encoded tables below. Lab names
+# and units repeat on millions of rows but take only a few hundred
+# distinct values, so LAB_RESULTS stores them as integer keys into
+# LAB_NAMES and UNITS. The view restores the original columns, and
+# its triggers turn writes to LABS into writes to the real tables.
+LAB_SCHEMA = [
+    """
+    CREATE TABLE LAB_NAMES (
+        ID INTEGER PRIMARY KEY,
+        Name VARCHAR(255) NOT NULL UNIQUE
+    )
+    """,
+    """
+    CREATE TABLE UNITS (
+        ID INTEGER PRIMARY KEY,
+        Unit VARCHAR(255) NOT NULL UNIQUE
+    )
+    """,
+    """
+    CREATE TABLE LAB_RESULTS (
+        PatientID VARCHAR(255),
+        AdmissionID INT,
+        NameID INT REFERENCES LAB_NAMES (ID),
+        Value FLOAT(8),
+        UnitID INT REFERENCES UNITS (ID),
+        Date DATETIME,
+        Autogen_id INTEGER PRIMARY KEY
+    )
+    """,
+    """
+    CREATE VIEW LABS AS
+    SELECT
+        LAB_RESULTS.PatientID AS PatientID,
+        LAB_RESULTS.AdmissionID AS AdmissionID,
+        LAB_NAMES.Name AS Name,
+        LAB_RESULTS.Value AS Value,
+        UNITS.Unit AS Unit,
+        LAB_RESULTS.Date AS Date,
+        LAB_RESULTS.Autogen_id AS Autogen_id
+    FROM LAB_RESULTS
+    JOIN LAB_NAMES ON LAB_NAMES.ID = LAB_RESULTS.NameID
+    JOIN UNITS ON UNITS.ID = LAB_RESULTS.UnitID
+    """,
+    """
+    CREATE TRIGGER LABS_INSERT INSTEAD OF INSERT ON LABS
+    BEGIN
+        INSERT OR IGNORE INTO LAB_NAMES (Name) VALUES (NEW.Name);
+        INSERT OR IGNORE INTO UNITS (Unit) VALUES (NEW.Unit);
+        INSERT INTO LAB_RESULTS VALUES (
+            NEW.PatientID,
+            NEW.AdmissionID,
+            (SELECT ID FROM LAB_NAMES WHERE Name = NEW.Name),
+            NEW.Value,
+            (SELECT ID FROM UNITS WHERE Unit = NEW.Unit),
+            NEW.Date,
+            NEW.Autogen_id
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER LABS_UPDATE INSTEAD OF UPDATE ON LABS
+    BEGIN
+        INSERT OR IGNORE INTO LAB_NAMES (Name) VALUES (NEW.Name);
+        INSERT OR IGNORE INTO UNITS (Unit) VALUES (NEW.Unit);
+        UPDATE LAB_RESULTS SET
+            PatientID = NEW.PatientID,
+            AdmissionID = NEW.AdmissionID,
+            NameID = (SELECT ID FROM LAB_NAMES WHERE Name = NEW.Name),
+            Value = NEW.Value,
+            UnitID = (SELECT ID FROM UNITS WHERE Unit = NEW.Unit),
+            Date = NEW.Date,
+            Autogen_id = NEW.Autogen_id
+        WHERE Autogen_id = OLD.Autogen_id;
+    END
+    """,
+    """
+    CREATE TRIGGER LABS_DELETE INSTEAD OF DELETE ON LABS
+    BEGIN
+        DELETE FROM LAB_RESULTS WHERE Autogen_id = OLD.Autogen_id;
+    END
+    """,
+]
+
+
+def _object_type(db: sqlite3.Connection, name: str) -> str | None:
+    """Return whether name is a table, a view, ..., or None if missing."""
+    row = db.execute(
+        "SELECT type FROM sqlite_master WHERE name = ?", (name,)
+    ).fetchone()
+    return None if row is None else str(row[0])
+
+
+def stores_epoch_timestamps(
+    db: sqlite3.Connection, table: str, column: str
+) -> bool | None:
+    """Return whether a date column holds epoch microseconds or text.
+
+    The first stored date decides, O(1). None means that the column
+    holds no dates yet, so either format may be written.
+    """
+    row = db.execute(
+        f"""
+        SELECT typeof({column}) FROM {table}
+        WHERE {column} IS NOT NULL
+        LIMIT 1
+        """
+    ).fetchone()
+    return None if row is None else row[0] == "integer"
+
+
+def date_sql(table: str, column: str, text: str, epoch: str) -> str:
+    """Return SQL for a date parameter that compares right with column.
+
+    Text dates only compare correctly against text, and epoch dates
+    against integers, so the same date is bound twice, as str(date)
+    to the placeholder text and as to_epoch(date) to epoch. The
+    expression picks one by the type of the column's first stored
+    date. SQLite evaluates that uncorrelated subquery once per
+    statement, so range searches still use the indexes on column.
+    """
+    return f"""CASE (
+        SELECT typeof({column}) FROM {table}
+        WHERE {column} IS NOT NULL
+        LIMIT 1
+    ) WHEN 'integer' THEN {epoch} ELSE {text} END"""
+
+
+def create_lab_table(db: sqlite3.Connection) -> None:
+    """Drop and re-create the LABS view and the tables behind it.
+
+    A LABS table left by a version of this module that did not
+    encode the names and units is dropped as well.
+    """
+    if _object_type(db, "LABS") == "table":
+        db.execute("DROP TABLE LABS")  # O(1)
+    else:
+        db.execute("DROP VIEW IF EXISTS LABS")  # O(1)
+    for table in ["LAB_RESULTS", "LAB_NAMES", "UNITS"]:
+        db.execute(f"DROP TABLE IF EXISTS {table}")  # O(1)
+
+    # create tables
+    for statement in LAB_SCHEMA:
+        db.execute(statement)  # O(1)
+
+    commit(db)  # O(1)
+
+
+class LabEncoder:
+    """Replace lab names and units by their keys while ingesting.
+
+    The keys already in LAB_NAMES and UNITS are loaded once. A name or
+    unit seen for the first time gets the next free key, and is
+    written to its table by flush(), which must run in the same
+    transaction as the rows that use it.
+    """
+
+    def __init__(self, db: sqlite3.Connection) -> None:
+        """Load the existing keys, O(distinct names and units)."""
+        self.db = db
+        self.names: dict[str, int] = dict(
+            db.execute("SELECT Name, ID FROM LAB_NAMES")
+        )
+        self.units: dict[str, int] = dict(
+            db.execute("SELECT Unit, ID FROM UNITS")
+        )
+        self._new_names: list[tuple[int, str]] = []
+        self._new_units: list[tuple[int, str]] = []
+        # the next free key of each table
+        self._next_name = max(self.names.values(), default=0) + 1
+        self._next_unit = max(self.units.values(), default=0) + 1
+
+    def encode_rows(
+        self, rows: Iterable[tuple[Any, ...]]
+    ) -> Iterator[tuple[Any, ...]]:
+        """Turn LABS rows into LAB_RESULTS rows, O(1) per row."""
+        names, units = self.names, self.units
+        for patient_id, admission_id, name, value, unit, date, lab_id in rows:
+            name_id = names.get(name)
+            if name_id is None:
+                name_id = names[name] = self._next_name
+                self._next_name += 1
+                self._new_names.append((name_id, name))
+            unit_id = units.get(unit)
+            if unit_id is None:
+                unit_id = units[unit] = self._next_unit
+                self._next_unit += 1
+                self._new_units.append((unit_id, unit))
+            yield (
+                patient_id,
+                admission_id,
+                name_id,
+                value,
+                unit_id,
+                date,
+                lab_id,
+            )
+
+    def flush(self) -> None:
+        """Write the names and units assigned since the last flush."""
+        self.db.executemany(
+            "INSERT INTO LAB_NAMES (ID, Name) VALUES (?, ?)", self._new_names
+        )
+        self.db.executemany(
+            "INSERT INTO UNITS (ID, Unit) VALUES (?, ?)", self._new_units
+        )
+        self._new_names.clear()
+        self._new_units.clear()
+
+
+# bytes of the digest that LabDeduplicator keeps per distinct row;
+# 128 bits make an accidental collision, which would drop a genuine
+# row, vanishingly unlikely even over billions of rows
+LAB_DIGEST_SIZE = 16
+
+
+class LabDeduplicator:
+    """Drop repeated lab rows while ingesting, keeping the first one.
+
+    Two rows are duplicates when their PatientID, AdmissionID, Name,
+    Value and Date are equal; the unit is not compared. Every
+    distinct row is remembered by a LAB_DIGEST_SIZE-byte digest in a
+    set, O(1) per row. With max_digests set, the set is spilled to a
+    temporary on-disk SQLite table whenever it reaches that size, so
+    memory stays bounded on huge files at the cost of one index
+    lookup per row once something was spilled.
+
+    Pass an instance to parse_data or an ingest function; afterwards
+    dropped holds the number of duplicates that were left out and
+    kept the number of rows inserted.
+    """
+
+    def __init__(self, max_digests: int | None = None) -> None:
+        """Initialize the deduplicator, spilling beyond max_digests."""
+        if max_digests is not None and max_digests < 1:
+            raise ValueError("max_digests must be at least 1")
+        self.max_digests = max_digests
+        self.dropped = 0
+        self.kept = 0
+        self.spilled = 0
+        self._digests: set[bytes] = set()
+        self._spill: sqlite3.Connection | None = None
+
+    @staticmethod
+    def digest(row: tuple[Any, ...]) -> bytes:
+        """Return the digest of a LABS row, O(1).
+
+        Dates are digested as SQLite stores them, str(datetime) or
+        epoch microseconds, so rows read back from LABS give the same
+        digest as the parsed rows they came from.
+        """
+        patient_id, admission_id, name, value, _, date = row[:6]
+        key = f"{patient_id}\t{admission_id}\t{name}\t{value!r}\t{date}"
+        return hashlib.blake2b(
+            key.encode(), digest_size=LAB_DIGEST_SIZE
+        ).digest()
+
+    def _release(self) -> None:
+        """Forget the digests and close the spill table."""
+        self._digests.clear()
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def clear(self) -> None:
+        """Forget every row and zero the counts, before an ingest."""
+        self._release()
+        self.dropped = self.kept = self.spilled = 0
+
+    def _spill_digests(self) -> None:
+        """Move the digests in memory to the spill table."""
+        if self._spill is None:
+            # an empty name opens a private on-disk database that
+            # SQLite deletes when it is closed
+            self._spill = sqlite3.connect("")
+            self._spill.execute(
+                "CREATE TABLE DIGESTS (Digest BLOB PRIMARY KEY) WITHOUT ROWID"
+            )
+        self._spill.executemany(
+            "INSERT INTO DIGESTS VALUES (?)",
+            ((digest,) for digest in self._digests),
+        )
+        self.spilled += len(self._digests)
+        self._digests.clear()
+
+    def _seen(self, digest: bytes) -> bool:
+        """Return whether a digest was recorded, recording it if not."""
+        if digest in self._digests:
+            return True
+        if (
+            self._spill is not None
+            and self._spill.execute(
+                "SELECT 1 FROM DIGESTS WHERE Digest = ?", (digest,)
+            ).fetchone()
+        ):
+            return True
+        self._digests.add(digest)
+        if self.max_digests is not None and (
+            len(self._digests) >= self.max_digests
+        ):
+            self._spill_digests()
+        return False
+
+    def is_duplicate(self, row: tuple[Any, ...]) -> bool:
+        """Return whether row repeats an earlier one, and count it."""
+        if self._seen(self.digest(row)):
+            self.dropped += 1
+            return True
+        self.kept += 1
+        return False
+
+    def add_existing(self, rows: Iterable[tuple[Any, ...]]) -> None:
+        """Record rows already in LABS, so that their repeats are dropped."""
+        for row in rows:
+            self._seen(self.digest(row))
+
+    def finish(self) -> None:
+        """Release the digests and the spill table; the counts stay.
+
+        With instrumentation enabled, the dropped rows are counted as
+        lab_duplicates_dropped.
+        """
+        stats = instrumentation.current()
+        if stats is not None and self.dropped:
+            stats.count("lab_duplicates_dropped", self.dropped)
+        self._release()
+
+
 def lab_file_to_dict(
     txt_file: str,
     db: sqlite3.Connection,
     name_db: str,
+    hydrated: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    date_cache_size: int = DATE_CACHE_SIZE,
+    collect: bool = True,
+    epoch_timestamps: bool = False,
+    dedup: LabDeduplicator | None = None,
 ) -> dict[str, list[Lab]]:
     """Open patient lab txt files to convert them to dictionaries.
 
@@ -610,84 +1995,544 @@ def lab_file_to_dict(
     This sums to 2 * O(L) + O(1) + O(1) (for opening the file)
     + O(K)[3 * O(L) + O(1)] + O(1) (the return statement).
     This simplifies to O(K x L), the highest order term.
+
+    As in patient_file_to_dict, the rows are parsed lazily and
+    inserted batch_size rows at a time within a single transaction,
+    so the rows waiting to be written take O(batch_size) memory
+    instead of O(K).
+
+    Lab timestamps are parsed through cached_date_parser, holding at
+    most date_cache_size distinct timestamps for the duration of the
+    call. Pass date_cache_size=0 to parse every row from scratch.
+
+    As in patient_file_to_dict, the file is read through
+    tsv_reader.iter_rows, without a dictionary per row.
+
+    The file's fingerprint is recorded for lab_file_append.
+
+    With collect=False no Lab objects are built and the returned
+    dictionary is empty, see LabMapping.
+
+    With epoch_timestamps=True Date is stored as integer microseconds
+    since EPOCH instead of text, see patient_file_to_dict.
+
+    With a LabDeduplicator, rows that repeat an earlier row are left
+    out before they get an Autogen_id or a Lab object, so the first
+    occurrences keep their file order and are numbered without gaps.
     """
     cursor = db.cursor()  # O(1)
-    cursor.execute("DROP TABLE IF EXISTS LABS")  # O(1)
+    create_lab_table(db)  # O(1)
+    if dedup is not None:
+        dedup.clear()  # O(1)
 
-    # create table
-    cursor.execute(
-        """
-        CREATE TABLE LABS (
-            PatientID VARCHAR(255),
-            AdmissionID INT,
-            Name VARCHAR(255),
-            Value FLOAT(8),
-            Unit VARCHAR(255),
-            Date DATETIME,
-            Autogen_id INT PRIMARY KEY
+    output_dict = dict()  # O(1)
+    parse_date = _date_parser(date_cache_size, epoch_timestamps)  # O(1)
+    stats = instrumentation.current()  # O(1)
+    if stats is not None:
+        parse_date = stats.timed(
+            "lab_file_to_dict.date_conversion", parse_date
         )
-        """
-    )  # O(1)
-
-    db.commit()  # O(1)
 
-    output_dict = dict()  # O(1)
-    generative_id = 1  # O(1)
-    with open(txt_file, encoding="UTF-8-SIG") as f:  # O(1)
+    def lab_rows() -> Iterator[tuple[Any, ...]]:
+        """Parse the file lazily, yielding one LABS row per line."""
         # Core assumption: first line is header
-        # skip and save header
-        header = next(f)  # O(1)
-        fixed_header = fix_header(header)  # O(L)
-        patient_id_index = fixed_header.index("PatientID")  # O(L)
-
-        # remove patient_id from header
-        sql_queue = []  # O(1)
+        generative_id = 1  # O(1)
         # This whole loop has a time complexity of O(K x L)
-        for line in f:  # O(K x L)
-            labs = line.strip().split("\t")  # O(L)
-            patient_id = labs[patient_id_index]  # O(1)
-
-            new_labs = dict(zip(fixed_header, labs))  # O(L)
-
-            # the query to insert the data
-            sql_queue.append(
-                (
-                    new_labs["PatientID"],
-                    int(new_labs["AdmissionID"]),
-                    new_labs["LabName"],
-                    float(new_labs["LabValue"]),
-                    new_labs["LabUnits"],
-                    date_parser(new_labs["LabDateTime"]),
-                    generative_id,
-                )
-            )  # O(1)
+        for fields in iter_rows(txt_file, LAB_FIELDS):  # O(K x L)
+            row = lab_fields_row(fields, parse_date)  # O(1)
+            if dedup is not None and dedup.is_duplicate(row):  # O(1)
+                continue
+            yield (*row, generative_id)  # O(1)
 
-            lab_obj = Lab(generative_id, name_db)  # O(1)
+            if collect:  # O(1)
+                patient_id = row[0]  # O(1)
+                lab_obj = Lab(generative_id, name_db, hydrated)  # O(1)
 
-            if patient_id not in output_dict:  # O(1)
-                output_dict[patient_id] = [lab_obj]  # O(1)
+                if patient_id not in output_dict:  # O(1)
+                    output_dict[patient_id] = [lab_obj]  # O(1)
 
-            else:  # O(1)
-                output_dict[patient_id].append(lab_obj)  # O(1)
+                else:  # O(1)
+                    output_dict[patient_id].append(lab_obj)  # O(1)
 
             generative_id += 1  # O(1)
 
-        # insert the data
-        cursor.executemany(
-            """INSERT INTO LABS
-            VALUES(?, ?, ?, ?, ?, ?, ?)
-            """,
-            sql_queue,
-        )  # O(1)
+    # insert the data
+    encoder = LabEncoder(db)  # O(1)
+    inserted = _timed_insert(
+        "lab_file_to_dict",
+        cursor,
+        LAB_INSERT_SQL,
+        encoder.encode_rows(lab_rows()),
+        batch_size,
+    )  # O(K)
+    encoder.flush()  # O(1)
+    if dedup is not None:
+        dedup.finish()  # O(1)
+
+    save_ingest_state(db, "LABS", file_fingerprint(txt_file), inserted)  # O(1)
+    _timed_commit("lab_file_to_dict", db)  # O(1)
+
+    return output_dict  # O(1)
+
+
+def lab_file_append(
+    txt_file: str,
+    db: sqlite3.Connection,
+    name_db: str,
+    hydrated: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    date_cache_size: int = DATE_CACHE_SIZE,
+    collect: bool = True,
+    epoch_timestamps: bool = False,
+    dedup: LabDeduplicator | None = None,
+) -> dict[str, list[Lab]]:
+    """Ingest only the lab rows appended since the previous ingest.
+
+    The fingerprint that the previous ingest recorded in INGEST_STATE
+    says how many bytes of the file were processed. When the file is
+    at least that long and its first that-many bytes still have the
+    same digest, the file was only appended to. Then the existing
+    Lab objects are rebuilt from LABS, O(K) without any parsing, and
+    only the new tail of the file is parsed and inserted, with
+    Autogen_id continuing from the current maximum. In any other case
+    the file was rewritten, and it is reloaded with lab_file_to_dict.
+
+    Parsing the tail is O(T x L) for T new rows, instead of
+    O(K x L) for a full reload.
+
+    With collect=False the existing rows are not read back and no
+    Lab objects are built; the returned dictionary is empty.
+
+    epoch_timestamps applies to a full reload. Appended rows are
+    stored in the format of the rows already in the table.
 
-        db.commit()  # O(1)
+    With a LabDeduplicator the rows already in LABS are digested
+    first, O(K), so that appended rows repeating them are dropped
+    too.
+    """
+    state = load_ingest_state(db, "LABS")  # O(1)
+    if (
+        state is None
+        or _object_type(db, "LAB_RESULTS") is None  # an older schema
+        or not _is_appended(txt_file, state)
+    ):  # O(1)
+        return lab_file_to_dict(
+            txt_file,
+            db,
+            name_db,
+            hydrated,
+            batch_size,
+            date_cache_size,
+            collect,
+            epoch_timestamps,
+            dedup,
+        )  # O(K x L)
+
+    output_dict: dict[str, list[Lab]] = dict()  # O(1)
+    if collect:
+        generative_id = 1  # O(1)
+        cursor = db.execute(
+            "SELECT PatientID, Autogen_id FROM LAB_RESULTS ORDER BY Autogen_id"
+        )  # O(K)
+        for patient_id, lab_id in cursor:  # O(K)
+            lab_obj = Lab(lab_id, name_db, hydrated)  # O(1)
+            output_dict.setdefault(patient_id, []).append(lab_obj)  # O(1)
+            generative_id = lab_id + 1  # O(1)
+    else:
+        (max_id,) = db.execute(
+            "SELECT MAX(Autogen_id) FROM LAB_RESULTS"
+        ).fetchone()  # O(1)
+        generative_id = (max_id or 0) + 1  # O(1)
+
+    stored = stores_epoch_timestamps(db, "LAB_RESULTS", "Date")  # O(1)
+    if stored is not None:
+        epoch_timestamps = stored  # O(1)
+    parse_date = _date_parser(date_cache_size, epoch_timestamps)  # O(1)
+    stats = instrumentation.current()  # O(1)
+    if stats is not None:
+        parse_date = stats.timed("lab_file_append.date_conversion", parse_date)
+    if dedup is not None:
+        dedup.clear()  # O(1)
+        dedup.add_existing(
+            db.execute(f"SELECT {LAB_COLUMNS} FROM LABS")
+        )  # O(K)
+
+    def lab_rows() -> Iterator[tuple[Any, ...]]:
+        """Parse the appended lines, yielding one LABS row per line."""
+        nonlocal generative_id
+        # blank lines are skipped, so it does not matter whether the
+        # previous last line had its newline
+        for fields in iter_rows(
+            txt_file, LAB_FIELDS, start=state.fingerprint.size
+        ):  # O(T x L)
+            row = lab_fields_row(fields, parse_date)  # O(1)
+            if dedup is not None and dedup.is_duplicate(row):  # O(1)
+                continue
+            yield (*row, generative_id)  # O(1)
+
+            if collect:  # O(1)
+                lab_obj = Lab(generative_id, name_db, hydrated)  # O(1)
+                output_dict.setdefault(row[0], []).append(lab_obj)
+            generative_id += 1  # O(1)
+
+    encoder = LabEncoder(db)  # O(1)
+    inserted = _timed_insert(
+        "lab_file_append",
+        db.cursor(),
+        LAB_INSERT_SQL,
+        encoder.encode_rows(lab_rows()),
+        batch_size,
+    )  # O(T)
+    encoder.flush()  # O(1)
+    if dedup is not None:
+        dedup.finish()  # O(1)
+
+    save_ingest_state(
+        db, "LABS", file_fingerprint(txt_file), state.row_count + inserted
+    )  # O(1)
+    _timed_commit("lab_file_append", db)  # O(1)
 
     return output_dict  # O(1)
 
 
+# bytes of the lab file parsed by one worker task
+DEFAULT_CHUNK_SIZE = 16 << 20
+
+
+def chunk_ranges(
+    txt_file: str, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> list[tuple[int, int]]:
+    """Split a file, minus its header line, into newline-aligned ranges.
+
+    Every range is a (start, end) pair of byte offsets. Each one ends
+    just after a newline (or at the end of the file), so no line is
+    split across two ranges.
+    """
+    size = os.path.getsize(txt_file)  # O(1)
+    ranges = []  # O(1)
+    with open(txt_file, "rb") as f:  # O(1)
+        f.readline()  # O(L), skip the header
+        start = f.tell()  # O(1)
+        while start < size:  # O(K / chunk_size)
+            f.seek(start + chunk_size - 1)  # O(1)
+            f.readline()  # O(L), finish the line at the boundary
+            end = min(f.tell(), size)  # O(1)
+            ranges.append((start, end))  # O(1)
+            start = end  # O(1)
+    return ranges  # O(1)
+
+
+def _parse_lab_chunk(
+    task: tuple[str, int, int, bool]
+) -> list[tuple[Any, ...]]:
+    """Parse the lab rows in one byte range, run in a worker process."""
+    txt_file, start, end, epoch_timestamps = task
+    parse_date = cached_date_parser(epoch_timestamps=epoch_timestamps)
+    return [
+        lab_fields_row(fields, parse_date)
+        for fields in iter_rows(txt_file, LAB_FIELDS, start, end)
+    ]
+
+
+def lab_file_to_dict_parallel(
+    txt_file: str,
+    db: sqlite3.Connection,
+    name_db: str,
+    workers: int | None = None,
+    hydrated: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    collect: bool = True,
+    epoch_timestamps: bool = False,
+    dedup: LabDeduplicator | None = None,
+) -> dict[str, list[Lab]]:
+    """Parse the lab file on several cores and load it like lab_file_to_dict.
+
+    The file is split with chunk_ranges and the ranges are parsed by
+    a pool of worker processes (os.cpu_count() when workers is None).
+    This process is the single writer: it takes the parsed ranges back
+    in file order, assigns Autogen_id sequentially and inserts the
+    rows, so the table and the returned dictionary are identical to
+    the ones lab_file_to_dict builds. At most two ranges per worker
+    are in flight at a time, which bounds the memory held by parsed
+    rows that are waiting for the writer.
+
+    The parsing work, O(K x L), is divided among the workers; the
+    insert remains O(K) in this process.
+
+    collect=False skips building the Lab objects, epoch_timestamps=True
+    stores epoch dates and dedup drops repeated rows, as in
+    lab_file_to_dict. Duplicates are dropped by this process, which
+    sees the rows in file order.
+
+    When instrumented, the time spent waiting for the workers counts
+    towards the parse phase; their date conversions are not timed.
+    """
+    create_lab_table(db)  # O(1)
+    if dedup is not None:
+        dedup.clear()  # O(1)
+    tasks = [
+        (txt_file, start, end, epoch_timestamps)
+        for start, end in chunk_ranges(txt_file, chunk_size)
+    ]  # O(K / chunk_size)
+
+    workers = workers or os.cpu_count() or 1  # O(1)
+    output_dict: dict[str, list[Lab]] = dict()  # O(1)
+
+    def parsed_chunks() -> Iterator[list[tuple[Any, ...]]]:
+        """Parse the ranges in the pool, yielding them in file order."""
+        with ProcessPoolExecutor(workers) as executor:
+            pending: collections.deque[
+                Future[list[tuple[Any, ...]]]
+            ] = collections.deque()
+            for task in tasks:
+                pending.append(executor.submit(_parse_lab_chunk, task))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def lab_rows() -> Iterator[tuple[Any, ...]]:
+        """Yield the parsed rows in file order, numbering them."""
+        generative_id = 1  # O(1)
+        for rows in parsed_chunks():
+            for row in rows:  # O(K) over all chunks
+                if dedup is not None and dedup.is_duplicate(row):  # O(1)
+                    continue
+                yield (*row, generative_id)  # O(1)
+
+                if collect:  # O(1)
+                    lab_obj = Lab(generative_id, name_db, hydrated)  # O(1)
+                    output_dict.setdefault(row[0], []).append(lab_obj)
+                generative_id += 1  # O(1)
+
+    encoder = LabEncoder(db)  # O(1)
+    inserted = _timed_insert(
+        "lab_file_to_dict_parallel",
+        db.cursor(),
+        LAB_INSERT_SQL,
+        encoder.encode_rows(lab_rows()),
+        batch_size,
+    )  # O(K)
+    encoder.flush()  # O(1)
+    if dedup is not None:
+        dedup.finish()  # O(1)
+
+    save_ingest_state(db, "LABS", file_fingerprint(txt_file), inserted)  # O(1)
+    _timed_commit("lab_file_to_dict_parallel", db)  # O(1)
+
+    return output_dict  # O(1)
+
+
+def patient_file_upsert(
+    txt_file: str,
+    lab_dict: dict[str, list[Lab]],
+    db: sqlite3.Connection,
+    name_db: str,
+    hydrated: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    collect: bool = True,
+    epoch_timestamps: bool = False,
+) -> dict[str, Patient]:
+    """Bring PATIENTS up to date with the patient file without a reload.
+
+    When the file matches the fingerprint recorded by the previous
+    ingest, nothing is parsed and the Patient objects are rebuilt
+    from the IDs in PATIENTS, O(N). Otherwise every row of the file
+    is upserted, inserting new patients and updating changed ones in
+    place, see patient_file_to_dict.
+    """
+    state = load_ingest_state(db, "PATIENTS")  # O(1)
+    if state is None or state.fingerprint != file_fingerprint(txt_file):
+        return patient_file_to_dict(
+            txt_file,
+            lab_dict,
+            db,
+            name_db,
+            hydrated,
+            batch_size,
+            upsert=True,
+            collect=collect,
+            epoch_timestamps=epoch_timestamps,
+        )  # O(N x M)
+
+    output_dict: dict[str, Patient] = dict()  # O(1)
+    if not collect:
+        return output_dict  # O(1)
+    for (patient_id,) in db.execute("SELECT ID FROM PATIENTS"):  # O(N)
+        output_dict[patient_id] = Patient(
+            patient_id, name_db, lab_dict[patient_id], hydrated
+        )  # O(1)
+    return output_dict  # O(1)
+
+
+# Secondary indexes, keyed by index name, mapped to (table, columns).
+# They are built after the bulk insert, because maintaining them row
+# by row during the insert would slow the load down.
+IndexSpec = tuple[str, tuple[str, ...]]
+DEFAULT_INDEXES: dict[str, IndexSpec] = {
+    "idx_labs_patient_name_date": (
+        "LAB_RESULTS",
+        ("PatientID", "NameID", "Date"),
+    ),
+    "idx_labs_name_date": ("LAB_RESULTS", ("NameID", "Date")),
+    "idx_labs_admission": ("LAB_RESULTS", ("AdmissionID",)),
+}
+
+
+def build_indexes(
+    db: sqlite3.Connection,
+    indexes: dict[str, IndexSpec] = DEFAULT_INDEXES,
+) -> dict[str, float]:
+    """Create secondary indexes and return the seconds spent on each.
+
+    Building an index sorts the table once, O(K log K) for LABS,
+    after which lookups by the indexed columns are O(log K)
+    instead of full table scans. Indexes that already exist are
+    skipped and reported with a build time of 0.
+    """
+    existing = set(list_indexes(db))
+    timings = dict()
+    for name, (table, columns) in indexes.items():
+        start = time.perf_counter()
+        if name not in existing:
+            column_list = ", ".join(columns)
+            db.execute(f"CREATE INDEX {name} ON {table} ({column_list})")
+        timings[name] = time.perf_counter() - start
+    commit(db)
+    return timings
+
+
+def list_indexes(
+    db: sqlite3.Connection, table: str | None = None
+) -> list[str]:
+    """Return the names of the secondary indexes, optionally per table.
+
+    Indexes that SQLite creates automatically for primary keys are
+    not listed, since they cannot be dropped.
+    """
+    query = """
+        SELECT name FROM sqlite_master
+        WHERE type = 'index' AND sql IS NOT NULL
+        """
+    parameters: tuple[str, ...] = ()
+    if table is not None:
+        query += " AND tbl_name = ?"
+        parameters = (table,)
+    return [row[0] for row in db.execute(query + " ORDER BY name", parameters)]
+
+
+def drop_indexes(
+    db: sqlite3.Connection, names: list[str] | None = None
+) -> list[str]:
+    """Drop the given secondary indexes, or all of them, and return names."""
+    if names is None:
+        names = list_indexes(db)
+    for name in names:
+        db.execute(f"DROP INDEX IF EXISTS {name}")
+    commit(db)
+    return names
+
+
+def lab_value_at(
+    db: sqlite3.Connection | str,
+    patient_id: str,
+    lab_name: str,
+    when: dt.datetime,
+) -> float | None:
+    """Return a patient's lab_name value as of when, from LAB_RESULTS.
+
+    The latest result dated at or before when is found through the
+    idx_labs_patient_name_date index, O(log K); a tie on that date
+    goes to the result ingested first, as in Patient.is_sick.
+    Returns None when there is no such result. Either date format
+    is searched the same way, see date_sql.
+    """
+    when_sql = date_sql("LAB_RESULTS", "Date", ":when", ":when_epoch")
+    with connection_for(db) as connection:
+        row = connection.execute(
+            f"""
+            SELECT Value FROM LAB_RESULTS
+            WHERE PatientID = :patient_id
+                AND NameID = (SELECT ID FROM LAB_NAMES WHERE Name = :name)
+                AND Date <= {when_sql}
+            ORDER BY Date DESC, Autogen_id ASC
+            LIMIT 1
+            """,
+            {
+                "patient_id": patient_id,
+                "name": lab_name,
+                "when": str(when),
+                "when_epoch": to_epoch(when),
+            },
+        ).fetchone()
+    return None if row is None else float(row[0])
+
+
+def lab_values_between(
+    db: sqlite3.Connection | str,
+    patient_id: str,
+    lab_name: str,
+    start: dt.datetime,
+    end: dt.datetime,
+) -> list[tuple[dt.datetime, float]]:
+    """Return a patient's (date, value) lab_name results in [start, end].
+
+    One range search on the idx_labs_patient_name_date index, whose
+    order is already (date, ingest order), O(log K) plus the results.
+    """
+    start_sql = date_sql("LAB_RESULTS", "Date", ":start", ":start_epoch")
+    end_sql = date_sql("LAB_RESULTS", "Date", ":end", ":end_epoch")
+    with connection_for(db) as connection:
+        rows = connection.execute(
+            f"""
+            SELECT Date, Value FROM LAB_RESULTS
+            WHERE PatientID = :patient_id
+                AND NameID = (SELECT ID FROM LAB_NAMES WHERE Name = :name)
+                AND Date BETWEEN {start_sql} AND {end_sql}
+            ORDER BY Date, Autogen_id
+            """,
+            {
+                "patient_id": patient_id,
+                "name": lab_name,
+                "start": str(start),
+                "start_epoch": to_epoch(start),
+                "end": str(end),
+                "end_epoch": to_epoch(end),
+            },
+        ).fetchall()
+    return [(stored_date(date), float(value)) for date, value in rows]
+
+
+def snapshot_database(db: sqlite3.Connection, target: str) -> None:
+    """Copy the whole database behind db into the file target.
+
+    SQLite's online backup API copies the database page by page, so
+    an in-memory database can be built fast and saved once at the end.
+    An existing target is overwritten.
+    """
+    destination = sqlite3.connect(target)
+    try:
+        db.backup(destination)
+    finally:
+        destination.close()
+
+
 def parse_data(
-    patient_filename: str, lab_filename: str
-) -> tuple[dict[str, Patient], dict[str, list[Lab]]]:
+    patient_filename: str,
+    lab_filename: str,
+    hydrated: bool = False,
+    indexes: dict[str, IndexSpec] | None = DEFAULT_INDEXES,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    incremental: bool = False,
+    workers: int = 1,
+    db: str | sqlite3.Connection = "EHR.db",
+    snapshot_to: str | None = None,
+    lazy: bool = False,
+    bulk_load: bool = False,
+    epoch_timestamps: bool = False,
+    dedup: LabDeduplicator | None = None,
+) -> tuple[Mapping[str, Patient], Mapping[str, list[Lab]]]:
     """Take patient and lab files and converts them into dictionaries.
 
     They are assumed to be tab-delimited text files,
@@ -702,14 +2547,134 @@ def parse_data(
 
     Regardless, the highest complexity is :
     O(N x M) + O(K x L)
-    """
-    # connected to database
-    connection = sqlite3.connect("EHR.db")  # O(1)
 
-    lab_dict = lab_file_to_dict(lab_filename, connection, "EHR.db")  # O(K x L)
-    patient_dict = patient_file_to_dict(
-        patient_filename, lab_dict, connection, "EHR.db"
-    )  # O(N x M)
+    With hydrated=True the returned Patient and Lab objects cache
+    their whole row on first access instead of querying the
+    database for every property read.
+
+    Once both tables are loaded the secondary indexes in indexes are
+    built, see build_indexes. Pass indexes=None to skip them.
+
+    Both files are streamed into the database batch_size rows at a
+    time, which bounds the memory spent on pending rows.
+
+    With incremental=True the tables are not rebuilt. Only the lab
+    rows appended since the previous call are ingested, see
+    lab_file_append, and patient rows are upserted when the patient
+    file changed, see patient_file_upsert. Files that were rewritten
+    rather than appended to are reloaded in full.
+
+    With workers > 1 the lab file is parsed by that many processes,
+    see lab_file_to_dict_parallel. The result is the same as with a
+    single worker.
+
+    db is where the tables are written and where the returned objects
+    read from: the path of a database file (EHR.db in the working
+    directory by default), ":memory:", an SQLite URI such as
+    connection_pool.shared_memory_uri(name), or an open connection.
+    snapshot_to names a file that receives a copy of the finished
+    database, see snapshot_database, which is how an in-memory build
+    is saved to disk.
+
+    With lazy=True no Patient or Lab objects are built during the
+    ingest. A PatientMapping and a LabMapping over the database are
+    returned instead, which build the objects on lookup, so
+    patient_dict[patient_id].labs still works while memory stays
+    bounded however many labs were loaded.
+
+    With bulk_load=True both tables and their indexes are written in
+    a single transaction under BULK_LOAD_PRAGMAS, see bulk_loading.
+    That trades durability for speed: a crash during the load can
+    leave the database unusable, which is fine where the export can
+    simply be loaded again. The default keeps SQLite's safe settings.
+
+    With epoch_timestamps=True LABS.Date and PATIENTS.DateOfBirth are
+    stored as integer microseconds since EPOCH rather than as text.
+    Range predicates, MIN/MAX and ORDER BY on them are then integer
+    operations in SQLite, and Lab.timestamp reads them without any
+    parsing; Lab.date and Patient.dob convert to a datetime only when
+    called. Every reader in this package accepts both formats, and an
+    incremental ingest keeps the format the tables already have.
+
+    With dedup, a LabDeduplicator, lab rows repeating an earlier row
+    are not ingested, see lab_file_to_dict; dedup.dropped then holds
+    how many were left out.
+    """
+    if db == ":memory:":
+        # a private in-memory database only exists for one connection
+        db = sqlite3.connect(db, check_same_thread=False)  # O(1)
+    name_db = db if isinstance(db, str) else database_name(db)  # O(1)
+    # pooled connections to a deleted or replaced file cannot write
+    refresh_pool(name_db)  # O(1)
 
-    connection.close()  # O(1)
+    # connected to database
+    with connection_for(db) as connection:  # O(1)
+        collect = not lazy  # O(1)
+        loading = bulk_loading(connection) if bulk_load else nullcontext()
+        with loading:  # O(1)
+            if incremental:
+                lab_dict = lab_file_append(
+                    lab_filename,
+                    connection,
+                    name_db,
+                    hydrated,
+                    batch_size,
+                    collect=collect,
+                    epoch_timestamps=epoch_timestamps,
+                    dedup=dedup,
+                )  # O(T x L)
+                patient_dict = patient_file_upsert(
+                    patient_filename,
+                    lab_dict,
+                    connection,
+                    name_db,
+                    hydrated,
+                    batch_size,
+                    collect,
+                    epoch_timestamps,
+                )  # O(N x M)
+            else:
+                if workers > 1:
+                    lab_dict = lab_file_to_dict_parallel(
+                        lab_filename,
+                        connection,
+                        name_db,
+                        workers,
+                        hydrated,
+                        batch_size,
+                        collect=collect,
+                        epoch_timestamps=epoch_timestamps,
+                        dedup=dedup,
+                    )  # O(K x L / workers)
+                else:
+                    lab_dict = lab_file_to_dict(
+                        lab_filename,
+                        connection,
+                        name_db,
+                        hydrated,
+                        batch_size,
+                        collect=collect,
+                        epoch_timestamps=epoch_timestamps,
+                        dedup=dedup,
+                    )  # O(K x L)
+                patient_dict = patient_file_to_dict(
+                    patient_filename,
+                    lab_dict,
+                    connection,
+                    name_db,
+                    hydrated,
+                    batch_size,
+                    collect=collect,
+                    epoch_timestamps=epoch_timestamps,
+                )  # O(N x M)
+
+            if indexes is not None:
+                build_indexes(connection, indexes)  # O(K log K)
+
+        if snapshot_to is not None:
+            snapshot_database(connection, snapshot_to)  # O(N + K)
+
+    if lazy:
+        patients = PatientMapping(name_db, hydrated)  # O(1)
+        return patients, patients.labs  # O(1)
     return patient_dict, lab_dict  # O(1)
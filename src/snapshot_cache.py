@@ -0,0 +1,716 @@
+"""Binary snapshots of ingested exports, so that restarts skip parsing.
+
+parse_data re-reads both exports, parses every timestamp and rebuilds
+the database and the object graph on every call, even when the files
+have not changed. A SnapshotCache keeps, per pair of input files, a
+snapshot of the ingested tables: a directory with one NumPy .npy
+file per table column and a manifest.json describing them.
+
+- Numbers are stored as int64 or float64 arrays, dates as
+  datetime64[us] arrays. Both directions of the date conversion are
+  vectorized, so neither saving nor restoring parses timestamps one
+  by one. The manifest lists the date columns that the database held
+  as epoch microseconds, see parse_data's epoch_timestamps, so that
+  they are restored as such.
+- Strings are dictionary-encoded: an int32 array of codes into the
+  list of distinct values, which is kept in the manifest.
+
+The columns are opened memory-mapped, so opening a snapshot reads
+only the manifest. Snapshots are keyed on the fingerprints of both
+input files, see patient_parser_v4.file_fingerprint, and on whether
+duplicate labs were dropped. Once a file changes its key changes too,
+and the old snapshot is stale.
+
+cached_parse_data is the entry point. On a hit the tables are
+restored from the columns, or left alone when the database already
+holds that very ingest, and the patient and lab dictionaries are
+rebuilt from the PatientID and Autogen_id columns. On a miss it calls
+parse_data and saves a snapshot of the result.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from contextlib import nullcontext
+from typing import Any, Iterator, Mapping
+
+import numpy as np
+import numpy.typing as npt
+
+from connection_pool import connection_for, database_name, refresh_pool
+from patient_parser_v4 import (
+    build_indexes,
+    bulk_loading,
+    commit,
+    create_lab_table,
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_INDEXES,
+    file_fingerprint,
+    FileFingerprint,
+    IndexSpec,
+    IngestState,
+    insert_batches,
+    Lab,
+    LabDeduplicator,
+    load_ingest_state,
+    parse_data,
+    Patient,
+    PATIENT_SCHEMA,
+    PatientMapping,
+    save_ingest_state,
+    snapshot_database,
+    stores_epoch_timestamps,
+)
+
+# bumped whenever the layout of a snapshot changes
+SNAPSHOT_VERSION = 1
+# total size of the snapshots a cache keeps by default, in bytes
+DEFAULT_MAX_BYTES = 1 << 30
+# unfinished snapshot directories older than this are left-overs
+STALE_TEMP_SECONDS = 3600.0
+MANIFEST = "manifest.json"
+
+# (column, kind) of every snapshotted table, in table column order
+SNAPSHOT_TABLES: dict[str, list[tuple[str, str]]] = {
+    "PATIENTS": [
+        ("ID", "str"),
+        ("Gender", "str"),
+        ("DateOfBirth", "date"),
+        ("Race", "str"),
+        ("MaritalStatus", "str"),
+        ("Language", "str"),
+        ("PovertyLevel", "float"),
+    ],
+    "LAB_NAMES": [("ID", "int"), ("Name", "str")],
+    "UNITS": [("ID", "int"), ("Unit", "str")],
+    "LAB_RESULTS": [
+        ("PatientID", "str"),
+        ("AdmissionID", "int"),
+        ("NameID", "int"),
+        ("Value", "float"),
+        ("UnitID", "int"),
+        ("Date", "date"),
+        ("Autogen_id", "int"),
+    ],
+}
+# the array type of each kind of column
+KIND_DTYPES: dict[str, np.dtype[Any]] = {
+    "str": np.dtype(np.int32),
+    "int": np.dtype(np.int64),
+    "float": np.dtype(np.float64),
+    "date": np.dtype("datetime64[us]"),
+}
+# the ingest state of each input file, by the table it was loaded into
+SOURCE_TABLES = ("PATIENTS", "LABS")
+# rows read from SQLite at a time by SnapshotCache.save
+DEFAULT_CHUNK_ROWS = 10_000
+
+
+def snapshot_key(
+    patient_fingerprint: FileFingerprint,
+    lab_fingerprint: FileFingerprint,
+    deduplicated: bool = False,
+) -> str:
+    """Return the cache key of a pair of input file fingerprints.
+
+    The ingest of a pair with its duplicate labs dropped, see
+    LabDeduplicator, holds other rows, so it has a key of its own.
+    """
+    digest = hashlib.sha256(str(SNAPSHOT_VERSION).encode())
+    for fingerprint in (patient_fingerprint, lab_fingerprint):
+        digest.update(json.dumps(list(fingerprint)).encode())
+    if deduplicated:
+        digest.update(b"deduplicated")
+    return digest.hexdigest()[:32]
+
+
+def _encode_chunk(
+    values: tuple[Any, ...], kind: str, codes: dict[str, int]
+) -> npt.NDArray[Any]:
+    """Return the array of a chunk of a column, O(len(values)).
+
+    String values are replaced by their codes, and values seen for
+    the first time are given the next code in codes.
+    """
+    if kind == "str":
+        return np.fromiter(
+            (codes.setdefault(value, len(codes)) for value in values),
+            dtype=KIND_DTYPES[kind],
+            count=len(values),
+        )
+    # NumPy parses the "YYYY-MM-DD HH:MM:SS[.ffffff]" text of a date
+    # column on its own, far faster than date_parser row by row, and
+    # takes epoch microseconds as they are
+    return np.array(values, dtype=KIND_DTYPES[kind])
+
+
+def _read_table(
+    db: sqlite3.Connection, table: str, rows: int, chunk_rows: int
+) -> tuple[dict[str, npt.NDArray[Any]], dict[str, list[str]]]:
+    """Read the columns of a table of rows rows into typed arrays.
+
+    The arrays are allocated up front and filled chunk_rows rows at
+    a time, so at most one chunk of rows is held as Python objects.
+    Returns the arrays and the distinct values of the string columns,
+    in code order.
+    """
+    columns = SNAPSHOT_TABLES[table]
+    arrays = {
+        column: np.empty(rows, dtype=KIND_DTYPES[kind])
+        for column, kind in columns
+    }
+    codes: dict[str, dict[str, int]] = {
+        column: dict() for column, kind in columns if kind == "str"
+    }
+    names = ", ".join(column for column, _ in columns)
+    cursor = db.execute(f"SELECT {names} FROM {table} ORDER BY rowid")
+    start = 0
+    while chunk := cursor.fetchmany(chunk_rows):
+        end = start + len(chunk)
+        if end > rows:
+            raise ValueError(f"{table} changed while it was read")
+        for (column, kind), values in zip(columns, zip(*chunk)):
+            arrays[column][start:end] = _encode_chunk(
+                values, kind, codes.get(column, {})
+            )
+        start = end
+    if start != rows:
+        raise ValueError(f"{table} changed while it was read")
+    strings = {column: list(distinct) for column, distinct in codes.items()}
+    return arrays, strings
+
+
+def _date_text(array: npt.NDArray[np.datetime64]) -> list[str]:
+    """Return dates as the text sqlite3 stores for datetime values.
+
+    That is str(datetime): a space between the date and the time,
+    and no fraction when the microseconds are zero.
+    """
+    text = np.datetime_as_string(array, unit="us").tolist()
+    whole = (array.astype(np.int64) % 1_000_000 == 0).tolist()
+    return [
+        f"{date[:10]} {date[11:19] if no_fraction else date[11:]}"
+        for date, no_fraction in zip(text, whole)
+    ]
+
+
+def _directory_size(directory: str) -> int:
+    """Return the total size of the files in a directory, in bytes."""
+    return sum(entry.stat().st_size for entry in os.scandir(directory))
+
+
+class Snapshot:
+    """One snapshot directory, with its columns opened memory-mapped."""
+
+    def __init__(self, directory: str) -> None:
+        """Open a snapshot, checking its manifest against its columns.
+
+        Raises ValueError when the snapshot is incomplete, of another
+        version or otherwise unusable.
+        """
+        self.directory = directory
+        try:
+            with open(os.path.join(directory, MANIFEST)) as f:
+                self.manifest: dict[str, Any] = json.load(f)
+            if self.manifest["version"] != SNAPSHOT_VERSION:
+                raise ValueError("Snapshot of another version")
+            self.columns: dict[tuple[str, str], npt.NDArray[Any]] = dict()
+            for table, columns in SNAPSHOT_TABLES.items():
+                rows = self.manifest["tables"][table]["rows"]
+                for column, kind in columns:
+                    array = np.load(
+                        os.path.join(directory, f"{table}.{column}.npy"),
+                        mmap_mode="r",
+                    )
+                    expected = (rows,), KIND_DTYPES[kind]
+                    if (array.shape, array.dtype) != expected:
+                        raise ValueError(f"Bad column {table}.{column}")
+                    self.columns[table, column] = array
+        except (OSError, KeyError, TypeError) as error:
+            raise ValueError(f"Unusable snapshot {directory}") from error
+
+    @property
+    def key(self) -> str:
+        """Return the cache key of the snapshot."""
+        return str(self.manifest["key"])
+
+    @property
+    def states(self) -> dict[str, IngestState]:
+        """Return the ingest state of PATIENTS and LABS it was taken at."""
+        return {
+            table: IngestState(
+                FileFingerprint(*source["fingerprint"]), source["row_count"]
+            )
+            for table, source in self.manifest["sources"].items()
+        }
+
+    def column(self, table: str, column: str) -> npt.NDArray[Any]:
+        """Return the memory-mapped array of a column, O(1)."""
+        return self.columns[table, column]
+
+    @property
+    def deduplicated(self) -> bool:
+        """Return whether duplicate labs were dropped from the ingest."""
+        return bool(self.manifest.get("deduplicated", False))
+
+    @property
+    def duplicates_dropped(self) -> int:
+        """Return how many duplicate labs the ingest dropped."""
+        return int(self.manifest.get("duplicates_dropped", 0))
+
+    def epoch_columns(self, table: str) -> list[str]:
+        """Return the date columns of a table held as epoch microseconds."""
+        return list(self.manifest["tables"][table].get("epochs", []))
+
+    def values(
+        self, table: str, column: str, epoch_timestamps: bool | None = None
+    ) -> list[Any]:
+        """Return the decoded values of a column, O(rows).
+
+        Dates come back as SQLite held them, text or epoch
+        microseconds, unless epoch_timestamps asks for one format.
+        """
+        array = self.columns[table, column]
+        if array.dtype == KIND_DTYPES["date"]:
+            if epoch_timestamps is None:
+                epoch_timestamps = column in self.epoch_columns(table)
+            if epoch_timestamps:
+                return list(array.astype(np.int64).tolist())
+            return _date_text(array)
+        strings = self.manifest["tables"][table]["strings"].get(column)
+        if strings is not None:
+            decoded: list[Any] = np.array(strings, dtype=object)[
+                array
+            ].tolist()
+            return decoded
+        return list(array.tolist())
+
+    def rows(
+        self, table: str, epoch_timestamps: bool | None = None
+    ) -> Iterator[tuple[Any, ...]]:
+        """Yield the rows of a table, in table column order."""
+        columns = SNAPSHOT_TABLES[table]
+        return zip(
+            *[
+                self.values(table, column, epoch_timestamps)
+                for column, _ in columns
+            ]
+        )
+
+    def is_current(
+        self, db: sqlite3.Connection, epoch_timestamps: bool | None = None
+    ) -> bool:
+        """Return whether db already holds the ingest of this snapshot.
+
+        With epoch_timestamps set, the dates in db must be stored in
+        that format as well.
+        """
+        tables = {
+            row[0]
+            for row in db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+        }
+        if not tables.issuperset(SNAPSHOT_TABLES):
+            return False
+        if epoch_timestamps is not None and any(
+            stores_epoch_timestamps(db, table, column)
+            not in (None, epoch_timestamps)
+            for table, columns in SNAPSHOT_TABLES.items()
+            for column, kind in columns
+            if kind == "date"
+        ):
+            return False
+        return all(
+            load_ingest_state(db, table) == state
+            for table, state in self.states.items()
+        )
+
+    def restore(
+        self,
+        db: sqlite3.Connection,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        epoch_timestamps: bool | None = None,
+    ) -> None:
+        """Rebuild PATIENTS and the lab tables of db from the columns.
+
+        No file is read and no timestamp is parsed; the rows are
+        inserted batch_size at a time and committed with the ingest
+        states, so that is_current holds afterwards. O(N + K).
+
+        The dates are written in the format they were saved in, or as
+        epoch_timestamps asks.
+        """
+        db.execute("DROP TABLE IF EXISTS PATIENTS")
+        db.execute(PATIENT_SCHEMA)
+        create_lab_table(db)
+        cursor = db.cursor()
+        for table, columns in SNAPSHOT_TABLES.items():
+            names = ", ".join(column for column, _ in columns)
+            placeholders = ", ".join("?" for _ in columns)
+            insert_batches(
+                cursor,
+                f"INSERT INTO {table} ({names}) VALUES({placeholders})",
+                self.rows(table, epoch_timestamps),
+                batch_size,
+            )
+        for table, state in self.states.items():
+            save_ingest_state(db, table, state.fingerprint, state.row_count)
+        commit(db)
+
+    def objects(
+        self, db_name: str, hydrated: bool = False
+    ) -> tuple[dict[str, Patient], dict[str, list[Lab]]]:
+        """Rebuild the dictionaries that parse_data returned, O(N + K).
+
+        As with parse_data, the labs of a patient are in ingest order
+        and the patients in the order of the patient file.
+        """
+        lab_dict: dict[str, list[Lab]] = dict()
+        for patient_id, autogen_id in zip(
+            self.values("LAB_RESULTS", "PatientID"),
+            self.column("LAB_RESULTS", "Autogen_id").tolist(),
+        ):
+            lab = Lab(autogen_id, db_name, hydrated)
+            labs = lab_dict.get(patient_id)
+            if labs is None:
+                lab_dict[patient_id] = [lab]
+            else:
+                labs.append(lab)
+
+        patient_dict = {
+            patient_id: Patient(
+                patient_id, db_name, lab_dict.get(patient_id, []), hydrated
+            )
+            for patient_id in self.values("PATIENTS", "ID")
+        }
+        return patient_dict, lab_dict
+
+
+class SnapshotCache:
+    """Directory of snapshots, bounded to max_bytes in total.
+
+    Every snapshot is written to a temporary directory and renamed
+    into place, so concurrent workers only ever see whole snapshots.
+    When the cache outgrows max_bytes, the least recently loaded
+    snapshots are evicted first.
+    """
+
+    def __init__(
+        self, directory: str, max_bytes: int = DEFAULT_MAX_BYTES
+    ) -> None:
+        """Initialize a cache in directory, creating it if needed."""
+        if max_bytes < 0:
+            raise ValueError("The size limit cannot be negative")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        """Return the directory of the snapshot with key."""
+        return os.path.join(self.directory, key)
+
+    def keys(self) -> list[str]:
+        """Return the keys of the stored snapshots."""
+        return sorted(
+            entry.name
+            for entry in os.scandir(self.directory)
+            if entry.is_dir() and not entry.name.startswith(".")
+        )
+
+    def size(self) -> int:
+        """Return the total size of the stored snapshots, in bytes."""
+        return sum(_directory_size(self._path(key)) for key in self.keys())
+
+    def load(
+        self,
+        patient_filename: str,
+        lab_filename: str,
+        deduplicated: bool = False,
+    ) -> Snapshot | None:
+        """Return the snapshot of the current input files, if any.
+
+        With deduplicated=True, that is the snapshot of an ingest that
+        dropped duplicate labs, otherwise of one that kept them. The
+        files are fingerprinted, which reads O(1) bytes of each. A
+        snapshot that fails validation is removed and treated as a
+        miss.
+        """
+        patient_fingerprint = file_fingerprint(patient_filename)
+        lab_fingerprint = file_fingerprint(lab_filename)
+        directory = self._path(
+            snapshot_key(patient_fingerprint, lab_fingerprint, deduplicated)
+        )
+        if not os.path.isdir(directory):
+            return None
+        try:
+            snapshot = Snapshot(directory)
+            states = snapshot.states
+            if (
+                states["PATIENTS"].fingerprint != patient_fingerprint
+                or states["LABS"].fingerprint != lab_fingerprint
+                or snapshot.deduplicated != deduplicated
+            ):
+                raise ValueError(f"Mislabelled snapshot {directory}")
+        except (ValueError, KeyError):
+            shutil.rmtree(directory, ignore_errors=True)
+            return None
+        # the manifest's modification time orders the eviction
+        os.utime(os.path.join(directory, MANIFEST))
+        return snapshot
+
+    def save(
+        self,
+        patient_filename: str,
+        lab_filename: str,
+        db: sqlite3.Connection,
+        dedup: LabDeduplicator | None = None,
+        chunk_rows: int = DEFAULT_CHUNK_ROWS,
+    ) -> Snapshot | None:
+        """Snapshot the tables that db ingested from the two files.
+
+        The snapshot is keyed on the fingerprints db recorded for them
+        in INGEST_STATE, so it describes exactly what was loaded. Pass
+        the LabDeduplicator of an ingest that dropped duplicate labs:
+        the snapshot is then keyed as deduplicated and records how
+        many labs were dropped.
+        Nothing is read or stored, and None returned, when the
+        snapshot alone would exceed max_bytes. The columns are read
+        straight into their arrays, chunk_rows rows at a time, and
+        written table by table, so the memory used is that of the
+        arrays of one table plus one chunk of rows. Stale and
+        least recently used snapshots are evicted afterwards, see
+        evict. O(N + K).
+        """
+        states = {
+            table: load_ingest_state(db, table) for table in SOURCE_TABLES
+        }
+        patient_state, lab_state = states["PATIENTS"], states["LABS"]
+        if patient_state is None or lab_state is None:
+            raise ValueError("The database holds no ingest to snapshot")
+        key = snapshot_key(
+            patient_state.fingerprint,
+            lab_state.fingerprint,
+            dedup is not None,
+        )
+
+        manifest: dict[str, Any] = {
+            "version": SNAPSHOT_VERSION,
+            "key": key,
+            "created": time.time(),
+            "deduplicated": dedup is not None,
+            "duplicates_dropped": 0 if dedup is None else dedup.dropped,
+            "sources": {
+                "PATIENTS": {
+                    "path": os.path.abspath(patient_filename),
+                    "fingerprint": list(patient_state.fingerprint),
+                    "row_count": patient_state.row_count,
+                },
+                "LABS": {
+                    "path": os.path.abspath(lab_filename),
+                    "fingerprint": list(lab_state.fingerprint),
+                    "row_count": lab_state.row_count,
+                },
+            },
+            "tables": dict(),
+        }
+        counts = {
+            table: db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in SNAPSHOT_TABLES
+        }
+        size = sum(
+            counts[table] * KIND_DTYPES[kind].itemsize
+            for table, columns in SNAPSHOT_TABLES.items()
+            for _, kind in columns
+        )
+        if size > self.max_bytes:
+            return None
+
+        staging = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+        try:
+            # one table's arrays are held at a time
+            for table, columns in SNAPSHOT_TABLES.items():
+                arrays, strings = _read_table(
+                    db, table, counts[table], chunk_rows
+                )
+                for column, array in arrays.items():
+                    np.save(
+                        os.path.join(staging, f"{table}.{column}.npy"), array
+                    )
+                del arrays
+                manifest["tables"][table] = {
+                    "rows": counts[table],
+                    "strings": strings,
+                    "epochs": [
+                        column
+                        for column, kind in columns
+                        if kind == "date"
+                        and stores_epoch_timestamps(db, table, column)
+                    ],
+                }
+            with open(os.path.join(staging, MANIFEST), "w") as f:
+                json.dump(manifest, f)
+            try:
+                os.replace(staging, self._path(key))
+            except OSError:
+                # another worker saved the same snapshot first
+                if not os.path.isdir(self._path(key)):
+                    raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict(keep=key)
+        return Snapshot(self._path(key))
+
+    def evict(self, keep: str | None = None) -> list[str]:
+        """Remove stale snapshots, then old ones beyond max_bytes.
+
+        A snapshot is stale when it cannot be read, or when one of the
+        files it was taken from is gone or has changed since. Then,
+        while the cache is larger than max_bytes, the least recently
+        loaded snapshot other than keep is removed. Unfinished
+        snapshots older than STALE_TEMP_SECONDS are cleaned up too.
+        Returns the keys that were removed.
+        """
+        removed = []
+        sizes: dict[str, int] = dict()
+        last_used: dict[str, float] = dict()
+        for key in self.keys():
+            directory = self._path(key)
+            try:
+                with open(os.path.join(directory, MANIFEST)) as f:
+                    sources = json.load(f)["sources"]
+                stale = any(
+                    not os.path.exists(source["path"])
+                    or list(file_fingerprint(source["path"]))
+                    != source["fingerprint"]
+                    for source in sources.values()
+                )
+            except (OSError, ValueError, KeyError, TypeError):
+                stale = True
+            if stale and key != keep:
+                shutil.rmtree(directory, ignore_errors=True)
+                removed.append(key)
+                continue
+            sizes[key] = _directory_size(directory)
+            manifest = os.path.join(directory, MANIFEST)
+            last_used[key] = os.path.getmtime(manifest)
+
+        total = sum(sizes.values())
+        for key in sorted(last_used, key=last_used.__getitem__):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._path(key), ignore_errors=True)
+            removed.append(key)
+            total -= sizes[key]
+
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if (
+                entry.name.startswith(".tmp-")
+                and now - entry.stat().st_mtime > STALE_TEMP_SECONDS
+            ):
+                shutil.rmtree(entry.path, ignore_errors=True)
+        return removed
+
+    def clear(self) -> None:
+        """Remove every snapshot."""
+        for key in self.keys():
+            shutil.rmtree(self._path(key), ignore_errors=True)
+
+
+def cached_parse_data(
+    patient_filename: str,
+    lab_filename: str,
+    cache: SnapshotCache | str,
+    hydrated: bool = False,
+    indexes: dict[str, IndexSpec] | None = DEFAULT_INDEXES,
+    db: str | sqlite3.Connection = "EHR.db",
+    lazy: bool = False,
+    bulk_load: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    incremental: bool = False,
+    workers: int = 1,
+    snapshot_to: str | None = None,
+    epoch_timestamps: bool | None = None,
+    dedup: LabDeduplicator | None = None,
+) -> tuple[Mapping[str, Patient], Mapping[str, list[Lab]]]:
+    """Return what parse_data returns, from a snapshot when possible.
+
+    cache is a SnapshotCache or the directory of one. On a miss the
+    files are parsed by parse_data, with the same options, and a
+    snapshot of the result is saved. On a hit the files are not
+    parsed: the tables are restored from the snapshot unless db
+    already holds them, the indexes that db lacks are built, and the
+    dictionaries come from the snapshot's columns.
+
+    The options mean what they mean to parse_data, on a hit too:
+    the tables are restored batch_size rows at a time, bulk_load
+    applies to the restore, and the database is copied to
+    snapshot_to. incremental and workers only change how a miss
+    parses the files; on a hit there is nothing to parse, and the
+    tables end up the same. epoch_timestamps restores the dates in
+    the requested format, whatever the format of the ingest the
+    snapshot was taken from; None keeps that format on a hit and
+    stores text on a miss, as parse_data does by default.
+
+    With dedup, only a snapshot of an ingest that dropped duplicate
+    labs is a hit, and without it only one of an ingest that kept
+    them. On a hit dedup.dropped and dedup.kept are set to the
+    counts of the ingest the snapshot was taken from.
+    """
+    if isinstance(cache, str):
+        cache = SnapshotCache(cache)
+    if db == ":memory:":
+        # kept open, so that the snapshot is taken from the same database
+        db = sqlite3.connect(db, check_same_thread=False)
+
+    snapshot = cache.load(patient_filename, lab_filename, dedup is not None)
+    if snapshot is None:
+        result = parse_data(
+            patient_filename,
+            lab_filename,
+            hydrated,
+            indexes,
+            batch_size,
+            incremental,
+            workers,
+            db,
+            snapshot_to,
+            lazy,
+            bulk_load,
+            bool(epoch_timestamps),
+            dedup,
+        )
+        with connection_for(db) as connection:
+            cache.save(patient_filename, lab_filename, connection, dedup)
+        return result
+
+    if dedup is not None:
+        dedup.clear()
+        dedup.dropped = snapshot.duplicates_dropped
+        dedup.kept = snapshot.manifest["tables"]["LAB_RESULTS"]["rows"]
+
+    name_db = db if isinstance(db, str) else database_name(db)
+    refresh_pool(name_db)
+    with connection_for(db) as connection:
+        if not snapshot.is_current(connection, epoch_timestamps):
+            loading = bulk_loading(connection) if bulk_load else nullcontext()
+            with loading:
+                snapshot.restore(connection, batch_size, epoch_timestamps)
+                if indexes is not None:
+                    build_indexes(connection, indexes)
+        elif indexes is not None:
+            # build_indexes skips the indexes that already exist
+            build_indexes(connection, indexes)
+        if snapshot_to is not None:
+            snapshot_database(connection, snapshot_to)
+
+    if lazy:
+        patients = PatientMapping(name_db, hydrated)
+        return patients, patients.labs
+    return snapshot.objects(name_db, hydrated)
@@ -0,0 +1,143 @@
+"""Deterministic synthetic patient and lab files for benchmarks.
+
+The files follow the layout of the real exports: tab-delimited, a
+header line first and timestamps as YYYY-MM-DD hh:mm:ss.mmm. The
+number of labs per patient is skewed like in practice, where a few
+chronically ill patients account for a large share of all tests.
+"""
+import datetime as dt
+import pathlib
+import random
+
+PATIENT_HEADER = [
+    "PatientID",
+    "PatientGender",
+    "PatientDateOfBirth",
+    "PatientRace",
+    "PatientMaritalStatus",
+    "PatientLanguage",
+    "PatientPopulationPercentageBelowPoverty",
+]
+LAB_HEADER = [
+    "PatientID",
+    "AdmissionID",
+    "LabName",
+    "LabValue",
+    "LabUnits",
+    "LabDateTime",
+]
+
+# lab name, unit, mean and standard deviation of the values
+LAB_TESTS = [
+    ("METABOLIC: ALBUMIN", "gm/dL", 4.0, 0.6),
+    ("METABOLIC: GLUCOSE", "mg/dL", 110.0, 30.0),
+    ("METABOLIC: SODIUM", "mmol/L", 139.0, 4.0),
+    ("METABOLIC: POTASSIUM", "mmol/L", 4.3, 0.5),
+    ("METABOLIC: CREATININE", "mg/dL", 1.0, 0.4),
+    ("CBC: HEMOGLOBIN", "gm/dl", 13.5, 1.8),
+    ("CBC: WHITE BLOOD CELL COUNT", "k/cumm", 7.5, 2.5),
+    ("CBC: PLATELET COUNT", "k/cumm", 250.0, 60.0),
+    ("URINALYSIS: PH", "no unit", 6.0, 0.8),
+    ("METABOLIC: URINE PROTEIN", "gm/dL", 3.0, 1.5),
+]
+GENDERS = ["Male", "Female"]
+RACES = ["White", "Black", "Asian", "Unknown"]
+MARITAL_STATUSES = ["Married", "Single", "Divorced", "Separated", "Unknown"]
+LANGUAGES = ["English", "Spanish", "Icelandic", "Unknown"]
+
+# average number of labs per patient
+LABS_PER_PATIENT = 20
+# labs drawn at once in one admission share a timestamp
+LABS_PER_PANEL = 5
+
+_EPOCH = dt.datetime(1990, 1, 1)
+
+
+def _timestamp(moment: dt.datetime) -> str:
+    """Format a datetime like the exports, with milliseconds."""
+    return moment.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+
+def write_synthetic_ehr(
+    dirname: str,
+    n_labs: int,
+    seed: int = 0,
+    labs_per_patient: int = LABS_PER_PATIENT,
+) -> tuple[str, str]:
+    """Write a patient file and a lab file with n_labs lab rows.
+
+    There are n_labs // labs_per_patient patients (at least one).
+    Every lab row picks its patient with a Pareto-distributed weight,
+    so most patients have a few labs and a few have hundreds. Each
+    patient has at least one lab, so every patient can be parsed.
+    The same arguments always produce the same files.
+
+    Returns the paths of the patient file and the lab file. Both are
+    written line by line, so memory use does not grow with n_labs
+    beyond the per-patient counts.
+    """
+    rng = random.Random(seed)
+    n_patients = max(1, min(n_labs, n_labs // labs_per_patient))
+    patient_ids = [f"{index:08d}" for index in range(1, n_patients + 1)]
+
+    # every patient gets one lab, the rest follow the skewed weights
+    weights = [rng.paretovariate(1.5) for _ in patient_ids]
+    counts = [1] * n_patients
+    for index in rng.choices(
+        range(n_patients), weights, k=max(0, n_labs - n_patients)
+    ):
+        counts[index] += 1
+
+    directory = pathlib.Path(dirname)
+    patient_file = directory / "synthetic_patients.txt"
+    lab_file = directory / "synthetic_labs.txt"
+
+    with open(patient_file, "w") as f:
+        f.write("\t".join(PATIENT_HEADER))
+        for patient_id in patient_ids:
+            dob = _EPOCH - dt.timedelta(
+                days=rng.uniform(5 * 365, 90 * 365),
+                milliseconds=rng.randrange(86_400_000),
+            )
+            f.write(
+                "\n"
+                + "\t".join(
+                    [
+                        patient_id,
+                        rng.choice(GENDERS),
+                        _timestamp(dob),
+                        rng.choice(RACES),
+                        rng.choice(MARITAL_STATUSES),
+                        rng.choice(LANGUAGES),
+                        f"{rng.uniform(0, 40):.2f}",
+                    ]
+                )
+            )
+
+    with open(lab_file, "w") as f:
+        f.write("\t".join(LAB_HEADER))
+        for patient_id, count in zip(patient_ids, counts):
+            admission_id = 0
+            drawn = dt.datetime.min
+            for lab_index in range(count):
+                if lab_index % LABS_PER_PANEL == 0:
+                    admission_id += 1
+                    drawn = _EPOCH + dt.timedelta(
+                        seconds=rng.uniform(0, 30 * 365 * 86_400)
+                    )
+                name, unit, mean, std = rng.choice(LAB_TESTS)
+                f.write(
+                    "\n"
+                    + "\t".join(
+                        [
+                            patient_id,
+                            str(admission_id),
+                            name,
+                            f"{max(0.0, rng.gauss(mean, std)):.2f}",
+                            unit,
+                            _timestamp(drawn),
+                        ]
+                    )
+                )
+
+    return str(patient_file), str(lab_file)
@@ -0,0 +1,90 @@
+"""Memory-mapped reader for the tab-delimited patient and lab exports.
+
+Reading an export line by line through a text-mode file object costs
+a read call and a decoded string per line, and picking the columns by
+name through dict(zip(header, fields)) adds a dictionary per row. Here
+the file is memory-mapped instead, so the operating system pages it
+in without any read calls. It is decoded in newline-aligned blocks,
+which is cheaper than decoding field by field in Python. Each line is
+split only up to the last column that is needed, and the needed
+columns are picked by position with one operator.itemgetter call.
+"""
+import codecs
+import mmap
+import operator
+from typing import Callable, Iterator, Sequence
+
+# bytes decoded at once, rounded up to the end of a line
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+
+def read_header(buffer: bytes | mmap.mmap) -> tuple[list[str], int]:
+    """Return the header's column names and the offset of the first row.
+
+    A UTF-8 byte order mark at the start of the file is skipped here,
+    once, instead of being decoded with every line.
+    """
+    start = len(codecs.BOM_UTF8) if buffer[:3] == codecs.BOM_UTF8 else 0
+    newline = buffer.find(b"\n", start)
+    body = len(buffer) if newline < 0 else newline + 1
+    header = bytes(buffer[start:body]).decode("UTF-8")
+    return header.strip().split("\t"), body
+
+
+def column_picker(
+    header: list[str], columns: Sequence[str]
+) -> tuple[Callable[[list[str]], tuple[str, ...]], int]:
+    """Return a function picking columns out of split fields, in order.
+
+    The second value is the position of the last of those columns,
+    beyond which a line does not need to be split. A column missing
+    from the header raises KeyError, like the lookup by name did.
+    """
+    positions = {name: index for index, name in enumerate(header)}
+    indices = [positions[name] for name in columns]
+    getter = operator.itemgetter(*indices)
+    if len(indices) == 1:
+        return (lambda fields: (getter(fields),)), indices[0]
+    return getter, max(indices)
+
+
+def iter_rows(
+    txt_file: str,
+    columns: Sequence[str],
+    start: int | None = None,
+    end: int | None = None,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+) -> Iterator[tuple[str, ...]]:
+    """Yield the given columns of every row of a tab-delimited file.
+
+    The first line is the header. Every other non-blank line yields
+    a tuple of its fields in the order of columns, stripped like the
+    lines used to be. start and end restrict the rows to a byte range
+    of the file; start must be at the beginning of a line (or at the
+    newline ending the previous one) and end just after a newline,
+    as produced by patient_parser_v4.chunk_ranges.
+
+    The file is decoded block_size bytes (rounded up to a full line)
+    at a time, so memory use is O(block_size) however large the file
+    is. Reading it is O(R x C) for R rows and C columns.
+    """
+    with open(txt_file, "rb") as f:
+        if not f.seek(0, 2):
+            raise ValueError(f"{txt_file} is empty, expected a header line")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            header, body = read_header(buffer)
+            pick, last = column_picker(header, columns)
+
+            position = body if start is None else max(start, body)
+            stop = len(buffer) if end is None else min(end, len(buffer))
+            while position < stop:
+                block_end = buffer.find(
+                    b"\n", min(position + block_size, stop) - 1, stop
+                )
+                block_end = stop if block_end < 0 else block_end + 1
+                text = buffer[position:block_end].decode("UTF-8")
+                for line in text.split("\n"):
+                    line = line.strip()
+                    if line:
+                        yield pick(line.split("\t", last + 1))
+                position = block_end
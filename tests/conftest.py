@@ -0,0 +1,16 @@
+"""Fixtures shared by the tests."""
+import pathlib
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Run every test in a directory of its own.
+
+    parse_data writes EHR.db to the working directory by default, so
+    the database of a test is never left behind in the repository.
+    """
+    monkeypatch.chdir(tmp_path)
@@ -0,0 +1,66 @@
+"""Sample patient and lab tables shared by the ehr_utils tests."""
+
+PATIENT_TABLE = [
+    [
+        "PatientID",
+        "PatientGender",
+        "PatientDateOfBirth",
+        "PatientRace",
+        "PatientMaritalStatus",
+        "PatientLanguage",
+        "PatientPopulationPercentageBelowPoverty",
+    ],
+    [
+        "1",
+        "Male",
+        "1947-12-28 02:45:40.547",
+        "White",
+        "Married",
+        "English",
+        "0.1",
+    ],
+    [
+        "2",
+        "Female",
+        "1999-11-30 03:40:20.247",
+        "Black",
+        "Single",
+        "Spanish",
+        "16.09",
+    ],
+]
+
+LAB_TABLE = [
+    [
+        "PatientID",
+        "AdmissionID",
+        "LabName",
+        "LabValue",
+        "LabUnits",
+        "LabDateTime",
+    ],
+    [
+        "1",
+        "1",
+        "METABOLIC: ALBUMIN",
+        "3.1",
+        "gm/dL",
+        "1992-07-01 08:10:42.320",
+    ],
+    [
+        "1",
+        "3",
+        "METABOLIC: ALBUMIN",
+        "3.9",
+        "gm/dL",
+        "2011-12-19 02:49:23.900",
+    ],
+    [
+        "2",
+        "1",
+        "METABOLIC: URINE PROTEIN",
+        "3.9",
+        "gm/dL",
+        "2011-12-19 02:49:23.900",
+    ],
+]
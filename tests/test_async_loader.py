@@ -0,0 +1,100 @@
+"""Test the async lookups."""
+import asyncio
+import pathlib
+import sqlite3
+import tempfile
+
+import pytest
+
+import async_loader
+import instrumentation
+from cohort import CohortQuery
+from connection_pool import close_pool, configure_read_only
+from ehr_tables import LAB_TABLE, PATIENT_TABLE
+from fake_files import fake_files
+from patient_parser_v4 import Lab, parse_data
+
+
+def test_async_lookups() -> None:
+    """Test that concurrent lookups are batched and agree with sync ones."""
+    with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+        patient_dict, lab_dict = parse_data(files[0], files[1], db=":memory:")
+        expected, _ = parse_data(files[0], files[1])
+    labs = [lab for labs in lab_dict.values() for lab in labs]
+
+    async def lookups() -> None:
+        records = await asyncio.gather(*[lab.aload() for lab in labs])
+        assert [record.value for record in records] == [3.1, 3.9, 3.9]
+        assert all(lab.hydrated for lab in labs)
+
+        patients = await asyncio.gather(
+            *[patient.aload() for patient in patient_dict.values()]
+        )
+        assert [patient.race for patient in patients] == ["White", "Black"]
+
+        sick = await asyncio.gather(
+            patient_dict["1"].ais_sick("METABOLIC: ALBUMIN", ">", 3.6),
+            patient_dict["2"].ais_sick("METABOLIC: URINE PROTEIN", "<", 3.6),
+        )
+        assert list(sick) == [
+            expected["1"].is_sick("METABOLIC: ALBUMIN", ">", 3.6),
+            expected["2"].is_sick("METABOLIC: URINE PROTEIN", "<", 3.6),
+        ]
+        with pytest.raises(ValueError):
+            await patient_dict["2"].ais_sick("METABOLIC: ALBUMIN", ">", 3.6)
+        with pytest.raises(KeyError):
+            await Lab(99, labs[0].db_name).aload()
+
+    with instrumentation.instrumented() as stats:
+        asyncio.run(lookups())
+    # three labs, two patients, two plus one lab hydrations, one miss
+    assert stats.counters["async_lookups"] == 9
+    assert stats.counters["async_batches"] == 5
+
+
+def test_async_cohort() -> None:
+    """Test that the async cohort iterator pages through the results."""
+    with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+        patient_dict, _ = parse_data(files[0], files[1])
+    db_name = patient_dict["1"].db_name
+
+    async def collect(query: CohortQuery, page_size: int) -> list[str]:
+        return [
+            patient_id
+            async for patient_id in query.apatient_ids(db_name, page_size)
+        ]
+
+    everyone = CohortQuery()
+    assert asyncio.run(collect(everyone, 1)) == ["1", "2"]
+    assert asyncio.run(collect(everyone, 2)) == ["1", "2"]
+    female = CohortQuery().demographics(gender="Female")
+    assert asyncio.run(collect(female, 10)) == list(
+        female.patient_ids(db_name)
+    )
+
+
+def test_async_read_mode() -> None:
+    """Test that the workers use the pool and its read mode."""
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        db_name = str(pathlib.Path(tmpdirname) / "async.db")
+        with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+            patient_dict, _ = parse_data(files[0], files[1], db=db_name)
+        pool = configure_read_only(db_name)
+        async_loader.configure_executor(2)
+
+        def write(connection: sqlite3.Connection) -> None:
+            connection.execute("DELETE FROM PATIENTS")
+
+        async def lookups() -> None:
+            await patient_dict["1"].aload()
+            with pytest.raises(sqlite3.OperationalError):
+                await async_loader.run_query(db_name, write)
+
+        with instrumentation.instrumented() as stats:
+            asyncio.run(lookups())
+        assert stats.counters["connections_opened"] >= 1
+        assert pool._open >= 1
+        async_loader.shutdown()
+        assert pool._open == 0
+        assert patient_dict["1"].gender == "Male"
+        close_pool(db_name)
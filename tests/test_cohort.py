@@ -0,0 +1,177 @@
+"""Test the cohort-level query functions."""
+import datetime as dt
+
+import pytest
+
+from cohort import (
+    cohort_age_at_first_admission,
+    cohort_ages,
+    cohort_is_sick,
+    CohortQuery,
+)
+from ehr_tables import LAB_TABLE, PATIENT_TABLE
+from fake_files import fake_files
+from patient_parser_v4 import parse_data
+
+
+def test_cohort_is_sick() -> None:
+    """Test that cohort_is_sick agrees with Patient.is_sick."""
+    with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+        patient_dict, lab_dict = parse_data(files[0], files[1])
+    db_name = patient_dict["1"].db_name
+
+    albumin = cohort_is_sick(db_name, "METABOLIC: ALBUMIN", ">", 3.6)
+    assert albumin == {"1": True, "2": None}
+    assert albumin["1"] == patient_dict["1"].is_sick(
+        "METABOLIC: ALBUMIN", ">", 3.6
+    )
+    with pytest.raises(ValueError):
+        patient_dict["2"].is_sick("METABOLIC: ALBUMIN", ">", 3.6)
+
+    protein = cohort_is_sick(
+        db_name, "METABOLIC: URINE PROTEIN", "<", 5.0, patient_ids=["2"]
+    )
+    assert protein == {"2": True}
+
+    unknown = cohort_is_sick(
+        db_name, "METABOLIC: ALBUMIN", "<", 5.0, patient_ids=["1", "3"]
+    )
+    assert unknown == {"1": True, "3": None}
+
+    with pytest.raises(ValueError):
+        cohort_is_sick(db_name, "METABOLIC: ALBUMIN", ">=", 3.6)
+
+
+def test_cohort_is_sick_latest_tie() -> None:
+    """Test that the first ingested lab wins a tie on the latest date."""
+    lab_table = LAB_TABLE + [
+        [
+            "1",
+            "4",
+            "METABOLIC: ALBUMIN",
+            "2.0",
+            "gm/dL",
+            "2011-12-19 02:49:23.900",
+        ]
+    ]
+    with fake_files(PATIENT_TABLE, lab_table) as files:
+        patient_dict, lab_dict = parse_data(files[0], files[1])
+
+    result = cohort_is_sick(
+        patient_dict["1"].db_name, "METABOLIC: ALBUMIN", ">", 3.6
+    )
+    assert result["1"] == patient_dict["1"].is_sick(
+        "METABOLIC: ALBUMIN", ">", 3.6
+    )
+    assert result["1"] is True
+
+
+def test_cohort_ages() -> None:
+    """Test that cohort_ages agrees with the Patient age properties."""
+    with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+        patient_dict, lab_dict = parse_data(files[0], files[1])
+    db_name = patient_dict["1"].db_name
+
+    ages = {row.patient_id: row for row in cohort_ages(db_name)}
+    assert set(ages) == {"1", "2"}
+    for patient_id, patient in patient_dict.items():
+        assert ages[patient_id].dob == patient.dob
+        assert ages[patient_id].age == patient.age
+        assert (
+            ages[patient_id].age_at_first_admission
+            == patient.age_at_first_admission
+        )
+    assert ages["1"].first_admission == dt.datetime(
+        1992, 7, 1, 8, 10, 42, 320000
+    )
+    assert ages["2"].first_admission == dt.datetime(
+        2011, 12, 19, 2, 49, 23, 900000
+    )
+    assert cohort_age_at_first_admission(db_name) == {
+        patient_id: patient.age_at_first_admission
+        for patient_id, patient in patient_dict.items()
+    }
+
+    # unknown patients are skipped, duplicates are reported once
+    filtered = list(cohort_ages(db_name, patient_ids=["2", "3", "2"]))
+    assert [row.patient_id for row in filtered] == ["2"]
+
+    # ages are measured from the given time
+    then = dt.datetime(2000, 1, 1)
+    ages = {row.patient_id: row for row in cohort_ages(db_name, now=then)}
+    assert ages["1"].age == 2000 - ages["1"].dob.year
+    assert ages["1"].age_at_first_admission == 1992 - ages["1"].dob.year
+
+
+def test_cohort_query() -> None:
+    """Test that CohortQuery selects the patients the properties would."""
+    with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+        patient_dict, lab_dict = parse_data(files[0], files[1])
+    db_name = patient_dict["1"].db_name
+    now = dt.datetime(2020, 6, 1)
+
+    def select(query: CohortQuery) -> list[str]:
+        return list(query.patient_ids(db_name))
+
+    assert select(CohortQuery()) == ["1", "2"]
+    assert select(CohortQuery().demographics(gender="Male")) == ["1"]
+    assert select(
+        CohortQuery().demographics(race=["White", "Black"], language="Spanish")
+    ) == ["2"]
+    assert select(CohortQuery(now).age_between(min_age=73)) == ["1"]
+    assert select(CohortQuery(now).age_between(min_age=74)) == []
+    assert select(CohortQuery(now).age_between(21, 21)) == ["2"]
+    assert select(CohortQuery().poverty_between(1.0, 20.0)) == ["2"]
+    assert select(CohortQuery().poverty_between(maximum=0.1)) == ["1"]
+
+    albumin = "METABOLIC: ALBUMIN"
+    assert select(CohortQuery().lab(albumin, ">", 3.6)) == ["1"]
+    assert select(CohortQuery().lab(albumin, "<", 3.5)) == []
+    assert select(CohortQuery().lab(albumin, "<", 3.5, mode="any")) == ["1"]
+    assert select(CohortQuery().lab(albumin, ">", 3.0, mode="all")) == ["1"]
+    assert select(CohortQuery().lab(albumin, ">", 3.5, mode="all")) == []
+    assert select(
+        CohortQuery().lab("METABOLIC: URINE PROTEIN", "<=", 3.9, mode="all")
+    ) == ["2"]
+
+    query = (
+        CohortQuery(now)
+        .demographics(gender=["Male", "Female"])
+        .age_between(max_age=80)
+        .lab(albumin, ">", 3.6)
+    )
+    assert select(query) == ["1"]
+    assert query.count(db_name) == 1
+    explanation = query.explain(db_name)
+    assert "SELECT ID FROM PATIENTS" in explanation
+    assert "idx_labs_patient_name_date" in explanation
+
+    with pytest.raises(ValueError):
+        CohortQuery().lab(albumin, "=>", 3.6)
+    with pytest.raises(ValueError):
+        CohortQuery().lab(albumin, ">", 3.6, mode="most")
+
+
+def test_cohort_epoch_timestamps() -> None:
+    """Test that epoch and text dates select the same patients."""
+    now = dt.datetime(2020, 6, 1)
+    answers = []
+    for epoch_timestamps in (False, True):
+        with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+            patient_dict, _ = parse_data(
+                files[0], files[1], epoch_timestamps=epoch_timestamps
+            )
+        db_name = patient_dict["1"].db_name
+        queries = [
+            CohortQuery(now).age_between(*ages)
+            for ages in [(73, None), (74, None), (21, 21), (None, 80)]
+        ]
+        answers.append(
+            (
+                [list(query.patient_ids(db_name)) for query in queries],
+                list(cohort_ages(db_name, now=now)),
+                cohort_is_sick(db_name, "METABOLIC: ALBUMIN", ">", 3.6),
+            )
+        )
+    assert answers[0] == answers[1]
+    assert answers[1][0] == [["1"], [], ["2"], ["1", "2"]]
@@ -0,0 +1,168 @@
+"""Test the shared connection pool."""
+import pathlib
+import sqlite3
+import tempfile
+import threading
+
+import pytest
+
+from connection_pool import (
+    close_pool,
+    configure_pool,
+    configure_read_only,
+    connection_for,
+    database_name,
+    get_pool,
+    refresh_pool,
+)
+
+
+def test_pool_reuses_connections() -> None:
+    """Test that a released connection is handed out again."""
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        db_name = str(pathlib.Path(tmpdirname) / "pool.db")
+        pool = get_pool(db_name)
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            pass
+        assert first is second
+        assert get_pool(db_name) is pool
+        close_pool(db_name)
+        assert pool.closed
+
+
+def test_pool_size_limit() -> None:
+    """Test that the pool blocks once every connection is checked out."""
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        db_name = str(pathlib.Path(tmpdirname) / "pool.db")
+        pool = configure_pool(db_name, size=1)
+        held = pool.acquire()
+        acquired = threading.Event()
+
+        def borrow() -> None:
+            with pool.connection():
+                acquired.set()
+
+        thread = threading.Thread(target=borrow)
+        thread.start()
+        assert not acquired.wait(0.1)
+        pool.release(held)
+        assert acquired.wait(5)
+        thread.join()
+        close_pool(db_name)
+
+
+def test_closed_pool_refuses_checkouts() -> None:
+    """Test that a closed pool raises instead of opening connections."""
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        db_name = str(pathlib.Path(tmpdirname) / "pool.db")
+        pool = configure_pool(db_name, size=2)
+        pool.close()
+        with pytest.raises(sqlite3.ProgrammingError):
+            pool.acquire()
+        with pytest.raises(ValueError):
+            configure_pool(db_name, size=0)
+
+
+def test_refresh_pool() -> None:
+    """Test that a pool over a replaced file is swapped for a new one."""
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        db_name = str(pathlib.Path(tmpdirname) / "pool.db")
+        pool = configure_pool(db_name, size=2)
+        refresh_pool(db_name)
+        assert get_pool(db_name) is pool
+        with pool.connection() as connection:
+            connection.execute("CREATE TABLE T (X INT)")
+        refresh_pool(db_name)
+        assert get_pool(db_name) is pool
+
+        pathlib.Path(db_name).unlink()
+        assert pool.replaced()
+        refresh_pool(db_name)
+        assert pool.closed
+        fresh = get_pool(db_name)
+        assert fresh.size == 2
+        with fresh.connection() as connection:
+            connection.execute("CREATE TABLE T (X INT)")
+        assert not fresh.replaced()
+        close_pool(db_name)
+
+
+def test_adopted_connection() -> None:
+    """Test that an adopted connection has one user at a time."""
+    connection = sqlite3.connect(":memory:", check_same_thread=False)
+    name = database_name(connection)
+    assert database_name(connection) == name
+    pool = get_pool(name)
+    acquired = threading.Event()
+
+    def borrow() -> None:
+        with pool.connection():
+            acquired.set()
+
+    with connection_for(connection) as lent:
+        assert lent is connection
+        thread = threading.Thread(target=borrow)
+        thread.start()
+        assert not acquired.wait(0.1)
+    assert acquired.wait(5)
+    thread.join()
+
+    # closed by its owner, the pool is dropped at the next adoption
+    connection.close()
+    other = sqlite3.connect(":memory:")
+    other_name = database_name(other)
+    assert pool.closed
+    with pytest.raises(sqlite3.ProgrammingError):
+        get_pool(name)
+    close_pool(other_name)
+    with pytest.raises(sqlite3.ProgrammingError):
+        other.execute("SELECT 1")
+
+
+def test_read_only_pool() -> None:
+    """Test that every thread gets its own read-only connection."""
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        db_name = str(pathlib.Path(tmpdirname) / "pool db.db")
+        with get_pool(db_name).connection() as connection:
+            connection.execute("CREATE TABLE T (X INT)")
+            connection.execute("INSERT INTO T VALUES (1)")
+            connection.commit()
+
+        pool = configure_read_only(db_name)
+        assert get_pool(db_name) is pool
+        with pool.connection() as outer:
+            with pool.connection() as inner:
+                assert inner is outer
+            assert outer.execute("SELECT X FROM T").fetchone() == (1,)
+            with pytest.raises(sqlite3.OperationalError):
+                outer.execute("INSERT INTO T VALUES (2)")
+
+        connections = []
+
+        def borrow() -> None:
+            with pool.connection() as connection:
+                connections.append(connection)
+
+        thread = threading.Thread(target=borrow)
+        thread.start()
+        thread.join()
+        assert connections[0] is not outer
+        # closed once its thread has exited
+        with pytest.raises(sqlite3.ProgrammingError):
+            connections[0].execute("SELECT X FROM T")
+        with pytest.raises(ValueError):
+            pool.adopt(outer)
+
+        with pool.connection() as held:
+            pool.close()
+            held.execute("SELECT X FROM T")
+        with pytest.raises(sqlite3.ProgrammingError):
+            held.execute("SELECT X FROM T")
+        with pytest.raises(sqlite3.ProgrammingError):
+            pool.acquire()
+        with pytest.raises(ValueError):
+            configure_read_only(":memory:")
+        configure_pool(db_name)
+        close_pool(db_name)
@@ -0,0 +1,58 @@
+"""Test the benchmark helpers."""
+from ehr_benchmark import (
+    benchmark_date_parser,
+    benchmark_scale,
+    benchmark_threads,
+    synthetic_timestamps,
+)
+from patient_parser_v4 import date_parser
+
+
+def test_synthetic_timestamps() -> None:
+    """Test that the synthetic timestamps are valid and deterministic."""
+    timestamps = synthetic_timestamps(50, 5)
+    assert timestamps == synthetic_timestamps(50, 5)
+    assert len(set(timestamps)) <= 5
+    for timestamp in timestamps:
+        assert len(timestamp) == 23
+        date_parser(timestamp)
+
+
+def test_benchmark_date_parser() -> None:
+    """Test that every parser is timed."""
+    results = benchmark_date_parser(count=100, distinct=10, repeat=1)
+    assert set(results) == {
+        "strptime_date_parser",
+        "date_parser",
+        "cached_date_parser",
+    }
+    assert all(seconds > 0 for seconds in results.values())
+
+
+def test_benchmark_scale() -> None:
+    """Test that every phase of the suite is timed and measured."""
+    results = benchmark_scale(200, sample_size=5)
+    assert results["n_labs"] == 200
+    assert results["n_patients"] == 10
+    assert set(results["phases"]) == {
+        "parse_data",
+        "parse_data_bulk",
+        "lab_properties",
+        "patient_properties",
+        "is_sick",
+        "age_at_first_admission",
+        "cohort_ages",
+        "aggregate_labs",
+    }
+    for phase in results["phases"].values():
+        assert phase["seconds"] > 0
+        assert phase["peak_memory_bytes"] > 0
+    assert results["phases"]["lab_properties"]["items"] == 5
+
+
+def test_benchmark_threads() -> None:
+    """Test that every thread count is timed."""
+    results = benchmark_threads(200, [1, 3], sample_size=5)
+    assert [result["workers"] for result in results] == [1, 3]
+    assert results[0]["speedup"] == 1.0
+    assert all(result["patients_per_second"] > 0 for result in results)
@@ -0,0 +1,86 @@
+"""Test the opt-in instrumentation."""
+import json
+import pathlib
+import tempfile
+
+import instrumentation
+from connection_pool import close_pool
+from ehr_tables import LAB_TABLE, PATIENT_TABLE
+from fake_files import fake_files
+from patient_parser_v4 import Lab, parse_data, Patient
+
+
+def test_instrumented() -> None:
+    """Test the counters, phases and histograms of a parse."""
+    original = vars(Patient)["gender"]
+    with tempfile.TemporaryDirectory() as dirname:
+        db_name = str(pathlib.Path(dirname) / "stats.db")
+        with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+            with instrumentation.instrumented() as stats:
+                patient_dict, lab_dict = parse_data(
+                    files[0], files[1], db=db_name
+                )
+                assert vars(Patient)["gender"] is not original
+                patient_dict["1"].gender
+                patient_dict["2"].gender
+                lab_dict["1"][0].value
+
+        assert instrumentation.current() is None
+        assert vars(Patient)["gender"] is original
+        patient_dict["1"].gender
+
+        assert stats.counters["rows_inserted"] == 5
+        assert stats.counters["connections_opened"] >= 1
+        assert stats.counters["sql_statements.INSERT"] >= 5
+        assert stats.counters["sql_statements.SELECT"] >= 3
+        for function_name in ["lab_file_to_dict", "patient_file_to_dict"]:
+            for phase in ["parse", "date_conversion", "insert", "commit"]:
+                assert stats.phases[f"{function_name}.{phase}"] >= 0
+        assert stats.histograms["Patient.gender"].count == 2
+        assert stats.histograms["Lab.value"].count == 1
+        assert "Lab.name" not in stats.histograms
+
+        with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+            with instrumentation.instrumented() as parallel:
+                parse_data(files[0], files[1], workers=2, db=db_name)
+            with open(files[1], "a") as f:
+                f.write("\n" + "\t".join(LAB_TABLE[1]))
+            with instrumentation.instrumented() as appended:
+                parse_data(files[0], files[1], incremental=True, db=db_name)
+        assert parallel.counters["rows_inserted"] == 5
+        for phase in ["parse", "insert", "commit"]:
+            assert f"lab_file_to_dict_parallel.{phase}" in parallel.phases
+        assert appended.counters["rows_inserted"] == 1
+        for phase in ["parse", "date_conversion", "insert", "commit"]:
+            assert f"lab_file_append.{phase}" in appended.phases
+
+        output = pathlib.Path(dirname) / "stats.json"
+        stats.dump(str(output))
+        dumped = json.loads(output.read_text())
+        assert dumped["counters"]["rows_inserted"] == 5
+        assert dumped["histograms"]["Patient.gender"]["count"] == 2
+        close_pool(db_name)
+
+
+def test_disabled() -> None:
+    """Test that nothing is recorded or wrapped while disabled."""
+    stats = instrumentation.enable()
+    assert instrumentation.disable() is stats
+    assert instrumentation.disable() is None
+    with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+        patient_dict, lab_dict = parse_data(files[0], files[1])
+    lab_dict["1"][0].value
+    assert not stats.counters
+    assert not stats.histograms
+    assert isinstance(vars(Lab)["value"], property)
+
+
+def test_histogram() -> None:
+    """Test the power-of-two bucketing."""
+    histogram = instrumentation.Histogram()
+    for seconds in [0.0, 1e-6, 3e-6, 1e-3]:
+        histogram.record(seconds)
+    summary = histogram.as_dict()
+    assert summary["count"] == 4
+    assert summary["buckets_us"] == {"1": 2, "4": 1, "1024": 1}
+    assert summary["max_seconds"] == 1e-3
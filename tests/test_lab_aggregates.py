@@ -0,0 +1,122 @@
+"""Test the streaming lab aggregation."""
+import math
+import random
+import statistics
+
+import pytest
+
+from ehr_tables import LAB_TABLE, PATIENT_TABLE
+from fake_files import fake_files
+from lab_aggregates import aggregate_labs, QuantileSketch, RunningStats
+from patient_parser_v4 import parse_data
+
+ALBUMIN = "METABOLIC: ALBUMIN"
+PROTEIN = "METABOLIC: URINE PROTEIN"
+
+
+def test_running_stats() -> None:
+    """Test that single, batched and merged updates agree with statistics."""
+    rng = random.Random(0)
+    values = [rng.gauss(4.0, 0.5) for _ in range(1000)]
+    single, batched, left, right = (RunningStats() for _ in range(4))
+    for value in values:
+        single.add(value)
+    batched.add_many(values)
+    left.add_many(values[:300])
+    right.add_many(values[300:])
+    left.merge(right)
+    for stats in (single, batched, left):
+        assert stats.count == 1000
+        assert stats.mean == pytest.approx(statistics.fmean(values))
+        assert stats.std == pytest.approx(statistics.stdev(values))
+        assert (stats.minimum, stats.maximum) == (min(values), max(values))
+    assert RunningStats().std is None
+
+
+def test_quantile_sketch() -> None:
+    """Test that merged sketches stay within their relative accuracy."""
+    rng = random.Random(1)
+    values = [rng.lognormvariate(0, 2) for _ in range(5000)]
+    values += [-value for value in values[:500]] + [0.0] * 100
+    first, second = QuantileSketch(0.01), QuantileSketch(0.01)
+    first.add_many(values[:2000])
+    for value in values[2000:]:
+        second.add(value)
+    first.merge(second)
+    assert first.count == len(values)
+
+    ordered = sorted(values)
+    for q in (0, 0.01, 0.05, 0.1, 0.5, 0.9, 0.99, 1):
+        exact = ordered[int(q * (len(values) - 1))]
+        estimate = first.quantile(q)
+        assert estimate is not None
+        assert abs(estimate - exact) <= 0.01 * abs(exact) + 1e-12
+    assert QuantileSketch().quantile(0.5) is None
+    with pytest.raises(ValueError):
+        first.merge(QuantileSketch(0.02))
+    with pytest.raises(ValueError):
+        first.quantile(1.5)
+
+
+def test_nan_values() -> None:
+    """Test that NaN values are skipped by every update."""
+    for aggregate in (RunningStats(), QuantileSketch()):
+        aggregate.add(math.nan)
+        aggregate.add(2.0)
+        aggregate.add_many([math.nan, 4.0, math.nan])
+        aggregate.add_many([math.nan])
+        assert aggregate.count == 2
+    stats, sketch = RunningStats(), QuantileSketch()
+    for aggregate in (stats, sketch):
+        aggregate.add_many([1.0, math.nan, 3.0])
+    assert stats.mean == 2.0
+    assert stats.std == pytest.approx(math.sqrt(2))
+    assert sketch.zeros == 0
+    assert sketch.quantile(1) == pytest.approx(3.0, 0.01)
+
+
+def test_aggregate_labs() -> None:
+    """Test per-lab, stratified, latest-only and sharded aggregates."""
+    extra_lab = ["2", "2", ALBUMIN, "5.0", "gm/dL", "2012-01-01 00:00:00.000"]
+    with fake_files(PATIENT_TABLE, LAB_TABLE + [extra_lab]) as files:
+        patient_dict, _ = parse_data(files[0], files[1])
+    db_name = patient_dict["1"].db_name
+
+    summaries = {
+        summary.lab_name: summary
+        for summary in aggregate_labs(db_name).summaries([0.5])
+    }
+    assert summaries[ALBUMIN].n_values == 3
+    assert summaries[ALBUMIN].mean == pytest.approx(4.0)
+    assert summaries[ALBUMIN].std == pytest.approx(0.9539392)
+    assert (summaries[ALBUMIN].minimum, summaries[ALBUMIN].maximum) == (
+        3.1,
+        5.0,
+    )
+    assert summaries[ALBUMIN].percentiles[0.5] == pytest.approx(3.9, 0.01)
+    assert summaries[PROTEIN].n_values == 1
+    assert summaries[PROTEIN].std is None
+
+    by_gender = {
+        (summary.lab_name, summary.stratum): summary.n_values
+        for summary in aggregate_labs(db_name, "Gender").summaries()
+    }
+    assert by_gender == {
+        (ALBUMIN, "Male"): 2,
+        (ALBUMIN, "Female"): 1,
+        (PROTEIN, "Female"): 1,
+    }
+
+    # only the 2011 albumin result of patient 1 counts
+    latest = aggregate_labs(db_name, latest_only=True)
+    assert latest.groups[ALBUMIN, None].stats.count == 2
+    assert latest.groups[ALBUMIN, None].stats.mean == pytest.approx(4.45)
+
+    # shards of patients merge into the whole
+    merged = aggregate_labs(db_name, "Race", patient_ids=["1"]).merge(
+        aggregate_labs(db_name, "Race", patient_ids=["2"], chunk_rows=1)
+    )
+    assert merged.summaries() == aggregate_labs(db_name, "Race").summaries()
+
+    with pytest.raises(ValueError):
+        aggregate_labs(db_name, "Language")
@@ -0,0 +1,59 @@
+"""Test the point-in-time lab lookups."""
+import datetime as dt
+
+from ehr_tables import LAB_TABLE, PATIENT_TABLE
+from fake_files import fake_files
+from lab_series import LabSeries
+from patient_parser_v4 import parse_data
+
+ALBUMIN = "METABOLIC: ALBUMIN"
+# a tie with the 2011 albumin result, and a result with no fraction
+EXTRA_LABS = [
+    ["1", "4", ALBUMIN, "5.0", "gm/dL", "2011-12-19 02:49:23.900"],
+    ["1", "5", ALBUMIN, "4.2", "gm/dL", "2015-03-01 00:00:00"],
+]
+
+
+def test_lab_series() -> None:
+    """Test that the index and the SQL lookups give the same answers."""
+    with fake_files(PATIENT_TABLE, LAB_TABLE + EXTRA_LABS) as files:
+        patient_dict, _ = parse_data(files[0], files[1])
+        series = LabSeries.from_file(files[1])
+    assert len(series) == 2
+    assert len(series.dates("1", ALBUMIN)) == 4
+    assert len(series.dates("2", ALBUMIN)) == 0
+
+    patient = patient_dict["1"]
+    queries = [
+        (dt.datetime(1990, 1, 1), None),
+        (dt.datetime(1992, 7, 1, 8, 10, 42, 320000), 3.1),
+        (dt.datetime(2000, 1, 1), 3.1),
+        # the tie goes to the result ingested first
+        (dt.datetime(2011, 12, 19, 2, 49, 23, 900000), 3.9),
+        (dt.datetime(2015, 3, 1), 4.2),
+        (dt.datetime(2030, 1, 1), 4.2),
+    ]
+    window = (
+        dt.datetime(1992, 7, 1, 8, 10, 42, 320000),
+        dt.datetime(2015, 3, 1),
+    )
+    expected_window = [
+        (dt.datetime(1992, 7, 1, 8, 10, 42, 320000), 3.1),
+        (dt.datetime(2011, 12, 19, 2, 49, 23, 900000), 3.9),
+        (dt.datetime(2011, 12, 19, 2, 49, 23, 900000), 5.0),
+        (dt.datetime(2015, 3, 1), 4.2),
+    ]
+    for attached in (False, True):
+        if attached:
+            series.attach(patient_dict.values())
+        for when, value in queries:
+            assert patient.lab_value_at(ALBUMIN, when) == value
+        assert patient.lab_values_between(ALBUMIN, *window) == expected_window
+        assert (
+            patient.lab_values_between(
+                ALBUMIN, dt.datetime(2012, 1, 1), dt.datetime(2013, 1, 1)
+            )
+            == []
+        )
+        assert patient_dict["2"].lab_value_at(ALBUMIN, queries[-1][0]) is None
+        assert patient.lab_value_at("NOT A LAB", queries[-1][0]) is None
@@ -0,0 +1,69 @@
+"""Test the columnar LabTable."""
+import datetime as dt
+
+import numpy as np
+import pytest
+
+from ehr_tables import LAB_TABLE, PATIENT_TABLE
+from fake_files import fake_files
+from lab_table import LabTable
+from patient_parser_v4 import parse_data
+
+
+def test_lab_table_columns() -> None:
+    """Test that the table matches the LABS table it was loaded from."""
+    with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+        patient_dict, lab_dict = parse_data(files[0], files[1])
+        from_file = LabTable.from_file(files[1])
+    table = LabTable.from_db(patient_dict["1"].db_name)
+
+    assert len(table) == 3
+    assert table.patient_ids == ["1", "2"]
+    assert table.names == ["METABOLIC: ALBUMIN", "METABOLIC: URINE PROTEIN"]
+    assert table.units == ["gm/dL"]
+    assert list(table.offsets) == [0, 2, 3]
+    assert table.rows_for("1") == slice(0, 2)
+    assert table.rows_for("3") == slice(0, 0)
+    assert list(table.autogen_id) == [1, 2, 3]
+    assert table.date[1] == np.datetime64("2011-12-19T02:49:23.900")
+    for column in ["patient", "admission_id", "name", "value", "date"]:
+        assert np.array_equal(
+            getattr(table, column), getattr(from_file, column)
+        )
+
+
+def test_lab_table_queries() -> None:
+    """Test the vectorized filters and latest-value queries."""
+    with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+        table = LabTable.from_file(files[1])
+
+    assert table.mask("METABOLIC: ALBUMIN").sum() == 2
+    assert table.mask(min_value=3.5).sum() == 2
+    assert table.mask(end=dt.datetime(2000, 1, 1)).sum() == 1
+    assert table.mask("UNKNOWN").sum() == 0
+    assert table.latest_values("METABOLIC: ALBUMIN") == {"1": 3.9}
+    assert table.cohort_is_sick("METABOLIC: ALBUMIN", ">", 3.6) == {
+        "1": True,
+        "2": None,
+    }
+    assert not table.is_sick("2", "METABOLIC: URINE PROTEIN", ">", 5.0)
+    with pytest.raises(ValueError):
+        table.is_sick("2", "METABOLIC: ALBUMIN", ">", 5.0)
+    assert table.first_admission("1") == dt.datetime(
+        1992, 7, 1, 8, 10, 42, 320000
+    )
+
+
+def test_patient_with_lab_table() -> None:
+    """Test that patients answer lab questions from an attached table."""
+    with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+        patient_dict, lab_dict = parse_data(files[0], files[1], hydrated=True)
+        table = LabTable.from_file(files[1])
+    table.attach(patient_dict.values())
+
+    for patient in patient_dict.values():
+        patient.labs = []  # the labs must come from the table
+    assert patient_dict["1"].is_sick("METABOLIC: ALBUMIN", ">", 3.6)
+    assert not patient_dict["2"].is_sick("METABOLIC: URINE PROTEIN", ">", 5.0)
+    assert patient_dict["1"].age_at_first_admission == 45
+    assert patient_dict["2"].age_at_first_admission == 12
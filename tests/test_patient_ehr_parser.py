@@ -1,8 +1,41 @@
 """Test parse_data function."""
+import pathlib
 import pytest
+import sqlite3
+import tempfile
 
+import instrumentation
+from connection_pool import (
+    close_pool,
+    configure_pool,
+    configure_read_only,
+    get_pool,
+    shared_memory_uri,
+)
+from ehr_tables import LAB_TABLE, PATIENT_TABLE
 from fake_files import fake_files
-from patient_parser_v4 import parse_data, Patient, Lab
+from patient_parser_v4 import (
+    build_indexes,
+    bulk_loading,
+    cached_date_parser,
+    chunk_ranges,
+    date_parser,
+    DEFAULT_INDEXES,
+    drop_indexes,
+    from_epoch,
+    lab_file_to_dict,
+    LabDeduplicator,
+    LabEncoder,
+    lab_file_to_dict_parallel,
+    list_indexes,
+    map_patients,
+    parse_data,
+    Patient,
+    PatientMapping,
+    Lab,
+    strptime_date_parser,
+    to_epoch,
+)
 import datetime as dt
 
 
@@ -154,3 +187,518 @@ def test_parser() -> None:
     # assert for age_at_first_admission
     assert patient_dict["1"].age_at_first_admission == 45
     assert patient_dict["2"].age_at_first_admission == 12
+
+
+def test_hydrated_parser() -> None:
+    """Test that hydrated objects cache their rows until refresh()."""
+    with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+        patient_dict, lab_dict = parse_data(files[0], files[1], hydrated=True)
+
+    patient = patient_dict["1"]
+    assert patient.gender == "Male"
+    assert patient.dob == dt.datetime(1947, 12, 28, 2, 45, 40, 547000)
+    assert patient.poverty_level == "0.1"
+    assert patient.labs[1].value == 3.9
+    assert patient.labs[1].date == dt.datetime(2011, 12, 19, 2, 49, 23, 900000)
+    assert patient.is_sick("METABOLIC: ALBUMIN", ">", 3.6)
+
+    connection = sqlite3.connect(patient.db_name)
+    connection.execute("UPDATE PATIENTS SET Gender = 'Unknown' WHERE ID = '1'")
+    connection.execute("UPDATE LABS SET Value = 1.0 WHERE Autogen_id = 2")
+    connection.commit()
+    connection.close()
+
+    # cached values survive until the row is re-read
+    assert patient.gender == "Male"
+    assert patient.labs[1].value == 3.9
+    patient.refresh()
+    patient.labs[1].refresh()
+    assert patient.gender == "Unknown"
+    assert patient.labs[1].value == 1.0
+
+
+def test_hydrate_labs() -> None:
+    """Test that hydrate_labs fills every lab of a patient at once."""
+    with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+        patient_dict, lab_dict = parse_data(files[0], files[1])
+
+    patient = patient_dict["1"]
+    assert not any(lab.hydrated for lab in patient.labs)
+    patient.hydrate_labs()
+    assert all(lab.hydrated for lab in patient.labs)
+    assert [lab.admission_id for lab in patient.labs] == [1, 3]
+    assert [lab.unit for lab in patient.labs] == ["gm/dL", "gm/dL"]
+    assert patient.age_at_first_admission == 45
+
+
+def test_lab_encoder() -> None:
+    """Test that new lab names and units get consecutive keys."""
+    with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+        patient_dict, _ = parse_data(files[0], files[1], db=":memory:")
+    with get_pool(patient_dict["1"].db_name).connection() as connection:
+        encoder = LabEncoder(connection)
+        assert sorted(encoder.names.values()) == [1, 2]
+        rows = [
+            ("1", 1, "CBC: HEMOGLOBIN", 13.0, "g/dL", "2010-01-01", 4),
+            ("1", 1, "METABOLIC: ALBUMIN", 4.0, "mg/L", "2010-01-01", 5),
+            ("2", 1, "CBC: PLATELETS", 250.0, "mg/L", "2010-01-01", 6),
+        ]
+        assert [row[2::2] for row in encoder.encode_rows(rows)] == [
+            (3, 2, 4),
+            (1, 3, 5),
+            (4, 3, 6),
+        ]
+        encoder.flush()
+        assert LabEncoder(connection).names["CBC: PLATELETS"] == 4
+        assert LabEncoder(connection).units == {
+            "gm/dL": 1,
+            "g/dL": 2,
+            "mg/L": 3,
+        }
+    close_pool(patient_dict["1"].db_name)
+
+
+def test_indexes() -> None:
+    """Test building, listing and dropping the secondary indexes."""
+    with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+        patient_dict, lab_dict = parse_data(files[0], files[1])
+
+    connection = sqlite3.connect(patient_dict["1"].db_name)
+    assert list_indexes(connection, "LAB_RESULTS") == sorted(DEFAULT_INDEXES)
+    plan = connection.execute(
+        """
+        EXPLAIN QUERY PLAN
+        SELECT Value FROM LABS WHERE PatientID = ? AND Name = ?
+        """,
+        ("1", "METABOLIC: ALBUMIN"),
+    ).fetchall()
+    assert "idx_labs_patient_name_date" in str(plan)
+
+    assert drop_indexes(connection, ["idx_labs_admission"]) == [
+        "idx_labs_admission"
+    ]
+    timings = build_indexes(connection)
+    assert set(timings) == set(DEFAULT_INDEXES)
+    assert all(seconds >= 0 for seconds in timings.values())
+
+    drop_indexes(connection)
+    assert list_indexes(connection) == []
+    connection.close()
+
+
+def test_batched_ingest() -> None:
+    """Test that the batch size does not change the ingested tables."""
+    dumps = []
+    for batch_size in (1, 2, 10_000):
+        with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+            patient_dict, lab_dict = parse_data(
+                files[0], files[1], batch_size=batch_size
+            )
+        connection = sqlite3.connect(patient_dict["1"].db_name)
+        dumps.append(
+            (
+                connection.execute("SELECT * FROM PATIENTS").fetchall(),
+                connection.execute("SELECT * FROM LABS").fetchall(),
+            )
+        )
+        connection.close()
+        assert [lab.Autogen_id for lab in lab_dict["1"]] == [1, 2]
+
+    assert dumps[0] == dumps[1] == dumps[2]
+    assert len(dumps[0][1]) == 3
+
+    with pytest.raises(ValueError):
+        with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+            parse_data(files[0], files[1], batch_size=0)
+
+
+def test_date_parser() -> None:
+    """Test that the fast date parser agrees with strptime."""
+    for date in [
+        "2011-12-19 02:49:23.900",
+        "1947-12-28 02:45:40.547\n",
+        "1992-07-01 08:10:42.320000",
+        "1992-07-01 08:10:42.3",
+    ]:
+        assert date_parser(date) == strptime_date_parser(date)
+
+    # SQLite drops the fraction of datetimes without microseconds
+    assert date_parser("1992-07-01 08:10:42") == dt.datetime(
+        1992, 7, 1, 8, 10, 42
+    )
+    # irregular strings fall back to strptime and fail the same way
+    for date in ["1992-07-01T08:10:42.320", "1992-13-01 08:10:42.320"]:
+        with pytest.raises(ValueError):
+            date_parser(date)
+
+    parse_date = cached_date_parser(2)
+    assert parse_date("2011-12-19 02:49:23.900") is parse_date(
+        "2011-12-19 02:49:23.900"
+    )
+
+
+def test_incremental_ingest() -> None:
+    """Test that incremental parses only ingest what changed."""
+    new_lab = [
+        "2",
+        "2",
+        "METABOLIC: URINE PROTEIN",
+        "6.2",
+        "gm/dL",
+        "2012-01-05 10:00:00.000",
+    ]
+    with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+        parse_data(files[0], files[1])
+        with open(files[1], "a") as f:
+            f.write("\n" + "\t".join(new_lab))
+        patient_table = [row[:] for row in PATIENT_TABLE]
+        patient_table[2][5] = "English"
+        with open(files[0], "w") as f:
+            f.write("\n".join("\t".join(row) for row in patient_table))
+
+        patient_dict, lab_dict = parse_data(
+            files[0], files[1], incremental=True
+        )
+        assert [lab.Autogen_id for lab in lab_dict["2"]] == [3, 4]
+        assert patient_dict["2"].labs[1].value == 6.2
+        assert patient_dict["2"].language == "English"
+        assert patient_dict["2"].is_sick("METABOLIC: URINE PROTEIN", ">", 5.0)
+
+        # nothing changed, so nothing is ingested twice
+        patient_dict, lab_dict = parse_data(
+            files[0], files[1], incremental=True
+        )
+        connection = sqlite3.connect(patient_dict["1"].db_name)
+        assert connection.execute("SELECT COUNT(*) FROM LABS").fetchone() == (
+            4,
+        )
+        assert sum(len(labs) for labs in lab_dict.values()) == 4
+        assert sorted(patient_dict) == ["1", "2"]
+
+        # a rewritten file is reloaded from scratch
+        with open(files[1], "w") as f:
+            rewritten = LAB_TABLE[:2] + LAB_TABLE[3:]
+            f.write("\n".join("\t".join(row) for row in rewritten))
+        patient_dict, lab_dict = parse_data(
+            files[0], files[1], incremental=True
+        )
+        assert connection.execute("SELECT COUNT(*) FROM LABS").fetchone() == (
+            2,
+        )
+        assert [lab.Autogen_id for lab in lab_dict["2"]] == [2]
+        connection.close()
+
+
+def test_parallel_lab_ingest() -> None:
+    """Test that parallel parsing builds the same LABS table."""
+    lab_table = LAB_TABLE + LAB_TABLE[1:] * 5
+    with fake_files(lab_table) as files:
+        ranges = chunk_ranges(files[0], chunk_size=64)
+        assert len(ranges) > 1
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            assert end == start
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            db_name = str(pathlib.Path(tmpdirname) / "labs.db")
+            connection = sqlite3.connect(db_name)
+            sequential = lab_file_to_dict(files[0], connection, db_name)
+            expected = connection.execute("SELECT * FROM LABS").fetchall()
+            parallel = lab_file_to_dict_parallel(
+                files[0], connection, db_name, workers=2, chunk_size=64
+            )
+            actual = connection.execute("SELECT * FROM LABS").fetchall()
+            connection.close()
+
+    assert actual == expected
+    assert len(actual) == 18
+    assert {
+        patient_id: [lab.Autogen_id for lab in labs]
+        for patient_id, labs in parallel.items()
+    } == {
+        patient_id: [lab.Autogen_id for lab in labs]
+        for patient_id, labs in sequential.items()
+    }
+
+
+def test_database_targets() -> None:
+    """Test parsing into files, in-memory databases and connections."""
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        db_name = str(pathlib.Path(tmpdirname) / "target.db")
+        snapshot = str(pathlib.Path(tmpdirname) / "snapshot.db")
+        with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+            on_file, _ = parse_data(files[0], files[1], db=db_name)
+            in_memory, _ = parse_data(
+                files[0],
+                files[1],
+                db=shared_memory_uri("test_database_targets"),
+                snapshot_to=snapshot,
+            )
+            private, _ = parse_data(files[0], files[1], db=":memory:")
+            connection = sqlite3.connect(":memory:")
+            adopted, _ = parse_data(files[0], files[1], db=connection)
+            # the pool still holds connections to the deleted file
+            pathlib.Path(db_name).unlink()
+            on_file, _ = parse_data(files[0], files[1], db=db_name)
+
+        for patient_dict in [on_file, in_memory, private, adopted]:
+            assert patient_dict["2"].gender == "Female"
+            assert patient_dict["1"].labs[1].value == 3.9
+            assert patient_dict["1"].is_sick("METABOLIC: ALBUMIN", ">", 3.6)
+        assert on_file["1"].db_name == db_name
+        assert in_memory["1"].db_name.startswith("file:")
+
+        copy = sqlite3.connect(snapshot)
+        assert copy.execute("SELECT COUNT(*) FROM LABS").fetchone() == (3,)
+        assert copy.execute("SELECT Race FROM PATIENTS").fetchall() == [
+            ("White",),
+            ("Black",),
+        ]
+        copy.close()
+        close_pool(db_name)
+        close_pool(adopted["1"].db_name)
+        with pytest.raises(sqlite3.ProgrammingError):
+            connection.execute("SELECT 1")
+
+
+def test_lazy_mapping() -> None:
+    """Test that lazy=True reads the same data back on demand."""
+    with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+        eager_patients, eager_labs = parse_data(files[0], files[1])
+        patient_dict, lab_dict = parse_data(
+            files[0], files[1], db=":memory:", lazy=True
+        )
+        incremental, _ = parse_data(
+            files[0], files[1], db=":memory:", incremental=True, lazy=True
+        )
+
+    assert isinstance(patient_dict, PatientMapping)
+    assert list(patient_dict) == list(eager_patients) == ["1", "2"]
+    assert list(lab_dict) == list(eager_labs) == ["1", "2"]
+    assert len(patient_dict) == len(lab_dict) == 2
+    assert "1" in patient_dict and "3" not in patient_dict
+    assert "2" in lab_dict and "3" not in lab_dict
+    with pytest.raises(KeyError):
+        patient_dict["3"]
+    with pytest.raises(KeyError):
+        lab_dict["3"]
+
+    for patient_id, patient in patient_dict.items():
+        eager = eager_patients[patient_id]
+        assert patient.gender == eager.gender
+        assert patient.dob == eager.dob
+        assert [lab.Autogen_id for lab in patient.labs] == [
+            lab.Autogen_id for lab in eager.labs
+        ]
+        assert [lab.value for lab in lab_dict[patient_id]] == [
+            lab.value for lab in eager_labs[patient_id]
+        ]
+    assert patient_dict["1"].labs[1].date == eager_patients["1"].labs[1].date
+    assert patient_dict["1"].is_sick("METABOLIC: ALBUMIN", ">", 3.6)
+    assert incremental["2"].labs[0].name == "METABOLIC: URINE PROTEIN"
+
+    # lookups are cached, up to cache_size patients
+    assert patient_dict["1"] is patient_dict["1"]
+    small = PatientMapping(patient_dict.db_name, cache_size=1)
+    first = small["1"]
+    assert small["1"] is first
+    small["2"]
+    assert small["1"] is not first
+
+
+def test_bulk_load() -> None:
+    """Test that a bulk load writes the same tables in one transaction."""
+    dumps = []
+    with tempfile.TemporaryDirectory() as dirname:
+        for bulk_load in (False, True):
+            db_name = str(pathlib.Path(dirname) / f"{bulk_load}.db")
+            with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+                parse_data(files[0], files[1], db=db_name, bulk_load=bulk_load)
+            connection = sqlite3.connect(db_name)
+            dumps.append(
+                (
+                    connection.execute("SELECT * FROM PATIENTS").fetchall(),
+                    connection.execute("SELECT * FROM LABS").fetchall(),
+                )
+            )
+            connection.close()
+            close_pool(db_name)
+        assert dumps[0] == dumps[1]
+
+        connection = sqlite3.connect(str(pathlib.Path(dirname) / "new.db"))
+        statements: list[str] = []
+        connection.set_trace_callback(statements.append)
+        other = sqlite3.connect(":memory:")
+        with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+            with bulk_loading(connection) as report:
+                parse_data(files[0], files[1], db=connection)
+                assert connection.in_transaction
+                # other connections still commit as they go
+                other_dict, _ = parse_data(files[0], files[1], db=other)
+                assert not other.in_transaction
+        close_pool(other_dict["1"].db_name)
+        assert statements.count("BEGIN") == 1
+        assert statements.count("COMMIT") == 1
+        assert report.applied["synchronous"] == 0
+        assert report.applied["page_size"] == 16384
+        assert report.seconds > 0
+        pragma = "PRAGMA synchronous"
+        assert connection.execute(pragma).fetchone()[0] == 2
+        assert connection.execute("PRAGMA journal_mode").fetchone() == (
+            "delete",
+        )
+
+        # a failed load is rolled back as a whole
+        with pytest.raises(ValueError):
+            with bulk_loading(connection):
+                connection.execute("DELETE FROM LABS")
+                raise ValueError
+        assert connection.execute("SELECT COUNT(*) FROM LABS").fetchone() == (
+            3,
+        )
+        connection.close()
+
+
+def test_map_patients() -> None:
+    """Stress concurrent reads, in the default pool and in read mode."""
+    assert Patient().labs is not Patient().labs
+    with tempfile.TemporaryDirectory() as dirname:
+        db_name = str(pathlib.Path(dirname) / "EHR.db")
+        with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+            patient_dict, _ = parse_data(files[0], files[1], db=db_name)
+
+        def read(patient: Patient) -> tuple[object, ...]:
+            labs = [(lab.name, lab.value, lab.date) for lab in patient.labs]
+            return (patient.gender, patient.dob, patient.age, labs)
+
+        patients = list(patient_dict.values()) * 200
+        expected = [read(patient) for patient in patients]
+        assert map_patients(read, patients, workers=1) == expected
+        assert map_patients(read, patients, workers=16) == expected
+
+        configure_read_only(db_name)
+        with instrumentation.instrumented() as stats:
+            assert map_patients(read, patients, workers=16) == expected
+        # one connection per worker thread at most, however many reads
+        assert 1 <= stats.counters["connections_opened"] <= 16
+        with pytest.raises(sqlite3.OperationalError):
+            parse_data(files[0], files[1], db=db_name)
+
+        def fail(patient: Patient) -> None:
+            raise KeyError(patient.id)
+
+        with pytest.raises(KeyError):
+            map_patients(fail, patients, workers=4)
+        with pytest.raises(ValueError):
+            map_patients(read, patients, workers=0)
+        configure_pool(db_name)
+        close_pool(db_name)
+
+
+def test_epoch_timestamps() -> None:
+    """Test that dates stored as epoch microseconds read back the same."""
+    albumin = "METABOLIC: ALBUMIN"
+    first = dt.datetime(1992, 7, 1, 8, 10, 42, 320000)
+    window = (first, dt.datetime(2012, 1, 1))
+
+    def date_types(db_name: str) -> list[tuple[str, ...]]:
+        connection = sqlite3.connect(db_name)
+        types = connection.execute(
+            """
+            SELECT DISTINCT typeof(Date) FROM LABS
+            UNION SELECT DISTINCT typeof(DateOfBirth) FROM PATIENTS
+            """
+        ).fetchall()
+        connection.close()
+        return types
+
+    with tempfile.TemporaryDirectory() as dirname, fake_files(
+        PATIENT_TABLE, LAB_TABLE
+    ) as files:
+        db_name = str(pathlib.Path(dirname) / "EHR.db")
+        expected, _ = parse_data(files[0], files[1], db=":memory:")
+        for hydrated in (False, True):
+            patient_dict, _ = parse_data(
+                files[0], files[1], hydrated, db=db_name, epoch_timestamps=True
+            )
+            assert date_types(db_name) == [("integer",)]
+            for patient_id, other in expected.items():
+                patient = patient_dict[patient_id]
+                assert patient.dob == other.dob
+                assert [lab.date for lab in patient.labs] == [
+                    lab.date for lab in other.labs
+                ]
+                assert (
+                    patient.age_at_first_admission
+                    == other.age_at_first_admission
+                )
+            patient = patient_dict["1"]
+            assert patient.labs[0].timestamp == to_epoch(first)
+            assert patient.is_sick(albumin, ">", 3.6)
+            assert patient.lab_value_at(albumin, window[1]) == 3.9
+            values = patient.lab_values_between(albumin, *window)
+            assert values == expected["1"].lab_values_between(albumin, *window)
+        assert from_epoch(to_epoch(first)) == first
+
+        # appended rows keep the format of the table
+        with open(files[1], "a") as f:
+            f.write(f"\n1\t4\t{albumin}\t4.5\tgm/dL\t2013-01-01 00:00:00.000")
+        patient_dict, _ = parse_data(
+            files[0], files[1], db=db_name, incremental=True
+        )
+        when = dt.datetime(2014, 1, 1)
+        assert patient_dict["1"].lab_value_at(albumin, when) == 4.5
+        assert date_types(db_name) == [("integer",)]
+        close_pool(db_name)
+
+
+def test_lab_dedup() -> None:
+    """Test that repeated lab rows are dropped, keeping the first ones."""
+    repeat = LAB_TABLE[1][:3] + ["3.10"] + LAB_TABLE[1][4:]
+    changed = LAB_TABLE[3][:3] + ["4.0"] + LAB_TABLE[3][4:]
+    lab_table = LAB_TABLE + [repeat, LAB_TABLE[2], changed, LAB_TABLE[3]]
+    expected_ids = {"1": [1, 2], "2": [3, 4]}
+    with tempfile.TemporaryDirectory() as dirname, fake_files(
+        PATIENT_TABLE, lab_table, lab_table + lab_table[1:] * 2
+    ) as files:
+        db_name = str(pathlib.Path(dirname) / "EHR.db")
+        dumps = []
+        for dedup in (LabDeduplicator(), LabDeduplicator(max_digests=1)):
+            with instrumentation.instrumented() as stats:
+                _, lab_dict = parse_data(
+                    files[0], files[1], db=db_name, dedup=dedup
+                )
+            assert dedup.dropped == 3
+            assert dedup.kept == 4
+            assert stats.counters["lab_duplicates_dropped"] == 3
+            assert {
+                patient_id: [lab.Autogen_id for lab in labs]
+                for patient_id, labs in lab_dict.items()
+            } == expected_ids
+            assert lab_dict["2"][1].value == 4.0
+            connection = sqlite3.connect(db_name)
+            dumps.append(connection.execute("SELECT * FROM LABS").fetchall())
+            connection.close()
+        assert dedup.spilled > 0
+        assert dumps[0] == dumps[1]
+
+        # the parallel ingest drops the same rows
+        connection = sqlite3.connect(db_name)
+        dedup = LabDeduplicator()
+        lab_file_to_dict_parallel(
+            files[2], connection, db_name, 2, chunk_size=64, dedup=dedup
+        )
+        assert connection.execute("SELECT * FROM LABS").fetchall() == dumps[0]
+        assert dedup.dropped == 3 + 2 * 7
+
+        # appended repeats of rows already ingested are dropped too
+        parse_data(files[0], files[1], db=db_name)
+        with open(files[1], "a") as f:
+            f.write("\n" + "\t".join(LAB_TABLE[1]))
+        dedup = LabDeduplicator()
+        _, lab_dict = parse_data(
+            files[0], files[1], db=db_name, incremental=True, dedup=dedup
+        )
+        assert dedup.dropped == 1
+        assert len(lab_dict["1"]) == 4
+        connection.close()
+        close_pool(db_name)
@@ -0,0 +1,219 @@
+"""Test the binary snapshot cache."""
+import os
+import pathlib
+import sqlite3
+import tempfile
+
+import instrumentation
+from connection_pool import close_pool, get_pool
+from ehr_tables import LAB_TABLE, PATIENT_TABLE
+from fake_files import fake_files
+from patient_parser_v4 import (
+    IndexSpec,
+    LabDeduplicator,
+    list_indexes,
+    parse_data,
+)
+from snapshot_cache import (
+    cached_parse_data,
+    MANIFEST,
+    SNAPSHOT_TABLES,
+    SnapshotCache,
+)
+
+
+def dump(db_name: str) -> tuple[list[tuple[object, ...]], ...]:
+    """Return the rows of PATIENTS and LABS."""
+    connection = sqlite3.connect(db_name)
+    tables = (
+        connection.execute("SELECT * FROM PATIENTS").fetchall(),
+        connection.execute("SELECT * FROM LABS").fetchall(),
+    )
+    connection.close()
+    return tables
+
+
+def test_snapshot_cache() -> None:
+    """Test misses, hits, restores and invalidation."""
+    with tempfile.TemporaryDirectory() as dirname:
+        cache = SnapshotCache(str(pathlib.Path(dirname) / "cache"))
+        first_db = str(pathlib.Path(dirname) / "first.db")
+        second_db = str(pathlib.Path(dirname) / "second.db")
+        with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+            assert cache.load(files[0], files[1]) is None
+            patient_dict, lab_dict = cached_parse_data(
+                files[0], files[1], cache, db=first_db
+            )
+            assert len(cache.keys()) == 1
+            snapshot = cache.load(files[0], files[1])
+            assert snapshot is not None
+            assert snapshot.values("LAB_RESULTS", "Value") == [3.1, 3.9, 3.9]
+
+            # reading the tables in chunks gives the same columns
+            chunked = SnapshotCache(str(pathlib.Path(dirname) / "chunked"))
+            with get_pool(first_db).connection() as connection:
+                in_chunks = chunked.save(
+                    files[0], files[1], connection, chunk_rows=2
+                )
+            assert in_chunks is not None
+            assert in_chunks.manifest["tables"] == snapshot.manifest["tables"]
+            for table, columns in SNAPSHOT_TABLES.items():
+                for column, _ in columns:
+                    assert in_chunks.values(table, column) == snapshot.values(
+                        table, column
+                    )
+
+            # the database already holds the ingest: nothing is written
+            copy_db = str(pathlib.Path(dirname) / "copy.db")
+            with instrumentation.instrumented() as stats:
+                cached_dict, cached_labs = cached_parse_data(
+                    files[0], files[1], cache, db=first_db, snapshot_to=copy_db
+                )
+            assert stats.counters["sql_statements.INSERT"] == 0
+            assert dump(copy_db) == dump(first_db)
+
+            # new indexes are built on a hit against a current database
+            value_index: dict[str, IndexSpec] = {
+                "idx_labs_value": ("LAB_RESULTS", ("Value",))
+            }
+            with instrumentation.instrumented() as stats:
+                cached_parse_data(
+                    files[0], files[1], cache, db=first_db, indexes=value_index
+                )
+            assert stats.counters["sql_statements.INSERT"] == 0
+            with get_pool(first_db).connection() as connection:
+                assert "idx_labs_value" in list_indexes(connection)
+            assert list(cached_dict) == list(patient_dict)
+            assert list(cached_labs) == list(lab_dict)
+            for patient_id, labs in lab_dict.items():
+                assert [lab.Autogen_id for lab in cached_labs[patient_id]] == [
+                    lab.Autogen_id for lab in labs
+                ]
+            assert cached_dict["1"].labs[1].value == 3.9
+            assert cached_dict["2"].gender == "Female"
+
+            # a new database is restored from the columns
+            cached_parse_data(
+                files[0], files[1], cache, db=second_db, hydrated=True
+            )
+            assert dump(second_db) == dump(first_db)
+            expected = parse_data(files[0], files[1], db=":memory:")[0]["1"]
+            restored = cached_parse_data(
+                files[0], files[1], cache, db=":memory:"
+            )[0]
+            assert restored["1"].dob == expected.dob
+
+            # a changed file misses, and its stale snapshot is evicted
+            stale = cache.keys()
+            with open(files[1], "a") as f:
+                f.write("\n2\t2\tMETABOLIC: ALBUMIN\t4.0\tgm/dL\t")
+                f.write("2012-01-01 00:00:00.000")
+            assert cache.load(files[0], files[1]) is None
+            _, lab_dict = cached_parse_data(
+                files[0], files[1], cache, db=first_db
+            )
+            assert len(lab_dict["2"]) == 2
+            assert len(cache.keys()) == 1
+            assert cache.keys() != stale
+
+            # a damaged snapshot is dropped
+            key = cache.keys()[0]
+            os.truncate(
+                os.path.join(cache.directory, key, "LAB_RESULTS.Value.npy"),
+                10,
+            )
+            assert cache.load(files[0], files[1]) is None
+            assert cache.keys() == []
+        close_pool(first_db)
+        close_pool(second_db)
+
+
+def test_snapshot_cache_size() -> None:
+    """Test the size limit and the least recently used eviction."""
+    with tempfile.TemporaryDirectory() as dirname:
+        db_name = str(pathlib.Path(dirname) / "EHR.db")
+        with fake_files(
+            PATIENT_TABLE, LAB_TABLE, LAB_TABLE[:3] + LAB_TABLE[2:]
+        ) as files:
+            tiny = SnapshotCache(str(pathlib.Path(dirname) / "tiny"), 10)
+            cached_parse_data(files[0], files[1], tiny, db=db_name)
+            assert tiny.keys() == []
+
+            cache = SnapshotCache(str(pathlib.Path(dirname) / "cache"))
+            cached_parse_data(files[0], files[1], cache, db=db_name)
+            cached_parse_data(files[0], files[2], cache, db=db_name)
+            assert len(cache.keys()) == 2
+            first = cache.load(files[0], files[1])
+            assert first is not None
+            # the last use is the manifest's modification time, which
+            # may not tell two uses in quick succession apart
+            for key in cache.keys():
+                used = 2.0 if key == first.key else 1.0
+                manifest = os.path.join(cache.directory, key, MANIFEST)
+                os.utime(manifest, (used, used))
+
+            # room for one snapshot: the most recently loaded one stays
+            cache.max_bytes = cache.size() // 2 + 1
+            cache.evict()
+            assert cache.keys() == [first.key]
+        close_pool(db_name)
+
+
+def test_snapshot_cache_epochs() -> None:
+    """Test that snapshots keep, or convert, the format of the dates."""
+    with tempfile.TemporaryDirectory() as dirname:
+        cache = SnapshotCache(str(pathlib.Path(dirname) / "cache"))
+        text_db = str(pathlib.Path(dirname) / "text.db")
+        epoch_db = str(pathlib.Path(dirname) / "epoch.db")
+        restored_db = str(pathlib.Path(dirname) / "restored.db")
+        with fake_files(PATIENT_TABLE, LAB_TABLE) as files:
+            parse_data(files[0], files[1], db=text_db)
+            cached_parse_data(
+                files[0], files[1], cache, db=epoch_db, epoch_timestamps=True
+            )
+            snapshot = cache.load(files[0], files[1])
+            assert snapshot is not None
+            assert snapshot.epoch_columns("LAB_RESULTS") == ["Date"]
+            assert snapshot.epoch_columns("PATIENTS") == ["DateOfBirth"]
+
+            # restored as stored, or as asked for
+            cached_parse_data(files[0], files[1], cache, db=restored_db)
+            assert dump(restored_db) == dump(epoch_db)
+            with instrumentation.instrumented() as stats:
+                cached_parse_data(
+                    files[0],
+                    files[1],
+                    cache,
+                    db=restored_db,
+                    epoch_timestamps=False,
+                )
+            assert stats.counters["sql_statements.INSERT"] > 0
+            assert dump(restored_db) == dump(text_db)
+        for db_name in (text_db, epoch_db, restored_db):
+            close_pool(db_name)
+
+
+def test_snapshot_cache_dedup() -> None:
+    """Test that deduplicated and plain ingests keep separate snapshots."""
+    labs = LAB_TABLE + [LAB_TABLE[1]]
+    with tempfile.TemporaryDirectory() as dirname:
+        db_name = str(pathlib.Path(dirname) / "EHR.db")
+        with fake_files(PATIENT_TABLE, labs) as files:
+            for order in ((False, True), (True, False)):
+                cache = SnapshotCache(str(pathlib.Path(dirname) / str(order)))
+                for deduplicated in order:
+                    # a miss saves a snapshot, which the same call hits
+                    for hit in (False, True):
+                        snapshot = cache.load(files[0], files[1], deduplicated)
+                        assert (snapshot is not None) == hit
+                        dedup = LabDeduplicator() if deduplicated else None
+                        _, lab_dict = cached_parse_data(
+                            files[0], files[1], cache, db=db_name, dedup=dedup
+                        )
+                        expected = 3 if deduplicated else 4
+                        assert sum(map(len, lab_dict.values())) == expected
+                        assert len(dump(db_name)[1]) == expected
+                        if dedup is not None:
+                            assert (dedup.dropped, dedup.kept) == (1, 3)
+                assert len(cache.keys()) == 2
+        close_pool(db_name)
@@ -0,0 +1,41 @@
+"""Test the synthetic EHR generator."""
+import collections
+import pathlib
+import tempfile
+
+from connection_pool import close_pool
+from patient_parser_v4 import parse_data
+from synthetic_ehr import LAB_HEADER, PATIENT_HEADER, write_synthetic_ehr
+
+
+def test_synthetic_files_are_deterministic() -> None:
+    """Test that the same seed writes the same files."""
+    contents = []
+    for _ in range(2):
+        with tempfile.TemporaryDirectory() as dirname:
+            files = write_synthetic_ehr(dirname, 500, seed=7)
+            contents.append([pathlib.Path(name).read_text() for name in files])
+    assert contents[0] == contents[1]
+
+    patient_lines = contents[0][0].split("\n")
+    lab_lines = contents[0][1].split("\n")
+    assert patient_lines[0].split("\t") == PATIENT_HEADER
+    assert lab_lines[0].split("\t") == LAB_HEADER
+    assert len(patient_lines) == 1 + 25
+    assert len(lab_lines) == 1 + 500
+
+    labs_per_patient = collections.Counter(
+        line.split("\t")[0] for line in lab_lines[1:]
+    )
+    assert len(labs_per_patient) == 25
+    assert max(labs_per_patient.values()) > 2 * 500 / 25
+
+
+def test_synthetic_files_parse(tmp_path: pathlib.Path) -> None:
+    """Test that parse_data accepts the synthetic files."""
+    patient_file, lab_file = write_synthetic_ehr(str(tmp_path), 200)
+    db_name = str(tmp_path / "EHR.db")
+    patient_dict, lab_dict = parse_data(patient_file, lab_file, db=db_name)
+    assert len(patient_dict) == 10
+    assert sum(len(labs) for labs in lab_dict.values()) == 200
+    close_pool(db_name)
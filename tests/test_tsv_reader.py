@@ -0,0 +1,54 @@
+"""Test the memory-mapped TSV reader."""
+import pathlib
+import tempfile
+
+import pytest
+
+from patient_parser_v4 import chunk_ranges
+from tsv_reader import iter_rows, read_header
+
+CONTENT = "\ufeffa\tb\tc\r\n1\t2\t3\r\n\n 4\t5\t6 \nx\ty\tz"
+
+
+def test_iter_rows() -> None:
+    """Test column picking, the BOM, blank lines and line endings."""
+    with tempfile.TemporaryDirectory() as dirname:
+        path = pathlib.Path(dirname) / "table.txt"
+        path.write_bytes(CONTENT.encode("UTF-8"))
+
+        assert read_header(path.read_bytes()) == (["a", "b", "c"], 10)
+        assert list(iter_rows(str(path), ["c", "a"])) == [
+            ("3", "1"),
+            ("6", "4"),
+            ("z", "x"),
+        ]
+        assert list(iter_rows(str(path), ["b"], block_size=1)) == [
+            ("2",),
+            ("5",),
+            ("y",),
+        ]
+        with pytest.raises(KeyError):
+            list(iter_rows(str(path), ["d"]))
+
+        path.write_bytes(b"")
+        with pytest.raises(ValueError):
+            list(iter_rows(str(path), ["a"]))
+
+
+def test_iter_rows_ranges() -> None:
+    """Test that newline-aligned ranges split the rows without overlap."""
+    lines = ["id\tvalue"] + [f"{index}\t{index * 2}" for index in range(100)]
+    with tempfile.TemporaryDirectory() as dirname:
+        path = pathlib.Path(dirname) / "table.txt"
+        path.write_text("\n".join(lines))
+
+        whole = list(iter_rows(str(path), ["id", "value"]))
+        assert len(whole) == 100
+        ranges = chunk_ranges(str(path), chunk_size=64)
+        assert len(ranges) > 1
+        pieces = [
+            row
+            for start, end in ranges
+            for row in iter_rows(str(path), ["id", "value"], start, end)
+        ]
+        assert pieces == whole